@@ -4,31 +4,39 @@
 '''
 Fake RocketMap API
 
-This is a simplistic flask app to emulate what a pokemon go api returns.
+This is a flask app simulating the map the pokemon go api serves, to load
+test RocketMap without accounts or hashing keys.
 
-It *does not* speak protobuff, and uses a hacky internal re-routing. That said,
-it does the trick well enough in my testing.
+It *does not* speak protobuff: RocketMap's mock mode sends its requests as
+JSON and turns the answers back into protos.
 
-When first "logged into" it will create a static map of evenly distributed
-gyms and poke stops. As each "scan" is run, it will gerenate a set of pokemon
-for that scan area. "New" pokemon will be found every 10 minutes.
+The map is generated from a seed around a location: spawnpoints spawning for
+15, 30 or 60 minutes at the same second of every hour, pokestops with lures
+and gyms with raids (see pogom/world.py). The same seed and location always
+give the same map and the same answers at the same time, so several
+processes can serve one map, and runs can be compared.
 
-You can run this as is, and then just add `-m http://127.0.0.1:9090` to your
-runserver.py call to start using it.
+Time runs from --time-start (default now) at --time-speed times real time,
+e.g. `--time-speed 60` goes through an hour of spawns in a minute.
+
+You can run this as is, e.g.
+
+    python contrib/fake-pgo-api.py -l 40.7580,-73.9855 --processes 4
+
+and then just add `-m http://127.0.0.1:9090` to your runserver.py call to
+start using it.
 '''
 
+import os
+import sys
+import json
 import logging
 import configargparse
-import math
 
-from flask import Flask, jsonify
-from random import randint, getrandbits, seed, random
-from uuid import uuid4
-from time import time
-from s2sphere import CellId, LatLng
-import geopy
-from geopy.distance import VincentyDistance
-from geopy.distance import vincenty
+from flask import Flask, Response, request
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from pogom.world import SyntheticWorld, WorldClock  # noqa: E402
 
 logging.basicConfig(format=(
     '%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] ' +
@@ -40,6 +48,29 @@ parser = configargparse.ArgParser()
 parser.add_argument('-H', '--host', help='Server Host', default='127.0.0.1')
 parser.add_argument('-p', '--port', help='Server Port', default=9090, type=int)
 parser.add_argument('-d', '--debug', help='Debug Mode', action='store_true')
+parser.add_argument('-l', '--location', required=True,
+                    help='Center of the map, as lat,lng')
+parser.add_argument('-s', '--seed', help='Seed of the map', default=0,
+                    type=int)
+parser.add_argument('-r', '--radius', help='Radius of the map in meters',
+                    default=2000, type=int)
+parser.add_argument('-sp', '--spawnpoints', help='Number of spawnpoints',
+                    default=5000, type=int)
+parser.add_argument('-ps', '--pokestops', help='Number of pokestops',
+                    default=300, type=int)
+parser.add_argument('-g', '--gyms', help='Number of gyms', default=100,
+                    type=int)
+parser.add_argument('-ts', '--time-start',
+                    help='Epoch second the simulated time starts at',
+                    default=None, type=float)
+parser.add_argument('-tx', '--time-speed',
+                    help='How much faster than real time the time goes',
+                    default=1.0, type=float)
+parser.add_argument('-lv', '--level', help='Level of all accounts',
+                    default=30, type=int)
+parser.add_argument('-pr', '--processes',
+                    help='Number of server processes, threaded if 1',
+                    default=1, type=int)
 parser.set_defaults(DEBUG=False)
 args = parser.parse_args()
 
@@ -48,60 +79,48 @@ if args.debug:
 else:
     log.setLevel(logging.INFO)
 
-
-# A holder of gyms/pokestops
-forts = []
-
-
-def getRandomPoint(location=None, maxMeters=70):
-    origin = geopy.Point(location[0], location[1])
-    b = randint(0, 360)
-    d = math.sqrt(random()) * (float(maxMeters) / 1000)
-    destination = VincentyDistance(kilometers=d).destination(origin, b)
-    return (destination.latitude, destination.longitude)
-
-
-# TODO: This method is suuuuper inefficient.
-#       Namely, it loops over EVERY POSSIBLE fort and does a distance calc
-#       Not a time-cheap operation to do at all. It would be way more efficient
-#       if we had all the forts setup with s2 locations and could more quickly
-#       query for 'within XYZ cells'. Or something like that :/
-def getForts(location):
-    global forts
-
-    lforts = []
-    for i in forts:
-        f = (i['latitude'], i['longitude'])
-        d = vincenty(location, f).meters
-        if d < 900:
-            lforts.append(i)
-
-    return lforts
-
-
-def makeWildPokemon(location):
-    # Cause the randomness to only shift every N minutes (thus new pokes
-    # every N minutes)
-    offset = int(time() % 3600) / 10
-    seedid = str(location[0]) + str(location[1]) + str(offset)
-    seed(seedid)
-
-    # Now, collect the pokes for this can point
-    pokes = []
-    for i in range(randint(0, 2)):
-        coords = getRandomPoint(location)
-        ll = LatLng.from_degrees(coords[0], coords[1])
-        cellId = CellId.from_lat_lng(ll).parent(20).to_token()
-        pokes.append({
-            'encounter_id': 'pkm' + seedid + str(i),
-            'last_modified_timestamp_ms': int((time() - 10) * 1000),
-            'latitude': coords[0],
-            'longitude': coords[1],
-            'pokemon_data': {'pokemon_id': randint(1, 140)},
-            'spawn_point_id': cellId,
-            'time_till_hidden_ms': randint(60, 600) * 1000
-        })
-    return pokes
+world = SyntheticWorld(
+    args.seed, tuple(float(c) for c in args.location.split(',')),
+    radius=args.radius, spawnpoints=args.spawnpoints,
+    pokestops=args.pokestops, gyms=args.gyms)
+clock = WorldClock(args.time_start, args.time_speed)
+log.info('Generated map of %d spawnpoints and %d forts around %s.',
+         len(world.spawnpoints), len(world.forts), args.location)
+
+
+# Answer to a request the map doesn't know about: whatever keeps the account
+# going, as for a healthy account that did its tutorial.
+def account_response(name, now):
+    if name == 'GET_PLAYER':
+        return {'success': True,
+                'player_data': {'username': 'simulated',
+                                'tutorial_state': [0, 1, 3, 4, 7]}}
+    if name == 'GET_HOLO_INVENTORY':
+        return {'success': True,
+                'inventory_delta': {
+                    'new_timestamp_ms': int(now * 1000),
+                    'inventory_items': [{'inventory_item_data': {
+                        'player_stats': {'level': args.level}}}]}}
+    if name == 'DOWNLOAD_REMOTE_CONFIG_VERSION':
+        return {'result': 1}
+    if name == 'DOWNLOAD_SETTINGS':
+        return {'hash': 'simulated'}
+    if name == 'FORT_SEARCH':
+        return {'result': 1}
+    if name in ('VERIFY_CHALLENGE', 'LEVEL_UP_REWARDS'):
+        return {'success': True, 'result': 1}
+    return {}
+
+
+def respond(name, kwargs, position, now):
+    if name == 'GET_MAP_OBJECTS':
+        return world.map_objects(position, kwargs.get('cell_id'), now)
+    if name == 'ENCOUNTER':
+        return world.encounter(kwargs['encounter_id'],
+                               kwargs['spawn_point_id'], now)
+    if name == 'GYM_GET_INFO':
+        return world.gym_info(kwargs['gym_id'], position, now)
+    return account_response(name, now)
 
 
 # Fancy app time
@@ -113,77 +132,17 @@ def api_root():
     return 'This here be a Fake RocketMap API Endpoint Server'
 
 
-@app.route('/login/<lat>/<lng>/<r>')
-def api_login(lat, lng, r):
-    global forts
-
-    if len(forts):
-        # already generated
-        return jsonify(forts)
-
-    # coerce types
-    r = int(r)  # radius in meters
-    lat = float(lat)
-    lng = float(lng)
-
-    forts = []
-    area = 3.14 * (r * r)
-
-    # One gym every N sq.m
-    gymCount = int(math.ceil(area / 25000))
-
-    # One pks every N sq.m
-    pksCount = int(math.ceil(area / 15000))
-
-    # Gyms
-    for i in range(gymCount):
-        coords = getRandomPoint(location=(lat, lng), maxMeters=r)
-        forts.append({
-            'enabled': True,
-            'guard_pokemon_id': randint(1, 140),
-            'gym_points': randint(1, 30000),
-            'id': 'gym-{}'.format(i),
-            'is_in_battle': not getrandbits(1),
-            'last_modified_timestamp_ms': int((time() - 10) * 1000),
-            'latitude': coords[0],
-            'longitude': coords[1],
-            'owned_by_team': randint(0, 3)
-        })
-
-    # Pokestops
-    for i in range(pksCount):
-        coords = getRandomPoint(location=(lat, lng), maxMeters=r)
-        forts.append({
-            'enabled': True,
-            'id': 'pks-{}'.format(i),
-            'last_modified_timestamp_ms': int((time() - 10) * 1000),
-            'latitude': coords[0],
-            'longitude': coords[1],
-            'type': 1
-        })
-
-    log.info('Login for location %f,%f generated %d gyms, %d pokestop', lat,
-             lng, gymCount, pksCount)
-    return jsonify(forts)
-
-
-@app.route('/scan/<lat>/<lng>')
-def api_scan(lat, lng):
-    location = (float(lat), float(lng))
-    cells = []
-    # for i in range(randint(60,70)):
-    for i in range(3):
-        cells.append({
-            'current_timestamp_ms': int(time() * 1000),
-            'forts': getForts(location),
-            's2_cell_id': uuid4(),  # wrong, but also unused so it
-                                    # doesn't matter
-            'wild_pokemons': makeWildPokemon(location),
-            'catchable_pokemons': [],  # unused
-            'nearby_pokemons': []  # unused
-        })
-    return jsonify({'responses': {'GET_MAP_OBJECTS': {'map_cells': cells}}})
+@app.route('/rpc', methods=['POST'])
+def api_rpc():
+    call = request.get_json()
+    now = clock.now()
+    responses = {}
+    for name, kwargs in call['requests']:
+        responses[name] = respond(name, kwargs, call['position'], now)
+    return Response(json.dumps({'responses': responses}),
+                    mimetype='application/json')
 
 
 if __name__ == '__main__':
-    app.run(threaded=True, debug=args.debug, host=args.host, port=args.port)
+    app.run(threaded=args.processes == 1, processes=args.processes,
+            debug=args.debug, host=args.host, port=args.port)
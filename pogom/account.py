@@ -70,6 +70,14 @@ def setup_api(args, status, account):
 
 # Use API to check the login status, and retry the login if possible.
 def check_login(args, account, api, proxy_url):
+    for delay in login_steps(args, account, api, proxy_url):
+        time.sleep(delay)
+
+
+# check_login() yielding the number of seconds to sleep instead of sleeping,
+# so that a login in a coroutine of the worker engine doesn't hold a thread of
+# the engine while it waits.
+def login_steps(args, account, api, proxy_url):
     # Logged in? Enough time left? Cool!
     if api._auth_provider and api._auth_provider._access_token:
         remaining_time = api._auth_provider._access_token_expiry - time.time()
@@ -105,7 +113,7 @@ def check_login(args, account, api, proxy_url):
                 ('Failed to login to Pokemon Go with account %s. ' +
                  'Trying again in %g seconds.'),
                 account['username'], args.login_delay)
-            time.sleep(args.login_delay)
+            yield args.login_delay
 
     if num_tries > args.login_retries:
         log.error(
@@ -114,13 +122,14 @@ def check_login(args, account, api, proxy_url):
             account['username'], num_tries)
         raise TooManyLoginAttempts('Exceeded login attempts.')
 
-    time.sleep(random.uniform(2, 4))
+    yield random.uniform(2, 4)
 
     # Simulate login sequence.
-    rpc_login_sequence(args, api, account)
+    for delay in rpc_login_sequence(args, api, account):
+        yield delay
 
 
-# Simulate real app via login sequence.
+# Simulate real app via login sequence. Yields the seconds to sleep.
 def rpc_login_sequence(args, api, account):
     total_req = 0
     app_version = PGoApi.get_api_version()
@@ -133,7 +142,7 @@ def rpc_login_sequence(args, api, account):
         req.call(False)
 
         total_req += 1
-        time.sleep(random.uniform(.43, .97))
+        yield random.uniform(.43, .97)
     except Exception as e:
         log.exception('Login for account %s failed.'
                       + ' Exception in call request: %s.',
@@ -153,7 +162,7 @@ def rpc_login_sequence(args, api, account):
         parse_get_player(account, resp)
 
         total_req += 1
-        time.sleep(random.uniform(.53, 1.1))
+        yield random.uniform(.53, 1.1)
         if account['warning']:
             log.warning('Account %s has received a warning.',
                         account['username'])
@@ -180,7 +189,7 @@ def rpc_login_sequence(args, api, account):
             req, account, settings=True, buddy=False, inbox=False)
 
         total_req += 1
-        time.sleep(random.uniform(.53, 1.1))
+        yield random.uniform(.53, 1.1)
     except Exception as e:
         log.exception('Error while downloading remote config: %s.', e)
         raise LoginSequenceFail('Failed while getting remote config version in'
@@ -198,7 +207,7 @@ def rpc_login_sequence(args, api, account):
         page_offset = 0
         page_timestamp = 0
 
-        time.sleep(random.uniform(.7, 1.2))
+        yield random.uniform(.7, 1.2)
 
         while result == 2:
             req = api.create_request()
@@ -215,11 +224,11 @@ def rpc_login_sequence(args, api, account):
             total_req += 1
 
             if i > 2:
-                time.sleep(random.uniform(1.4, 1.6))
+                yield random.uniform(1.4, 1.6)
                 i = 0
             else:
                 i += 1
-                time.sleep(random.uniform(.3, .5))
+                yield random.uniform(.3, .5)
 
             try:
                 # Re-use variable name. Also helps GC.
@@ -256,11 +265,11 @@ def rpc_login_sequence(args, api, account):
             total_req += 1
 
             if i > 2:
-                time.sleep(random.uniform(1.4, 1.6))
+                yield random.uniform(1.4, 1.6)
                 i = 0
             else:
                 i += 1
-                time.sleep(random.uniform(.25, .5))
+                yield random.uniform(.25, .5)
 
             try:
                 # Re-use variable name. Also helps GC.
@@ -277,7 +286,8 @@ def rpc_login_sequence(args, api, account):
     # Check tutorial completion.
     if not all(x in account['tutorials'] for x in (0, 1, 3, 4, 7)):
         log.info('Completing tutorial steps for %s.', account['username'])
-        complete_tutorial(args, api, account)
+        for delay in complete_tutorial(args, api, account):
+            yield delay
     else:
         log.debug('Account %s already did the tutorials.', account['username'])
         # 6 - Get player profile.
@@ -287,7 +297,7 @@ def rpc_login_sequence(args, api, account):
             req.get_player_profile()
             send_generic_request(req, account, settings=True, inbox=False)
             total_req += 1
-            time.sleep(random.uniform(.2, .3))
+            yield random.uniform(.2, .3)
         except Exception as e:
             log.exception('Login for account %s failed. Exception occurred ' +
                           'while fetching player profile: %s.',
@@ -304,7 +314,7 @@ def rpc_login_sequence(args, api, account):
         req.call(False)
 
         total_req += 1
-        time.sleep(random.uniform(.6, 1.1))
+        yield random.uniform(.6, 1.1)
     except Exception as e:
         log.exception('Login for account %s failed. Exception in ' +
                       'retrieving Store Items: %s.', account['username'],
@@ -318,7 +328,7 @@ def rpc_login_sequence(args, api, account):
         send_generic_request(req, account, settings=True)
 
         total_req += 1
-        time.sleep(random.uniform(.45, .7))
+        yield random.uniform(.45, .7)
     except Exception as e:
         log.exception('Login for account %s failed. Exception while ' +
                       'fetching all news: %s.', account['username'],
@@ -334,7 +344,7 @@ def rpc_login_sequence(args, api, account):
         send_generic_request(req, account, settings=True)
 
         total_req += 1
-        time.sleep(random.uniform(.45, .7))
+        yield random.uniform(.45, .7)
     except Exception as e:
         log.exception('Login for account %s failed. Exception occurred ' +
                       'while fetching level-up rewards: %s.',
@@ -348,7 +358,7 @@ def rpc_login_sequence(args, api, account):
              account['username'],
              total_req)
 
-    time.sleep(random.uniform(3, 5))
+    yield random.uniform(3, 5)
 
     if account['buddy'] == 0 and len(account['pokemons']) > 0:
         poke_id = random.choice(account['pokemons'].keys())
@@ -357,28 +367,28 @@ def rpc_login_sequence(args, api, account):
         log.debug('Setting buddy pokemon for %s.', account['username'])
         send_generic_request(req, account)
 
-    time.sleep(random.uniform(10, 20))
+    yield random.uniform(10, 20)
 
 
-# Complete minimal tutorial steps.
+# Complete minimal tutorial steps. Yields the seconds to sleep.
 # API argument needs to be a logged in API instance.
 # TODO: Check if game client bundles these requests, or does them separately.
 def complete_tutorial(args, api, account):
     tutorial_state = account['tutorials']
     if 0 not in tutorial_state:
-        time.sleep(random.uniform(1, 5))
+        yield random.uniform(1, 5)
         req = api.create_request()
         req.mark_tutorial_complete(tutorials_completed=0)
         log.debug('Sending 0 tutorials_completed for %s.', account['username'])
         send_generic_request(req, account, buddy=False, inbox=False)
 
-        time.sleep(random.uniform(0.5, 0.6))
+        yield random.uniform(0.5, 0.6)
         req = api.create_request()
         req.get_player(player_locale=args.player_locale)
         send_generic_request(req, account, buddy=False, inbox=False)
 
     if 1 not in tutorial_state:
-        time.sleep(random.uniform(5, 12))
+        yield random.uniform(5, 12)
         req = api.create_request()
         req.set_avatar(player_avatar={
             'hair': random.randint(1, 5),
@@ -393,20 +403,20 @@ def complete_tutorial(args, api, account):
                   account['username'])
         send_generic_request(req, account, buddy=False, inbox=False)
 
-        time.sleep(random.uniform(0.3, 0.5))
+        yield random.uniform(0.3, 0.5)
         req = api.create_request()
         req.mark_tutorial_complete(tutorials_completed=1)
         log.debug('Sending 1 tutorials_completed for %s.', account['username'])
         send_generic_request(req, account, buddy=False, inbox=False)
 
-        time.sleep(random.uniform(0.5, 0.6))
+        yield random.uniform(0.5, 0.6)
         req = api.create_request()
         req.get_player_profile()
         log.debug('Fetching player profile for %s...', account['username'])
         send_generic_request(req, account, inbox=False)
 
     if 3 not in tutorial_state:
-        time.sleep(random.uniform(1, 1.5))
+        yield random.uniform(1, 1.5)
         req = api.create_request()
         req.get_download_urls(asset_id=[
             '1a3c2816-65fa-4b97-90eb-0b301c064b7a/1477084786906000',
@@ -415,38 +425,38 @@ def complete_tutorial(args, api, account):
         log.debug('Grabbing some game assets.')
         send_generic_request(req, account, inbox=False)
 
-        time.sleep(random.uniform(6, 13))
+        yield random.uniform(6, 13)
         req = api.create_request()
         starter = random.choice((1, 4, 7))
         req.encounter_tutorial_complete(pokemon_id=starter)
         log.debug('Catching the starter for %s.', account['username'])
         send_generic_request(req, account, inbox=False)
 
-        time.sleep(random.uniform(0.5, 0.6))
+        yield random.uniform(0.5, 0.6)
         req = api.create_request()
         req.get_player(player_locale=args.player_locale)
         send_generic_request(req, account, inbox=False)
 
     if 4 not in tutorial_state:
-        time.sleep(random.uniform(5, 12))
+        yield random.uniform(5, 12)
         req = api.create_request()
         req.claim_codename(codename=account['username'])
         log.debug('Claiming codename for %s.', account['username'])
         send_generic_request(req, account, inbox=False)
 
-        time.sleep(0.1)
+        yield 0.1
         req = api.create_request()
         req.get_player(player_locale=args.player_locale)
         send_generic_request(req, account, inbox=False)
 
-        time.sleep(random.uniform(1, 1.3))
+        yield random.uniform(1, 1.3)
         req = api.create_request()
         req.mark_tutorial_complete(tutorials_completed=4)
         log.debug('Sending 4 tutorials_completed for %s.', account['username'])
         send_generic_request(req, account, inbox=False)
 
     if 7 not in tutorial_state:
-        time.sleep(random.uniform(4, 10))
+        yield random.uniform(4, 10)
         req = api.create_request()
         req.mark_tutorial_complete(tutorials_completed=7)
         log.debug('Sending 7 tutorials_completed for %s.', account['username'])
@@ -455,8 +465,7 @@ def complete_tutorial(args, api, account):
     # Sleeping before we start scanning to avoid Niantic throttling.
     log.debug('And %s is done. Wait for a second, to avoid throttle.',
               account['username'])
-    time.sleep(random.uniform(2, 4))
-    return True
+    yield random.uniform(2, 4)
 
 
 def reset_account(account):
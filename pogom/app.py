@@ -20,6 +20,7 @@ from .utils import (get_args, get_pokemon_name, get_pokemon_types,
                     now, dottedQuadToNum)
 from .transform import transform_from_wgs_to_gcj
 from .blacklist import fingerprints, get_ip_blacklist
+from .workerstatus import worker_status_table, merge_status_rows
 
 log = logging.getLogger(__name__)
 compress = Compress()
@@ -430,13 +431,7 @@ class Pogom(Flask):
                 d['error'] = 'Access denied'
             elif (request.args.get('password', None) ==
                   args.status_page_password):
-                max_status_age = args.status_page_filter
-                if max_status_age > 0:
-                    d['main_workers'] = MainWorker.get_recent(max_status_age)
-                    d['workers'] = WorkerStatus.get_recent(max_status_age)
-                else:
-                    d['main_workers'] = MainWorker.get_all()
-                    d['workers'] = WorkerStatus.get_all()
+                d.update(self.get_worker_status(args.status_page_filter))
 
         return jsonify(d)
 
@@ -554,6 +549,27 @@ class Pogom(Flask):
         return render_template('status.html',
                                show=visibility_flags)
 
+    def get_worker_status(self, max_status_age):
+        if max_status_age > 0:
+            main_workers = MainWorker.get_recent(max_status_age)
+            workers = WorkerStatus.get_recent(max_status_age)
+        else:
+            main_workers = MainWorker.get_all()
+            workers = WorkerStatus.get_all()
+
+        # Rows of the scanner running in this process are newer in memory
+        # than in the database, which is only written every few seconds.
+        if worker_status_table.active:
+            main_workers = merge_status_rows(
+                main_workers,
+                worker_status_table.get_main_recent(max_status_age),
+                'worker_name')
+            workers = merge_status_rows(
+                workers, worker_status_table.get_recent(max_status_age),
+                'username')
+
+        return {'main_workers': main_workers, 'workers': workers}
+
     def post_status(self):
         args = get_args()
         d = {}
@@ -562,13 +578,7 @@ class Pogom(Flask):
 
         if request.form.get('password', None) == args.status_page_password:
             d['login'] = 'ok'
-            max_status_age = args.status_page_filter
-            if max_status_age > 0:
-                d['main_workers'] = MainWorker.get_recent(max_status_age)
-                d['workers'] = WorkerStatus.get_recent(max_status_age)
-            else:
-                d['main_workers'] = MainWorker.get_all()
-                d['workers'] = WorkerStatus.get_all()
+            d.update(self.get_worker_status(args.status_page_filter))
             d['hashkeys'] = HashKeys.get_obfuscated_keys()
         else:
             d['login'] = 'failed'
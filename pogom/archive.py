@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import logging
+import calendar
+
+from datetime import datetime, timedelta
+from threading import Lock
+from cachetools import LRUCache
+
+# NumPy is only needed for the archive, which is optional. We check later if
+# it was properly imported.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# Archived columns per table, with their NumPy type. Times are stored as
+# epoch seconds, coordinates in 1e-7 degrees and missing values as -1.
+archive_columns = {
+    'pokemon': (
+        ('encounter_id', 'u8'),
+        ('spawnpoint_id', 'u8'),
+        ('pokemon_id', 'u2'),
+        ('latitude', 'i4'),
+        ('longitude', 'i4'),
+        ('disappear_time', 'u4'),
+        ('individual_attack', 'i1'),
+        ('individual_defense', 'i1'),
+        ('individual_stamina', 'i1'),
+        ('move_1', 'i2'),
+        ('move_2', 'i2'),
+        ('cp', 'i2'),
+        ('gender', 'i1'),
+        ('form', 'i2'),
+        ('weather_boosted_condition', 'i1')
+    )
+}
+fixed_point_columns = ('latitude', 'longitude')
+coordinate_scale = 10000000
+
+
+def archive_available():
+    return np is not None
+
+
+# Cold history in one directory per table and day, with one .npy file per
+# column. Columns are memory-mapped when read, so queries only touch the
+# pages of the columns they use. A day is written to a temporary directory
+# first and renamed when complete, so readers never see half a day.
+class DailyArchive(object):
+
+    def __init__(self, path, max_open_days=64, list_interval=60):
+        self.path = path
+        # Days are written by the cleanup, which might run in another
+        # process, so check for new ones every `list_interval` seconds.
+        self.list_interval = list_interval
+        self.days_cache = {}
+        self.open_days = LRUCache(maxsize=max_open_days)
+        self.lock = Lock()
+
+    def table_path(self, table):
+        return os.path.join(self.path, table)
+
+    # Sorted list of the archived days of a table.
+    def days(self, table):
+        with self.lock:
+            listed_at, days = self.days_cache.get(table, (0, None))
+            if time.time() - listed_at > self.list_interval:
+                days = []
+                if os.path.isdir(self.table_path(table)):
+                    for name in os.listdir(self.table_path(table)):
+                        if not name.startswith('.'):
+                            days.append(datetime.strptime(
+                                name, '%Y-%m-%d').date())
+                days = sorted(days)
+                self.days_cache[table] = (time.time(), days)
+            return list(days)
+
+    def has_day(self, table, day):
+        return day in self.days(table)
+
+    # Start of the first day that isn't archived yet, or None if nothing is
+    # archived. Rows before it are read from the archive, not the database.
+    def covered_until(self, table):
+        days = self.days(table)
+        if not days:
+            return None
+        last_day = days[-1] + timedelta(days=1)
+        return datetime(last_day.year, last_day.month, last_day.day)
+
+    # Write a day of rows, given as {column: list of values}.
+    def write_day(self, table, day, rows):
+        final_path = os.path.join(self.table_path(table),
+                                  day.strftime('%Y-%m-%d'))
+        temp_path = os.path.join(self.table_path(table),
+                                 '.' + day.strftime('%Y-%m-%d'))
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+
+        for name, dtype in archive_columns[table]:
+            if name in fixed_point_columns:
+                values = [int(round(v * coordinate_scale))
+                          for v in rows[name]]
+            else:
+                values = [to_archive_value(v) for v in rows[name]]
+            values = np.array(values, dtype=dtype)
+            np.save(os.path.join(temp_path, name + '.npy'), values)
+
+        os.rename(temp_path, final_path)
+        with self.lock:
+            self.days_cache.pop(table, None)
+
+    # {column: memory-mapped array} of an archived day.
+    def load_day(self, table, day):
+        key = (table, day)
+        with self.lock:
+            columns = self.open_days.get(key, None)
+            if columns is None:
+                day_path = os.path.join(self.table_path(table),
+                                        day.strftime('%Y-%m-%d'))
+                columns = {}
+                for name, _ in archive_columns[table]:
+                    filename = os.path.join(day_path, name + '.npy')
+                    try:
+                        columns[name] = np.load(filename, mmap_mode='r')
+                    except ValueError:
+                        # Days without rows can't be memory-mapped.
+                        columns[name] = np.load(filename)
+                self.open_days[key] = columns
+            return columns
+
+    # {column: array} of the archived rows of a table where `time_column` is
+    # after `since` (all rows if None) and `match` is true for all given
+    # {column: value}.
+    def select(self, table, time_column, since, names, match=None):
+        match = match or {}
+        since_secs = to_archive_value(since) if since else None
+        parts = dict((name, []) for name in names)
+
+        for day in self.days(table):
+            if since and day < since.date():
+                continue
+
+            columns = self.load_day(table, day)
+            mask = np.ones(len(columns[time_column]), dtype=bool)
+            if since_secs is not None:
+                mask &= columns[time_column] > since_secs
+            for name, value in match.iteritems():
+                mask &= columns[name] == value
+
+            for name in names:
+                parts[name].append(columns[name][mask])
+
+        return dict((name, np.concatenate(arrays) if arrays
+                     else np.array([], dtype=column_type(table, name)))
+                    for name, arrays in parts.iteritems())
+
+    # Same as Pokemon.get_spawn_counts(): {pokemon_id: count}.
+    def spawn_counts(self, since):
+        rows = self.select('pokemon', 'disappear_time', since,
+                           ['pokemon_id'])
+        counts = np.bincount(rows['pokemon_id'])
+        return dict((int(pid), int(counts[pid]))
+                    for pid in np.flatnonzero(counts))
+
+    # Same as Pokemon.get_seen(): {pokemon_id: (count, last disappear time,
+    # latitude, longitude)} of the last sighting of each Pokemon.
+    def seen(self, since):
+        rows = self.select('pokemon', 'disappear_time', since,
+                           ['pokemon_id', 'disappear_time', 'latitude',
+                            'longitude'])
+        if not len(rows['pokemon_id']):
+            return {}
+
+        counts = np.bincount(rows['pokemon_id'])
+        # Sort by Pokemon, then time: the last row of each Pokemon is its
+        # latest sighting.
+        order = np.lexsort((rows['disappear_time'], rows['pokemon_id']))
+        pids = rows['pokemon_id'][order]
+        last = np.flatnonzero(np.append(pids[1:] != pids[:-1], True))
+
+        seen = {}
+        for i in order[last]:
+            pid = int(rows['pokemon_id'][i])
+            seen[pid] = (int(counts[pid]),
+                         from_epoch(rows['disappear_time'][i]),
+                         from_fixed(rows['latitude'][i]),
+                         from_fixed(rows['longitude'][i]))
+        return seen
+
+    # Same as Pokemon.get_appearances(): {spawnpoint_id: (count, latitude,
+    # longitude)}.
+    def appearances(self, pokemon_id, since):
+        rows = self.select('pokemon', 'disappear_time', since,
+                           ['spawnpoint_id', 'latitude', 'longitude'],
+                           match={'pokemon_id': int(pokemon_id)})
+        spawnpoints, first, counts = np.unique(
+            rows['spawnpoint_id'], return_index=True, return_counts=True)
+
+        return dict((int(sp), (int(count),
+                               from_fixed(rows['latitude'][i]),
+                               from_fixed(rows['longitude'][i])))
+                    for sp, i, count in zip(spawnpoints, first, counts))
+
+    # Same as Pokemon.get_appearances_times_by_spawnpoint(): sorted list of
+    # disappear times.
+    def appearance_times(self, pokemon_id, spawnpoint_id, since):
+        rows = self.select('pokemon', 'disappear_time', since,
+                           ['disappear_time'],
+                           match={'pokemon_id': int(pokemon_id),
+                                  'spawnpoint_id': int(spawnpoint_id)})
+        return [from_epoch(t) for t in np.sort(rows['disappear_time'])]
+
+
+def column_type(table, name):
+    return dict(archive_columns[table])[name]
+
+
+def to_archive_value(value):
+    if value is None:
+        return -1
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple())
+    return value
+
+
+def from_epoch(value):
+    return datetime.utcfromtimestamp(int(value))
+
+
+def from_fixed(value):
+    return int(value) / float(coordinate_scale)
@@ -69,8 +69,9 @@ def captcha_overseer_thread(args, account_queue, account_captchas,
             # Adjust captcha-overseer sleep timer
             sleep_timer -= 1 * solvers
 
-            # Hybrid mode
-            if args.captcha_key and args.manual_captcha_timeout > 0:
+            # Hybrid mode, or captchas of worker engine coroutines.
+            if args.captcha_key and (args.manual_captcha_timeout > 0 or
+                                     args.worker_engine == 'coroutines'):
                 tokens_remaining = tokens_needed - tokens_available
                 # Safety guard
                 tokens_remaining = min(tokens_remaining, 5)
@@ -209,7 +210,10 @@ def handle_captcha(args, status, api, account, account_failures,
                 whq.put(('captcha', wh_message))
             return False
 
-        if args.captcha_key and args.manual_captcha_timeout == 0:
+        # Coroutines of the worker engine leave solving to the captcha
+        # overseer, instead of holding an engine thread while 2captcha works.
+        if (args.captcha_key and args.manual_captcha_timeout == 0 and
+                args.worker_engine == 'threads'):
             if automatic_captcha_solve(args, status, api, captcha_url, account,
                                        whq):
                 return True
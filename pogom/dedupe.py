@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+
+from threading import Lock, Event
+from cachetools import LRUCache, TTLCache
+
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+# Answers the "did we already see this?" checks of parse_map from memory, for
+# all workers of this instance: which encounters are already stored until
+# they despawn, the last modified time of pokestops and whether gyms are in a
+# park. Lookups return what was found and which keys the caller has to fetch
+# from the database, and the caller adds what it fetched or wrote.
+class ScanDedupeCache(object):
+
+    def __init__(self, max_encounters=100000, max_forts=50000):
+        # Encounter id -> (spawnpoint id, disappear time in epoch seconds).
+        # Nothing despawns later than an hour after it was seen.
+        self.encounters = TTLCache(maxsize=max_encounters, ttl=3600)
+        # Pokestop id -> last modified time in epoch seconds.
+        self.pokestops = LRUCache(maxsize=max_forts)
+        # Gym id -> park flag.
+        self.parks = LRUCache(maxsize=max_forts)
+        self.lock = Lock()
+
+    # Returns ({encounter id: spawnpoint id} of the encounters still stored,
+    # list of encounter ids to look up).
+    def get_encounters(self, encounter_ids):
+        now = time.time()
+        found = {}
+        missing = []
+        with self.lock:
+            for encounter_id in encounter_ids:
+                entry = self.encounters.get(encounter_id, None)
+                if entry is None:
+                    missing.append(encounter_id)
+                elif entry[1] >= now:
+                    found[encounter_id] = entry[0]
+                else:
+                    # Despawned, the database doesn't have it as active
+                    # either.
+                    del self.encounters[encounter_id]
+        self.count('encounters', len(encounter_ids) - len(missing),
+                   len(missing))
+        return found, missing
+
+    # Remember encounters, given as {encounter id: (spawnpoint id, disappear
+    # time in epoch seconds)}.
+    def add_encounters(self, encounters):
+        with self.lock:
+            self.encounters.update(encounters)
+
+    def get_pokestops(self, pokestop_ids):
+        return self.get('pokestops', self.pokestops, pokestop_ids)
+
+    def add_pokestops(self, last_modified):
+        with self.lock:
+            self.pokestops.update(last_modified)
+
+    def get_parks(self, gym_ids):
+        return self.get('parks', self.parks, gym_ids)
+
+    def add_parks(self, parks):
+        with self.lock:
+            self.parks.update(parks)
+
+    # Returns ({key: value} of the cached keys, list of missing keys).
+    def get(self, name, cache, keys):
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                value = cache.get(key, None)
+                if value is None:
+                    missing.append(key)
+                else:
+                    found[key] = value
+        self.count(name, len(found), len(missing))
+        return found, missing
+
+    @staticmethod
+    def count(name, hits, misses):
+        metrics.inc('dedupe.{}.hits'.format(name), hits)
+        metrics.inc('dedupe.{}.misses'.format(name), misses)
+
+
+# Encounters in progress and their results, shared by all workers, so that a
+# Pokemon seen by several workers at once is encountered only once. The first
+# requester of an encounter id runs the encounter, later ones wait for it and
+# reuse its result, which is kept until the Pokemon despawns.
+class InFlightEncounters(object):
+
+    def __init__(self, maxsize=100000, timeout=60):
+        # Encounter id -> (encounter result, despawn time in epoch seconds).
+        self.results = TTLCache(maxsize=maxsize, ttl=3600)
+        # Encounter id -> Event set when its encounter is done.
+        self.in_flight = {}
+        self.timeout = timeout
+        self.lock = Lock()
+
+    # Returns the result of `encounter()` for the encounter id, calling it
+    # only if no other thread did or is doing so. Failed encounters (a false
+    # result) aren't kept, and can be tried again.
+    def encounter(self, encounter_id, despawn, encounter):
+        with self.lock:
+            entry = self.results.get(encounter_id, None)
+            if entry is not None and entry[1] > time.time():
+                metrics.inc('encounter.dedupe.reused')
+                return entry[0]
+
+            event = self.in_flight.get(encounter_id, None)
+            if event is None:
+                event = self.in_flight[encounter_id] = Event()
+                waiting = False
+            else:
+                waiting = True
+
+        if waiting:
+            metrics.inc('encounter.dedupe.waited')
+            event.wait(self.timeout)
+            with self.lock:
+                entry = self.results.get(encounter_id, None)
+            return entry[0] if entry is not None else False
+
+        metrics.inc('encounter.dedupe.started')
+        result = False
+        try:
+            result = encounter()
+        finally:
+            with self.lock:
+                if result:
+                    self.results[encounter_id] = (result, despawn)
+                del self.in_flight[encounter_id]
+            event.set()
+        return result
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import threading
+
+from itertools import count
+from threading import Thread, Condition
+from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+# Runs search workers as coroutines instead of one thread per account. A
+# coroutine is a generator yielding the seconds it wants to sleep. The engine
+# keeps the sleeping coroutines in a heap of wake up times, and when one is
+# due a thread of the pool runs it until its next yield. Blocking calls made
+# by a coroutine (API requests, database reads) only hold a pool thread while
+# they run, so thousands of accounts need as many threads as there are
+# requests in flight, not one per account. Anything that sleeps, like the
+# login sequence, has to yield its sleeps too, or it holds the thread.
+class CoroutineEngine(object):
+
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        # Heap of (wake up time, sequence, coroutine, name).
+        self.sleeping = []
+        self.sequence = count()
+        self.condition = Condition()
+        self.coroutines = 0
+
+        t = Thread(target=self.run, name='worker-engine')
+        t.daemon = True
+        t.start()
+
+    def spawn(self, coroutine, name):
+        with self.condition:
+            self.coroutines += 1
+        self.schedule(coroutine, name, 0)
+
+    def schedule(self, coroutine, name, delay):
+        with self.condition:
+            heapq.heappush(self.sleeping, (default_timer() + max(delay, 0),
+                                           next(self.sequence), coroutine,
+                                           name))
+            self.condition.notify()
+
+    # The event loop: wait for the next coroutine to wake up and hand it to
+    # the pool.
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    timeout = None
+                    if self.sleeping:
+                        timeout = self.sleeping[0][0] - default_timer()
+                        if timeout <= 0:
+                            break
+                    self.condition.wait(timeout)
+                due, _, coroutine, name = heapq.heappop(self.sleeping)
+                sleeping = len(self.sleeping)
+
+            metrics.observe('engine.lag', default_timer() - due)
+            metrics.set('engine.sleeping', sleeping)
+            metrics.set('engine.running', self.coroutines - sleeping)
+            self.executor.submit(self.step, coroutine, name)
+
+    # Run a coroutine until it yields, in a thread of the pool.
+    def step(self, coroutine, name):
+        # Log lines of the coroutine show its name, as for worker threads.
+        thread = threading.current_thread()
+        pool_name = thread.name
+        thread.name = name
+        try:
+            delay = next(coroutine)
+        except StopIteration:
+            delay = None
+        except Exception as e:
+            log.exception('Coroutine %s stopped: %s', name, repr(e))
+            delay = None
+        finally:
+            thread.name = pool_name
+
+        if delay is None:
+            with self.condition:
+                self.coroutines -= 1
+        else:
+            self.schedule(coroutine, name, delay)
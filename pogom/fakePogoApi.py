@@ -2,44 +2,97 @@
 # -*- coding: utf-8 -*-
 
 import requests
-import struct
+import importlib
 from time import time
-from .utils import get_args
 
+from google.protobuf import json_format
+from pogoprotos.networking.envelopes.response_envelope_pb2 import (
+    ResponseEnvelope)
 
+
+# Proto class of the response to a request, e.g. GetMapObjectsResponse for
+# GET_MAP_OBJECTS.
+def response_class(name):
+    module = name.lower() + '_response'
+    return getattr(
+        importlib.import_module(
+            'pogoprotos.networking.responses.{}_pb2'.format(module)),
+        ''.join(word.capitalize() for word in module.split('_')))
+
+
+class FakeAuthProvider:
+
+    def __init__(self):
+        self._access_token = None
+        self._access_token_expiry = 0
+        self._ticket_expire = 0
+
+    def set_proxy(self, proxy_config):
+        pass
+
+
+# Stands in for PGoApi with a simulator (contrib/fake-pgo-api.py). Requests
+# are sent to it as JSON and its answers turned into the same protos as the
+# real API returns.
 class FakePogoApi:
 
     def __init__(self, mock):
-        # Fake a 24 hour auth token.
-        self._auth_provider = type('', (object,), {
-            "_ticket_expire": (time() + (3600 * 24)) * 1000})()
-        self.inited = False
+        self._auth_provider = FakeAuthProvider()
+        self.device_info = {'device_model_boot': 'simulator'}
         self.mock = mock
+        self.position = (0, 0, 0)
+        self.session = requests.Session()
 
     def set_proxy(self, proxy_config):
         pass
 
-    def activate_signature(self, library):
+    def activate_hash_server(self, hash_token):
         pass
 
+    def get_hash_server_token(self):
+        return None
+
     def set_position(self, lat, lng, alt):
-        # Meters radius (very, very rough approximation -- deal with it.)
-        if not self.inited:
-            args = get_args()
-            radius = 140 * args.step_limit
-            requests.get('{}/login/{}/{}/{}'.format(
-                self.mock, lat, lng, radius))
-            self.inited = True
+        self.position = (lat, lng, alt)
 
     def set_authentication(self, provider=None, oauth2_refresh_token=None,
-                           username=None, password=None):
-        pass
+                           username=None, password=None, proxy_config=None):
+        # Fake a 24 hour auth token.
+        expiry = time() + 3600 * 24
+        self._auth_provider._access_token = 'simulated'
+        self._auth_provider._access_token_expiry = expiry
+        self._auth_provider._ticket_expire = expiry * 1000
+
+    def create_request(self):
+        return FakePogoRequest(self)
+
+
+class FakePogoRequest:
+
+    def __init__(self, api):
+        self.__parent__ = api
+        self.requests = []
+
+    # req.get_map_objects(...) etc. queue the request, as with pgoapi.
+    def __getattr__(self, name):
+        def add(**kwargs):
+            self.requests.append((name.upper(), kwargs))
+            return self
+        return add
 
-    def i2f(self, i):
-        return struct.unpack('<d', struct.pack('<Q', i))[0]
+    def call(self, *args, **kwargs):
+        api = self.__parent__
+        response = api.session.post(api.mock + '/rpc', json={
+            'position': api.position,
+            'requests': self.requests
+        })
+        response.raise_for_status()
 
-    def get_map_objects(self, latitude=None, longitude=None,
-                        since_timestamp_ms=None, cell_id=None):
-        location = (self.i2f(latitude), self.i2f(longitude))
-        response = requests.get('{}/scan/{}/{}'.format(self.mock, *location))
-        return response.json()
+        responses = {}
+        for name, data in response.json()['responses'].iteritems():
+            responses[name] = json_format.ParseDict(
+                data, response_class(name)())
+        return {
+            'envelope': ResponseEnvelope(status_code=1),
+            'responses': responses
+        }
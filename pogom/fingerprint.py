@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from threading import Lock
+from cachetools import TTLCache
+
+from .metrics import metrics, ratio
+
+log = logging.getLogger(__name__)
+
+
+# Remembers a compact hash of the last row written per primary key, so
+# upserts of rows that didn't change can be dropped before they reach the
+# database. Timestamp fields are left out of the hash: rows where only those
+# changed are returned separately, to be written with a cheap UPDATE.
+class FingerprintCache(object):
+
+    def __init__(self, maxsize=50000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Model name -> tuple of timestamp field names.
+        self.timestamp_fields = {}
+        # Model name -> TTLCache of primary key -> fingerprint.
+        self.caches = {}
+        self.lock = Lock()
+
+    # Enable fingerprinting for a model. The TTL makes sure that every row is
+    # fully rewritten once in a while, e.g. after a manual database change.
+    def register(self, cls, timestamp_fields=()):
+        name = cls.__name__
+        self.timestamp_fields[name] = tuple(timestamp_fields)
+        self.caches[name] = TTLCache(maxsize=self.maxsize, ttl=self.ttl)
+
+    def is_registered(self, cls):
+        return self.maxsize > 0 and cls.__name__ in self.caches
+
+    # Split the rows of an upsert batch. Returns a tuple of:
+    #   - the rows that have to be upserted,
+    #   - {primary key: {timestamp field: value}} for rows where only the
+    #     timestamps changed,
+    #   - {primary key: fingerprint} of the rows to upsert, to commit once
+    #     they're written.
+    def split(self, cls, data):
+        name = cls.__name__
+        timestamp_fields = self.timestamp_fields[name]
+        # Timestamps missing from a row get their default, which is the same
+        # for the whole batch.
+        defaults = {}
+        for f, default in cls._meta.defaults.items():
+            if f.name in timestamp_fields:
+                defaults[f.name] = default() if callable(default) else default
+
+        changed = {}
+        touched = {}
+        fingerprints = {}
+        with self.lock:
+            cache = self.caches[name]
+            for key, row in data.iteritems():
+                pk = self.primary_key(cls, row)
+                fingerprint = self.fingerprint(row, timestamp_fields)
+
+                if cache.get(pk, None) != fingerprint:
+                    changed[key] = row
+                    fingerprints[pk] = fingerprint
+                elif timestamp_fields:
+                    touched[pk] = dict((f, row.get(f, defaults.get(f)))
+                                       for f in timestamp_fields)
+
+        rows = len(data)
+        skipped = rows - len(changed) - len(touched)
+        metrics.inc('upsert.{}.rows'.format(name), rows)
+        metrics.inc('upsert.{}.skipped'.format(name), skipped)
+        metrics.inc('upsert.{}.touched'.format(name), len(touched))
+        metrics.set('upsert.{}.skip_ratio'.format(name), ratio(
+            metrics.get('upsert.{}.skipped'.format(name)),
+            metrics.get('upsert.{}.rows'.format(name))))
+        metrics.set('upsert.{}.touch_ratio'.format(name), ratio(
+            metrics.get('upsert.{}.touched'.format(name)),
+            metrics.get('upsert.{}.rows'.format(name))))
+
+        return changed, touched, fingerprints
+
+    # Remember the fingerprints of rows that were written successfully.
+    def commit(self, cls, fingerprints):
+        with self.lock:
+            self.caches[cls.__name__].update(fingerprints)
+
+    # Forget rows, e.g. after a failed write, so they're fully rewritten.
+    def forget(self, cls, keys):
+        with self.lock:
+            cache = self.caches[cls.__name__]
+            for key in keys:
+                cache.pop(key, None)
+
+    @staticmethod
+    def primary_key(cls, row):
+        pk = cls._meta.primary_key
+        if hasattr(pk, 'field_names'):
+            return tuple(row[f] for f in pk.field_names)
+        return row[pk.name]
+
+    @staticmethod
+    def fingerprint(row, timestamp_fields):
+        return hash(tuple((k, row[k]) for k in sorted(row)
+                          if k not in timestamp_fields))
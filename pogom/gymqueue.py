@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime, timedelta
+from threading import Lock
+from cachetools import LRUCache
+
+from .metrics import metrics
+from .utils import distance
+
+log = logging.getLogger(__name__)
+
+
+# Gyms waiting for their details to be fetched, shared by all workers. Parsed
+# gyms that changed since their details were last fetched are queued, and
+# workers with time to spare take the most stale gym near them. Staleness is
+# how much later the gym was modified than its details were fetched, gyms
+# without details first.
+#
+# The time details were last fetched is kept in memory; the database is only
+# asked once for gyms this instance hasn't seen yet.
+class GymDetailQueue(object):
+
+    def __init__(self, load_last_scanned, max_gyms=50000,
+                 max_age=timedelta(minutes=30)):
+        # Function returning {gym id: last scanned datetime} of the gym ids
+        # given that have details in the database.
+        self.load_last_scanned = load_last_scanned
+        # Gym id -> datetime its details were last fetched, None if never.
+        self.last_scanned = LRUCache(maxsize=max_gyms)
+        # Gym id -> (queued datetime, gym dict).
+        self.pending = {}
+        # Gym ids a worker is getting the details of.
+        self.in_progress = set()
+        # Queued gyms no worker came close to are dropped after max_age.
+        self.max_age = max_age
+        self.lock = Lock()
+
+    # Queue the gyms of a parse ({gym id: gym dict}) whose details are out of
+    # date.
+    def add(self, gyms):
+        with self.lock:
+            missing = [gym_id for gym_id in gyms
+                       if gym_id not in self.last_scanned]
+        if missing:
+            loaded = self.load_last_scanned(missing)
+            with self.lock:
+                for gym_id in missing:
+                    self.last_scanned[gym_id] = loaded.get(gym_id, None)
+
+        now = datetime.utcnow()
+        queued = 0
+        with self.lock:
+            for gym_id, gym in gyms.iteritems():
+                last_scanned = self.last_scanned.get(gym_id, None)
+                if last_scanned and last_scanned >= gym['last_modified']:
+                    continue
+                if gym_id in self.in_progress:
+                    continue
+                if gym_id not in self.pending:
+                    queued += 1
+                self.pending[gym_id] = (now, gym)
+            pending = len(self.pending)
+
+        metrics.inc('gyms.queued', queued)
+        metrics.inc('gyms.fresh', len(gyms) - queued)
+        metrics.set('gyms.pending', pending)
+
+    # Take the most stale queued gym within `max_distance` meters of
+    # `position`, or None. It has to be given back with done().
+    def take(self, position, max_distance=1000):
+        now = datetime.utcnow()
+        best = None
+        with self.lock:
+            for gym_id, (queued, gym) in self.pending.items():
+                if now - queued > self.max_age:
+                    del self.pending[gym_id]
+                    metrics.inc('gyms.expired')
+                    continue
+                if distance(position, (gym['latitude'],
+                                       gym['longitude'])) >= max_distance:
+                    continue
+                staleness = self.staleness(gym)
+                if best is None or staleness > best[0]:
+                    best = (staleness, queued, gym)
+
+            if best is None:
+                return None
+            gym = best[2]
+            del self.pending[gym['gym_id']]
+            self.in_progress.add(gym['gym_id'])
+
+        metrics.observe('gyms.wait', (now - best[1]).total_seconds())
+        return gym
+
+    # A gym taken is done, `scanned` telling whether its details were
+    # fetched.
+    def done(self, gym, scanned):
+        with self.lock:
+            self.in_progress.discard(gym['gym_id'])
+            if scanned:
+                self.last_scanned[gym['gym_id']] = datetime.utcnow()
+
+    # Seconds the gym was modified after its details were fetched, infinite
+    # for gyms without details. Called with the lock held.
+    def staleness(self, gym):
+        last_scanned = self.last_scanned.get(gym['gym_id'], None)
+        if last_scanned is None:
+            return float('inf')
+        return (gym['last_modified'] - last_scanned).total_seconds()
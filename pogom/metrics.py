@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from threading import Lock
+
+from .utils import periodic_loop
+
+log = logging.getLogger(__name__)
+
+
+# Thread-safe, in-process counters, gauges and timers. Values are only kept
+# in memory and are reported through the logs.
+class Metrics(object):
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.lock = Lock()
+
+    # Increment a counter.
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Set a gauge to its current value.
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # Record a duration in seconds.
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name, None)
+            if timer is None:
+                self.timers[name] = {'count': 1, 'total': seconds,
+                                     'max': seconds}
+            else:
+                timer['count'] += 1
+                timer['total'] += seconds
+                timer['max'] = max(timer['max'], seconds)
+
+    # Return a counter or gauge value.
+    def get(self, name, default=0):
+        with self.lock:
+            return self.counters.get(name, self.gauges.get(name, default))
+
+    def snapshot(self):
+        with self.lock:
+            timers = {}
+            for name, timer in self.timers.iteritems():
+                timers[name] = {
+                    'count': timer['count'],
+                    'avg': round(timer['total'] / timer['count'], 6),
+                    'max': round(timer['max'], 6)
+                }
+
+            return {'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'timers': timers}
+
+
+# Return part / total, or 0 if there is no total.
+def ratio(part, total):
+    return round(float(part) / total, 4) if total else 0.0
+
+
+# Log all metrics to any logger.
+def log_metrics(log_method):
+    snapshot = metrics.snapshot()
+    for kind in ('counters', 'gauges', 'timers'):
+        if snapshot[kind]:
+            log_method('Metrics %s: %s.', kind, snapshot[kind])
+
+
+# Periodically log metrics every 'loop_delay_ms' ms.
+def log_metrics_loop(loop_delay_ms=60000):
+    def log_metrics_to_debug():
+        log_metrics(log.debug)
+
+    periodic_loop(log_metrics_to_debug, loop_delay_ms)
+
+
+# Shared by all threads of this process.
+metrics = Metrics()
@@ -8,45 +8,101 @@ import sys
 import gc
 import time
 import math
+import os
+import json
+import operator
+import random
+from StringIO import StringIO
 
 from peewee import (InsertQuery, Check, CompositeKey, ForeignKeyField,
                     SmallIntegerField, IntegerField, CharField, DoubleField,
                     BooleanField, DateTimeField, fn, DeleteQuery, FloatField,
                     TextField, BigIntegerField, PrimaryKeyField,
-                    JOIN, OperationalError)
+                    FixedCharField, JOIN, SQL, OperationalError,
+                    PostgresqlDatabase, BlobField)
 from playhouse.flask_utils import FlaskDB
-from playhouse.pool import PooledMySQLDatabase
+from playhouse.pool import PooledMySQLDatabase, PooledPostgresqlDatabase
 from playhouse.shortcuts import RetryOperationalError, case
-from playhouse.migrate import migrate, MySQLMigrator
+from playhouse.migrate import migrate, MySQLMigrator, PostgresqlMigrator
 from datetime import datetime, timedelta
-from cachetools import TTLCache
+from cachetools import TTLCache, LRUCache
 from cachetools import cached
+from threading import Lock, local
 from timeit import default_timer
+from functools import wraps
 
 from .utils import (get_pokemon_name, get_pokemon_types,
-                    get_args, cellid, in_radius, date_secs, clock_between,
+                    get_args, cellid, s2_cell_id, s2_cell_id_ranges,
+                    in_radius, date_secs, clock_between,
                     get_move_name, get_move_damage, get_move_energy,
-                    get_move_type, calc_pokemon_level, peewee_attr_to_col)
+                    get_move_type, peewee_attr_to_col)
 from .transform import transform_from_wgs_to_gcj, get_new_coords
 from .customLog import printPokemon
 
 from .account import check_login, setup_api, pokestop_spinnable, spin_pokestop
 from .proxy import get_new_proxy
 from .apiRequests import encounter
+from .fingerprint import FingerprintCache
+from .archive import DailyArchive, archive_columns
+from .registry import SpawnRegistry
+from .sightings import SightingSummary
+from .dedupe import ScanDedupeCache, InFlightEncounters
+from .records import PokemonRecord, PokestopRecord, GymRecord, RaidRecord
+from .metrics import metrics
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
-
-db_schema_version = 30
+fingerprints = FingerprintCache(maxsize=args.db_fingerprint_cache)
+dead_letter_lock = Lock()
+# Daily files of the rows removed by the database cleanup.
+archive = (DailyArchive(args.db_cleanup_archive)
+           if args.db_cleanup_archive else None)
+# Scanned locations and spawnpoints of the hives scanned by this instance.
+registry = SpawnRegistry()
+# Spawnpoint id -> SightingSummary of its sightings.
+sighting_summaries = LRUCache(maxsize=50000)
+sighting_summaries_lock = Lock()
+# Encounters and forts already seen by any worker.
+scan_cache = ScanDedupeCache()
+# Encounters in progress or done by any worker.
+in_flight_encounters = InFlightEncounters()
+
+# Read replicas from --db-replica-host, and those of them that are currently
+# within --db-replica-max-lag of the primary.
+read_replicas = {}
+fresh_replicas = []
+# The replica used by the replica_read() method running in this thread.
+replica_context = local()
+
+# MySQL error codes worth retrying: too many connections, lock wait timeout,
+# deadlock, can't connect, server has gone away and lost connection.
+transient_db_errors = (1040, 1205, 1213, 2003, 2006, 2013)
+# PostgreSQL SQLSTATEs worth retrying, besides connection exceptions (class
+# 08): serialization failure, deadlock, too many connections, lock not
+# available and the server shutting down.
+transient_pg_errors = ('40001', '40P01', '53300', '55P03', '57P01', '57P02',
+                       '57P03')
+db_retry_max_secs = 60
+db_retry_max_attempts = 10
+
+db_schema_version = 32
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
 
 
+class MyRetryPgDB(RetryOperationalError, PooledPostgresqlDatabase):
+    # PostgreSQL has no unsigned integers.
+    field_overrides = dict(PooledPostgresqlDatabase.field_overrides, **{
+        'bigint unsigned': 'NUMERIC(20)',
+        'int unsigned': 'BIGINT'
+    })
+
+
 # Reduction of CharField to fit max length inside 767 bytes for utf8mb4 charset
 class Utf8mb4CharField(CharField):
     def __init__(self, max_length=191, *args, **kwargs):
@@ -58,33 +114,204 @@ class UBigIntegerField(BigIntegerField):
     db_field = 'bigint unsigned'
 
 
+# Fixed-point coordinate in 1e-7 degrees (about 1 cm), 4 bytes instead of 8.
+class E7CoordinateField(IntegerField):
+    db_field = 'int'
+    scale = 10000000
+
+    def db_value(self, value):
+        return None if value is None else int(round(value * self.scale))
+
+    def python_value(self, value):
+        return None if value is None else value / float(self.scale)
+
+
+# UTC datetime stored as Unix epoch seconds, 4 bytes instead of 5 to 8.
+class EpochDateTimeField(IntegerField):
+    db_field = 'int unsigned'
+
+    def db_value(self, value):
+        if value is None or isinstance(value, (int, long)):
+            return value
+        return calendar.timegm(value.timetuple())
+
+    def python_value(self, value):
+        return None if value is None else datetime.utcfromtimestamp(value)
+
+
+# Single byte per character, for short codes like SpawnPoint.kind.
+class AsciiCharField(FixedCharField):
+
+    def __ddl_column__(self, column_type):
+        return SQL('CHAR({}) CHARACTER SET ascii'.format(self.max_length))
+
+
+# BlobField asks the database for its binary type when the model is defined,
+# which fails while the database proxy isn't initialized yet. Ask when
+# writing instead.
+class BinaryField(BlobField):
+
+    def add_to_class(self, model_class, name):
+        return super(BlobField, self).add_to_class(model_class, name)
+
+    def db_value(self, value):
+        self._constructor = self.model_class._meta.database.get_binary_type()
+        return super(BinaryField, self).db_value(value)
+
+
+# With --db-compact the hottest tables use the narrow types above.
+if args.db_compact:
+    CoordinateField = E7CoordinateField
+    TimestampField = EpochDateTimeField
+    CodeField = AsciiCharField
+else:
+    CoordinateField = DoubleField
+    TimestampField = DateTimeField
+    CodeField = Utf8mb4CharField
+
+
 def init_database(app):
-    log.info('Connecting to MySQL database on %s:%i...',
-             args.db_host, args.db_port)
-    db = MyRetryDB(
-        args.db_name,
-        user=args.db_user,
-        password=args.db_pass,
-        host=args.db_host,
-        port=args.db_port,
-        stale_timeout=30,
-        max_connections=None,
-        charset='utf8mb4')
+    if args.db_type == 'postgres':
+        log.info('Connecting to PostgreSQL database on %s:%i...',
+                 args.db_host, args.db_port)
+        db = MyRetryPgDB(
+            args.db_name,
+            user=args.db_user,
+            password=args.db_pass,
+            host=args.db_host,
+            port=args.db_port,
+            stale_timeout=30,
+            max_connections=None)
+    else:
+        log.info('Connecting to MySQL database on %s:%i...',
+                 args.db_host, args.db_port)
+        db = MyRetryDB(
+            args.db_name,
+            user=args.db_user,
+            password=args.db_pass,
+            host=args.db_host,
+            port=args.db_port,
+            stale_timeout=30,
+            max_connections=None,
+            charset='utf8mb4')
 
     # Using internal method as the other way would be using internal var, we
     # could use initializer but db is initialized later
     flaskDb._load_database(app, db)
     if app is not None:
         flaskDb._register_handlers(app)
+
+    for host in args.db_replica_host or []:
+        host, _, port = host.partition(':')
+        port = int(port) if port else args.db_port
+        log.info('Using MySQL read replica on %s:%i.', host, port)
+        read_replicas['{}:{}'.format(host, port)] = MyRetryDB(
+            args.db_name,
+            user=args.db_user,
+            password=args.db_pass,
+            host=host,
+            port=port,
+            stale_timeout=30,
+            max_connections=None,
+            charset='utf8mb4')
+
     return db
 
 
+def is_postgres(db):
+    return isinstance(db, PostgresqlDatabase)
+
+
+# Run the decorated read-only method on a read replica, if one is fresh
+# enough. All other queries, including reads that have to see our own writes
+# (e.g. ScannedLocation.get_by_loc), stay on the primary.
+def replica_read(f):
+    @wraps(f)
+    def wrapper(*f_args, **f_kwargs):
+        replicas = fresh_replicas
+        if not replicas or getattr(replica_context, 'db', None) is not None:
+            return f(*f_args, **f_kwargs)
+
+        replica = random.choice(replicas)
+        replica_context.db = replica
+        try:
+            return f(*f_args, **f_kwargs)
+        finally:
+            replica_context.db = None
+            # Hand the connection back to the pool right away, web requests
+            # run in short-lived threads.
+            if not replica.is_closed():
+                replica.close()
+
+    return wrapper
+
+
+# Check replication lag of the read replicas, and only keep using those
+# within --db-replica-max-lag seconds of the primary. Also reports the usage
+# of all connection pools.
+def db_replica_monitor_loop(primary):
+    global fresh_replicas
+
+    while True:
+        fresh = []
+        for name, replica in sorted(read_replicas.items()):
+            lag = get_replication_lag(replica)
+            metrics.set('db.replica.{}.lag'.format(name),
+                        -1 if lag is None else lag)
+            if lag is not None and lag <= args.db_replica_max_lag:
+                fresh.append(replica)
+            elif replica in fresh_replicas:
+                log.warning('Read replica %s is %s, reading from the '
+                            'primary instead.', name,
+                            'unavailable' if lag is None else
+                            '{}s behind'.format(lag))
+
+        fresh_replicas = fresh
+        metrics.set('db.replica.fresh', len(fresh))
+
+        for name, db in [('primary', primary)] + read_replicas.items():
+            metrics.set('db.pool.{}.in_use'.format(name), len(db._in_use))
+            metrics.set('db.pool.{}.idle'.format(name), len(db._connections))
+
+        time.sleep(5)
+
+
+# Seconds a replica is behind its primary, or None if replication isn't
+# running or the replica can't be reached.
+def get_replication_lag(replica):
+    try:
+        with replica.execution_context():
+            cursor = replica.execute_sql('SHOW SLAVE STATUS;')
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            columns = [c[0] for c in cursor.description]
+            return dict(zip(columns, row))['Seconds_Behind_Master']
+    except Exception as e:
+        log.debug('Failed to get replication lag: %s.', repr(e))
+        return None
+
+
 class BaseModel(flaskDb.Model):
 
     @classmethod
     def database(cls):
+        replica = getattr(replica_context, 'db', None)
+        if replica is not None:
+            return replica
         return cls._meta.database
 
+    @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        replica = getattr(replica_context, 'db', None)
+        if replica is not None:
+            query.database = replica
+            metrics.inc('db.reads.replica')
+        else:
+            metrics.inc('db.reads.primary')
+        return query
+
     @classmethod
     def get_all(cls):
         return [m for m in cls.select().dicts()]
@@ -102,6 +329,21 @@ class LatLongModel(BaseModel):
                         result['latitude'], result['longitude'])
         return results
 
+    # Viewport condition for models with an `s2_cell_id` column. The S2
+    # covering of the box turns into a few ranges MySQL can scan on the
+    # s2_cell_id index, the coordinates trim it to the exact box.
+    @classmethod
+    def in_bounds(cls, swLat, swLng, neLat, neLng):
+        cells = reduce(operator.or_, [
+            cls.s2_cell_id.between(min_id, max_id)
+            for min_id, max_id in s2_cell_id_ranges(swLat, swLng, neLat,
+                                                    neLng)])
+        return (cells &
+                (cls.latitude >= swLat) &
+                (cls.longitude >= swLng) &
+                (cls.latitude <= neLat) &
+                (cls.longitude <= neLng))
+
 
 class Pokemon(LatLongModel):
     # We are base64 encoding the ids delivered by the api
@@ -109,9 +351,10 @@ class Pokemon(LatLongModel):
     encounter_id = UBigIntegerField(primary_key=True)
     spawnpoint_id = UBigIntegerField(index=True)
     pokemon_id = SmallIntegerField(index=True)
-    latitude = DoubleField()
-    longitude = DoubleField()
-    disappear_time = DateTimeField()
+    latitude = CoordinateField()
+    longitude = CoordinateField()
+    s2_cell_id = UBigIntegerField(null=True, index=True)
+    disappear_time = TimestampField()
     individual_attack = SmallIntegerField(null=True)
     individual_defense = SmallIntegerField(null=True)
     individual_stamina = SmallIntegerField(null=True)
@@ -125,7 +368,7 @@ class Pokemon(LatLongModel):
     costume = SmallIntegerField(null=True)
     form = SmallIntegerField(null=True)
     weather_boosted_condition = SmallIntegerField(null=True)
-    last_modified = DateTimeField(
+    last_modified = TimestampField(
         null=True, index=True, default=datetime.utcnow)
 
     class Meta:
@@ -135,6 +378,7 @@ class Pokemon(LatLongModel):
         )
 
     @staticmethod
+    @replica_read
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                    oSwLng=None, oNeLat=None, oNeLng=None, exclude=None):
         now_date = datetime.utcnow()
@@ -153,20 +397,14 @@ class Pokemon(LatLongModel):
                      .where(((Pokemon.last_modified >
                               datetime.utcfromtimestamp(timestamp / 1000)) &
                              (Pokemon.disappear_time > now_date)) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
+                            (Pokemon.in_bounds(swLat, swLng, neLat, neLng)))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send Pokemon in view but exclude those within old boundaries.
             # Only send newly uncovered Pokemon.
             query = (query
                      .where(((Pokemon.disappear_time > now_date) &
-                             (((Pokemon.latitude >= swLat) &
-                               (Pokemon.longitude >= swLng) &
-                               (Pokemon.latitude <= neLat) &
-                               (Pokemon.longitude <= neLng))) &
+                             Pokemon.in_bounds(swLat, swLng, neLat, neLng) &
                              ~((Pokemon.disappear_time > now_date) &
                                (Pokemon.latitude >= oSwLat) &
                                (Pokemon.longitude >= oSwLng) &
@@ -178,14 +416,12 @@ class Pokemon(LatLongModel):
                      # Add 1 hour buffer to include spawnpoints that persist
                      # after tth, like shsh.
                      .where((Pokemon.disappear_time > now_date) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))))
+                            ((Pokemon.in_bounds(swLat, swLng, neLat, neLng))))
                      .dicts())
         return list(query)
 
     @staticmethod
+    @replica_read
     def get_active_by_id(ids, swLat, swLng, neLat, neLng):
         if not (swLat and swLng and neLat and neLng):
             query = (Pokemon
@@ -198,10 +434,7 @@ class Pokemon(LatLongModel):
                      .select()
                      .where((Pokemon.pokemon_id << ids) &
                             (Pokemon.disappear_time > datetime.utcnow()) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
+                            Pokemon.in_bounds(swLat, swLng, neLat, neLng))
                      .dicts())
 
         return list(query)
@@ -211,6 +444,7 @@ class Pokemon(LatLongModel):
     # Returns a dict:
     #   { 'pokemon': [ {'pokemon_id': '', 'count': 1} ], 'total': 1 }.
     @staticmethod
+    @replica_read
     def get_spawn_counts(hours):
         query = (Pokemon
                  .select(Pokemon.pokemon_id,
@@ -222,8 +456,21 @@ class Pokemon(LatLongModel):
             # Not using WHERE speeds up the query.
             query = query.where(Pokemon.disappear_time > hours)
 
+        # Older rows are counted from the archive.
+        archived_until = pokemon_archived_until()
+        if archived_until:
+            query = query.where(Pokemon.disappear_time >= archived_until)
+
         query = query.group_by(Pokemon.pokemon_id).dicts()
 
+        if archived_until and (not hours or hours < archived_until):
+            counts = archive.spawn_counts(hours or None)
+            for row in query:
+                counts[row['pokemon_id']] = (counts.get(row['pokemon_id'], 0) +
+                                             row['count'])
+            query = [{'pokemon_id': pokemon_id, 'count': count}
+                     for pokemon_id, count in counts.iteritems()]
+
         # We need a total count. Use reduce() instead of sum() for O(n)
         # instead of O(2n) caused by list comprehension.
         total = reduce(lambda x, y: x + y['count'], query, 0)
@@ -232,6 +479,7 @@ class Pokemon(LatLongModel):
 
     @staticmethod
     @cached(cache)
+    @replica_read
     def get_seen(timediff):
         if timediff:
             timediff = datetime.utcnow() - timedelta(hours=timediff)
@@ -239,6 +487,12 @@ class Pokemon(LatLongModel):
         # Note: pokemon_id+0 forces SQL to ignore the pokemon_id index
         # and should use the disappear_time index and hopefully
         # improve performance
+        # Older rows are read from the archive.
+        archived_until = pokemon_archived_until()
+        archived = {}
+        if archived_until and (not timediff or timediff < archived_until):
+            archived = archive.seen(timediff or None)
+
         pokemon_count_query = (Pokemon
                                .select((Pokemon.pokemon_id+0).alias(
                                            'pokemon_id'),
@@ -251,6 +505,9 @@ class Pokemon(LatLongModel):
                                .group_by((Pokemon.pokemon_id+0))
                                .alias('counttable')
                                )
+        if archived_until:
+            pokemon_count_query = pokemon_count_query.where(
+                Pokemon.disappear_time >= archived_until)
         query = (Pokemon
                  .select(Pokemon.pokemon_id,
                          Pokemon.disappear_time,
@@ -274,15 +531,33 @@ class Pokemon(LatLongModel):
         total = 0
         for p in query:
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+            if p['pokemon_id'] in archived:
+                p['count'] += archived[p['pokemon_id']][0]
             pokemon.append(p)
             total += p['count']
 
+        # Pokemon that were only seen in archived days.
+        seen_ids = set(p['pokemon_id'] for p in pokemon)
+        for pokemon_id, (count, disappear_time, latitude,
+                         longitude) in archived.iteritems():
+            if pokemon_id not in seen_ids:
+                pokemon.append({
+                    'pokemon_id': pokemon_id,
+                    'pokemon_name': get_pokemon_name(pokemon_id),
+                    'disappear_time': disappear_time,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'count': count
+                })
+                total += count
+
         # Re-enable the GC.
         gc.enable()
 
         return {'pokemon': pokemon, 'total': total}
 
     @staticmethod
+    @replica_read
     def get_appearances(pokemon_id, timediff):
         '''
         :param pokemon_id: id of Pokemon that we need appearances for
@@ -304,9 +579,33 @@ class Pokemon(LatLongModel):
                  .dicts()
                  )
 
-        return list(query)
+        # Older rows are counted from the archive.
+        archived_until = pokemon_archived_until()
+        if not archived_until:
+            return list(query)
+
+        appearances = list(query.where(
+            Pokemon.disappear_time >= archived_until))
+        if not timediff or timediff < archived_until:
+            archived = archive.appearances(pokemon_id, timediff or None)
+            for appearance in appearances:
+                count, _, _ = archived.pop(appearance['spawnpoint_id'],
+                                           (0, None, None))
+                appearance['count'] += count
+            for spawnpoint_id, (count, latitude,
+                                longitude) in archived.iteritems():
+                appearances.append({
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'pokemon_id': int(pokemon_id),
+                    'count': count,
+                    'spawnpoint_id': spawnpoint_id
+                })
+
+        return appearances
 
     @staticmethod
+    @replica_read
     def get_appearances_times_by_spawnpoint(pokemon_id, spawnpoint_id,
                                             timediff):
 
@@ -328,7 +627,17 @@ class Pokemon(LatLongModel):
                  .tuples()
                  )
 
-        return list(itertools.chain(*query))
+        # Older rows are read from the archive.
+        archived_until = pokemon_archived_until()
+        if not archived_until:
+            return list(itertools.chain(*query))
+
+        times = []
+        if not timediff or timediff < archived_until:
+            times = archive.appearance_times(pokemon_id, spawnpoint_id,
+                                             timediff or None)
+        query = query.where(Pokemon.disappear_time >= archived_until)
+        return times + list(itertools.chain(*query))
 
 
 class Pokestop(LatLongModel):
@@ -336,6 +645,7 @@ class Pokestop(LatLongModel):
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = UBigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     lure_expiration = DateTimeField(null=True, index=True)
     active_fort_modifier = SmallIntegerField(null=True, index=True)
@@ -346,6 +656,7 @@ class Pokestop(LatLongModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
+    @replica_read
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                   oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
 
@@ -361,17 +672,11 @@ class Pokestop(LatLongModel):
             query = (query
                      .where(((Pokestop.last_updated >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
+                            Pokestop.in_bounds(swLat, swLng, neLat, neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng and lured:
             query = (query
-                     .where((((Pokestop.latitude >= swLat) &
-                              (Pokestop.longitude >= swLng) &
-                              (Pokestop.latitude <= neLat) &
-                              (Pokestop.longitude <= neLng)) &
+                     .where(((Pokestop.in_bounds(swLat, swLng, neLat, neLng)) &
                              (Pokestop.active_fort_modifier.is_null(False))) &
                             ~((Pokestop.latitude >= oSwLat) &
                               (Pokestop.longitude >= oSwLng) &
@@ -383,10 +688,7 @@ class Pokestop(LatLongModel):
             # Send stops in view but exclude those within old boundaries. Only
             # send newly uncovered stops.
             query = (query
-                     .where(((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
+                     .where((Pokestop.in_bounds(swLat, swLng, neLat, neLng)) &
                             ~((Pokestop.latitude >= oSwLat) &
                               (Pokestop.longitude >= oSwLng) &
                               (Pokestop.latitude <= oNeLat) &
@@ -396,19 +698,13 @@ class Pokestop(LatLongModel):
             query = (query
                      .where(((Pokestop.last_updated >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
+                            (Pokestop.in_bounds(swLat, swLng, neLat, neLng)) &
                             (Pokestop.active_fort_modifier.is_null(False)))
                      .dicts())
 
         else:
             query = (query
-                     .where((Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
+                     .where(Pokestop.in_bounds(swLat, swLng, neLat, neLng))
                      .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -437,6 +733,7 @@ class Gym(LatLongModel):
     park = BooleanField(default=False)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell_id = UBigIntegerField(null=True, index=True)
     total_cp = SmallIntegerField()
     last_modified = DateTimeField(index=True)
     last_scanned = DateTimeField(default=datetime.utcnow, index=True)
@@ -445,6 +742,7 @@ class Gym(LatLongModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
+    @replica_read
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                  oSwLng=None, oNeLat=None, oNeLng=None):
         if not (swLat and swLng and neLat and neLng):
@@ -457,20 +755,14 @@ class Gym(LatLongModel):
                        .select()
                        .where(((Gym.last_scanned >
                                 datetime.utcfromtimestamp(timestamp / 1000)) &
-                               (Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)))
+                               Gym.in_bounds(swLat, swLng, neLat, neLng)))
                        .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send gyms in view but exclude those within old boundaries. Only
             # send newly uncovered gyms.
             results = (Gym
                        .select()
-                       .where(((Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)) &
+                       .where((Gym.in_bounds(swLat, swLng, neLat, neLng)) &
                               ~((Gym.latitude >= oSwLat) &
                                 (Gym.longitude >= oSwLng) &
                                 (Gym.latitude <= oNeLat) &
@@ -480,10 +772,7 @@ class Gym(LatLongModel):
         else:
             results = (Gym
                        .select()
-                       .where((Gym.latitude >= swLat) &
-                              (Gym.longitude >= swLng) &
-                              (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng))
+                       .where(Gym.in_bounds(swLat, swLng, neLat, neLng))
                        .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -550,6 +839,7 @@ class Gym(LatLongModel):
         return gyms
 
     @staticmethod
+    @replica_read
     def get_gym(id):
 
         try:
@@ -631,15 +921,24 @@ class Gym(LatLongModel):
     def set_gyms_in_park(gyms, park):
         gym_ids = [gym['gym_id'] for gym in gyms]
         Gym.update(park=park).where(Gym.gym_id << gym_ids).execute()
+        scan_cache.add_parks(dict((gym_id, park) for gym_id in gym_ids))
 
+    # Returns {gym id: park flag}, False for unknown gyms.
     @staticmethod
-    def get_gyms_park(id):
-        with Gym.database().execution_context():
-            gym_by_id = Gym.select(Gym.park).where(
-                Gym.gym_id == id).dicts()
-            if gym_by_id:
-                return gym_by_id[0]['park']
-        return False
+    def get_gyms_parks(ids):
+        parks, missing = scan_cache.get_parks(ids)
+        if missing:
+            fetched = dict((gym_id, False) for gym_id in missing)
+            with Gym.database().execution_context():
+                query = (Gym
+                         .select(Gym.gym_id, Gym.park)
+                         .where(Gym.gym_id << missing)
+                         .tuples())
+                for gym_id, park in query:
+                    fetched[gym_id] = bool(park)
+            scan_cache.add_parks(fetched)
+            parks.update(fetched)
+        return parks
 
 
 class Raid(BaseModel):
@@ -697,9 +996,7 @@ class LocationAltitude(LatLongModel):
 
     @staticmethod
     def save_altitude(loc, altitude):
-        InsertQuery(
-            LocationAltitude,
-            rows=[LocationAltitude.new_loc(loc, altitude)]).upsert().execute()
+        upsert_row(LocationAltitude, LocationAltitude.new_loc(loc, altitude))
 
 
 class PlayerLocale(BaseModel):
@@ -726,9 +1023,10 @@ class PlayerLocale(BaseModel):
 
 class ScannedLocation(LatLongModel):
     cellid = UBigIntegerField(primary_key=True)
-    latitude = DoubleField()
-    longitude = DoubleField()
-    last_modified = DateTimeField(
+    latitude = CoordinateField()
+    longitude = CoordinateField()
+    s2_cell_id = UBigIntegerField(null=True, index=True)
+    last_modified = TimestampField(
         index=True, default=datetime.utcnow, null=True)
     # Marked true when all five bands have been completed.
     done = BooleanField(default=False)
@@ -766,6 +1064,7 @@ class ScannedLocation(LatLongModel):
                        Check('width >= 0'), Check('width <= 130')]
 
     @staticmethod
+    @replica_read
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                    oSwLng=None, oNeLat=None, oNeLng=None):
         activeTime = (datetime.utcnow() - timedelta(minutes=15))
@@ -774,10 +1073,8 @@ class ScannedLocation(LatLongModel):
                      .select()
                      .where(((ScannedLocation.last_modified >=
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
+                            ScannedLocation.in_bounds(swLat, swLng, neLat,
+                                                      neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send scannedlocations in view but exclude those within old
@@ -785,10 +1082,8 @@ class ScannedLocation(LatLongModel):
             query = (ScannedLocation
                      .select()
                      .where((((ScannedLocation.last_modified >= activeTime)) &
-                             (ScannedLocation.latitude >= swLat) &
-                             (ScannedLocation.longitude >= swLng) &
-                             (ScannedLocation.latitude <= neLat) &
-                             (ScannedLocation.longitude <= neLng)) &
+                             ScannedLocation.in_bounds(swLat, swLng, neLat,
+                                                       neLng)) &
                             ~(((ScannedLocation.last_modified >= activeTime)) &
                               (ScannedLocation.latitude >= oSwLat) &
                               (ScannedLocation.longitude >= oSwLng) &
@@ -799,10 +1094,8 @@ class ScannedLocation(LatLongModel):
             query = (ScannedLocation
                      .select()
                      .where((ScannedLocation.last_modified >= activeTime) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
+                            ScannedLocation.in_bounds(swLat, swLng, neLat,
+                                                      neLng))
                      .order_by(ScannedLocation.last_modified.asc())
                      .dicts())
 
@@ -840,6 +1133,10 @@ class ScannedLocation(LatLongModel):
 
     @staticmethod
     def get_by_cellids(cellids):
+        if registry.has_cells(cellids):
+            return dict(("{}".format(cell), scan) for cell, scan
+                        in registry.get_scans(cellids).iteritems())
+
         d = {}
         with ScannedLocation.database().execution_context():
             query = (ScannedLocation
@@ -860,6 +1157,10 @@ class ScannedLocation(LatLongModel):
     # Return value of a particular scan from loc, or default dict if not found.
     @staticmethod
     def get_by_loc(loc):
+        scan = registry.get_scan(cellid(loc))
+        if scan:
+            return scan
+
         with ScannedLocation.database().execution_context():
             query = (ScannedLocation
                      .select()
@@ -892,9 +1193,43 @@ class ScannedLocation(LatLongModel):
                     index += 1
         return scan_spawn_point
 
+    # Load the scanned locations of a hive ({cell id: dict}) into the
+    # registry, with the spawnpoints linked to them in the database, the
+    # spawnpoints found in the hive and the links that were just created.
+    @staticmethod
+    def load_registry(owner, scans, spawn_points, new_links):
+        cells = scans.keys()
+        links = dict((cell, set()) for cell in cells)
+        sp_by_id = dict((sp['id'], sp) for sp in spawn_points)
+
+        with ScanSpawnPoint.database().execution_context():
+            query = (ScanSpawnPoint
+                     .select(ScanSpawnPoint.scannedlocation,
+                             ScanSpawnPoint.spawnpoint)
+                     .where(ScanSpawnPoint.scannedlocation << cells)
+                     .tuples())
+            for cell, sp_id in query:
+                links[cell].add(sp_id)
+
+            query = (SpawnPoint
+                     .select()
+                     .join(ScanSpawnPoint)
+                     .where(ScanSpawnPoint.scannedlocation << cells)
+                     .distinct()
+                     .dicts())
+            for sp in query:
+                sp_by_id[sp['id']] = sp
+
+        for link in new_links.itervalues():
+            links[link['scannedlocation']].add(link['spawnpoint'])
+
+        registry.load(owner, scans, sp_by_id, links)
+
     # Return list of dicts for upcoming valid band times.
     @staticmethod
     def linked_spawn_points(cell):
+        if registry.has_cell(cell):
+            return registry.linked_spawn_points(cell)
 
         # Unable to use a normal join, since MySQL produces foreignkey
         # constraint errors when trying to upsert fields that are foreignkeys
@@ -910,7 +1245,11 @@ class ScannedLocation(LatLongModel):
 
     # Return list of dicts for upcoming valid band times.
     @staticmethod
+    @replica_read
     def get_cell_to_linked_spawn_points(cellids, location_change_date):
+        if registry.has_cells(cellids):
+            return registry.cell_to_linked_spawn_points(cellids)
+
         # Get all spawnpoints from the hive's cells
         sp_from_cells = (ScanSpawnPoint
                          .select(ScanSpawnPoint.spawnpoint)
@@ -1027,6 +1366,11 @@ class ScannedLocation(LatLongModel):
 
     @staticmethod
     def get_bands_filled_by_cellids(cellids):
+        if registry.has_cells(cellids):
+            return sum(scan['band' + str(i)] > -1
+                       for scan in registry.get_scans(cellids).itervalues()
+                       for i in range(1, 6))
+
         with SpawnPoint.database().execution_context():
             result = int(
                 ScannedLocation.select(
@@ -1188,12 +1532,13 @@ class WorkerStatus(LatLongModel):
 
 class SpawnPoint(LatLongModel):
     id = UBigIntegerField(primary_key=True)
-    latitude = DoubleField()
-    longitude = DoubleField()
-    last_scanned = DateTimeField(index=True)
+    latitude = CoordinateField()
+    longitude = CoordinateField()
+    s2_cell_id = UBigIntegerField(null=True, index=True)
+    last_scanned = TimestampField(index=True)
     # kind gives the four quartiles of the spawn, as 's' for seen
     # or 'h' for hidden.  For example, a 30 minute spawn is 'hhss'.
-    kind = Utf8mb4CharField(max_length=4, default='hhhs')
+    kind = CodeField(max_length=4, default='hhhs')
 
     # links shows whether a Pokemon encounter id changes between quartiles or
     # stays the same.  Both 1x45 and 1x60h3 have the kind of 'sssh', but the
@@ -1205,7 +1550,7 @@ class SpawnPoint(LatLongModel):
     # Note index is shifted by a half. links[0] is the link between
     # kind[0] and kind[1] and so on. links[3] is the link between
     # kind[3] and kind[0]
-    links = Utf8mb4CharField(max_length=4, default='????')
+    links = CodeField(max_length=4, default='????')
 
     # Count consecutive times spawn should have been seen, but wasn't.
     # If too high, will not be scheduled for review, and treated as inactive.
@@ -1226,29 +1571,38 @@ class SpawnPoint(LatLongModel):
                        Check('latest_seen >= 0'),
                        Check('latest_seen <= 3600')]
 
-    # Returns the spawnpoint dict from ID, or a new dict if not found.
+    # Returns {id: spawnpoint dict} for a dict of {id: (latitude,
+    # longitude)}, with one query. Spawnpoints not found get a new dict.
     @staticmethod
-    def get_by_id(id, latitude=0, longitude=0):
-        with SpawnPoint.database().execution_context():
-            query = (SpawnPoint
-                     .select()
-                     .where(SpawnPoint.id == id)
-                     .dicts())
-
-            result = query[0] if query else {
-                'id': id,
-                'latitude': latitude,
-                'longitude': longitude,
-                'last_scanned': None,  # Null value used as new flag.
-                'kind': 'hhhs',
-                'links': '????',
-                'missed_count': 0,
-                'latest_seen': 0,
-                'earliest_unseen': 0
-            }
+    def get_by_ids(locations):
+        result = registry.get_spawn_points(locations)
+        missing = [sp_id for sp_id in locations if sp_id not in result]
+        if missing:
+            with SpawnPoint.database().execution_context():
+                query = (SpawnPoint
+                         .select()
+                         .where(SpawnPoint.id << missing)
+                         .dicts())
+                for sp in query:
+                    result[sp['id']] = sp
+
+        for id, (latitude, longitude) in locations.iteritems():
+            if id not in result:
+                result[id] = {
+                    'id': id,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'last_scanned': None,  # Null value used as new flag.
+                    'kind': 'hhhs',
+                    'links': '????',
+                    'missed_count': 0,
+                    'latest_seen': 0,
+                    'earliest_unseen': 0
+                }
         return result
 
     @staticmethod
+    @replica_read
     def get_spawnpoints(swLat, swLng, neLat, neLng, timestamp=0,
                         oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
         spawnpoints = {}
@@ -1263,18 +1617,14 @@ class SpawnPoint(LatLongModel):
                 query = (
                     query.where(((SpawnPoint.last_scanned >
                                   datetime.utcfromtimestamp(timestamp / 1000)))
-                                & ((SpawnPoint.latitude >= swLat) &
-                                   (SpawnPoint.longitude >= swLng) &
-                                   (SpawnPoint.latitude <= neLat) &
-                                   (SpawnPoint.longitude <= neLng))).dicts())
+                                & SpawnPoint.in_bounds(swLat, swLng, neLat,
+                                                       neLng)).dicts())
             elif oSwLat and oSwLng and oNeLat and oNeLng:
                 # Send spawnpoints in view but exclude those within old
                 # boundaries. Only send newly uncovered spawnpoints.
                 query = (query
-                         .where((((SpawnPoint.latitude >= swLat) &
-                                  (SpawnPoint.longitude >= swLng) &
-                                  (SpawnPoint.latitude <= neLat) &
-                                  (SpawnPoint.longitude <= neLng))) &
+                         .where(SpawnPoint.in_bounds(swLat, swLng, neLat,
+                                                     neLng) &
                                 ~((SpawnPoint.latitude >= oSwLat) &
                                   (SpawnPoint.longitude >= oSwLng) &
                                   (SpawnPoint.latitude <= oNeLat) &
@@ -1282,10 +1632,8 @@ class SpawnPoint(LatLongModel):
                          .dicts())
             elif swLat and swLng and neLat and neLng:
                 query = (query
-                         .where((SpawnPoint.latitude <= neLat) &
-                                (SpawnPoint.latitude >= swLat) &
-                                (SpawnPoint.longitude >= swLng) &
-                                (SpawnPoint.longitude <= neLng)))
+                         .where(SpawnPoint.in_bounds(swLat, swLng, neLat,
+                                                     neLng)))
 
             queryDict = query.dicts()
             for sp in queryDict:
@@ -1403,7 +1751,12 @@ class SpawnPoint(LatLongModel):
             l.append(ScannedLocation._q_init(scan, start, end, kind, sp['id']))
 
     @staticmethod
+    @replica_read
     def select_in_hex_by_cellids(cellids, location_change_date):
+        if registry.has_cells(cellids):
+            return [sp for sps in registry.cell_to_linked_spawn_points(
+                cellids).itervalues() for sp in sps]
+
         # Get all spawnpoints from the hive's cells
         sp_from_cells = (ScanSpawnPoint
                          .select(ScanSpawnPoint.spawnpoint)
@@ -1454,10 +1807,7 @@ class SpawnPoint(LatLongModel):
         with SpawnPoint.database().execution_context():
             sp = list(SpawnPoint
                       .select()
-                      .where((SpawnPoint.latitude <= n) &
-                             (SpawnPoint.latitude >= s) &
-                             (SpawnPoint.longitude >= w) &
-                             (SpawnPoint.longitude <= e))
+                      .where(SpawnPoint.in_bounds(s, w, n, e))
                       .dicts())
 
             # For each spawn work out if it is in the hex
@@ -1495,191 +1845,16 @@ class SpawnpointDetectionData(BaseModel):
     encounter_id = UBigIntegerField()
     # Removed ForeignKeyField since it caused MySQL issues.
     spawnpoint_id = UBigIntegerField(index=True)
-    scan_time = DateTimeField()
+    scan_time = DateTimeField(index=True)
     tth_secs = SmallIntegerField(null=True)
 
-    @staticmethod
-    def set_default_earliest_unseen(sp):
-        sp['earliest_unseen'] = (sp['latest_seen'] + 15 * 60) % 3600
-
     @staticmethod
     def classify(sp, scan_loc, now_secs, sighting=None):
-
-        # Get past sightings.
-        with SpawnpointDetectionData.database().execution_context():
-            query = list(
-                SpawnpointDetectionData.select()
-                .where(SpawnpointDetectionData.spawnpoint_id == sp['id'])
-                .order_by(SpawnpointDetectionData.scan_time.asc()).dicts())
-
-        if sighting:
-            query.append(sighting)
-
-        tth_found = False
-        for s in query:
-            if s['tth_secs'] is not None:
-                tth_found = True
-                tth_secs = (s['tth_secs'] - 1) % 3600
-
-        # To reduce CPU usage, give an intial reading of 15 minute spawns if
-        # not done with initial scan of location.
-        if not scan_loc['done']:
-            # We only want to reset a SP if it is new and not due the
-            # location changing (which creates new Scannedlocations)
-            if not tth_found:
-                sp['kind'] = 'hhhs'
-                if not sp['earliest_unseen']:
-                    sp['latest_seen'] = now_secs
-                    SpawnpointDetectionData.set_default_earliest_unseen(sp)
-
-                elif clock_between(sp['latest_seen'], now_secs,
-                                   sp['earliest_unseen']):
-                    sp['latest_seen'] = now_secs
-            return
-
-        # Make a record of links, so we can reset earliest_unseen
-        # if it changes.
-        old_kind = str(sp['kind'])
-        # Make a sorted list of the seconds after the hour.
-        seen_secs = sorted(map(lambda x: date_secs(x['scan_time']), query))
-        # Include and entry for the TTH if it found
-        if tth_found:
-            seen_secs.append(tth_secs)
-            seen_secs.sort()
-        # Add the first seen_secs to the end as a clock wrap around.
-        if seen_secs:
-            seen_secs.append(seen_secs[0] + 3600)
-
-        # Make a list of gaps between sightings.
-        gap_list = [seen_secs[i + 1] - seen_secs[i]
-                    for i in range(len(seen_secs) - 1)]
-
-        max_gap = max(gap_list)
-
-        # An hour minus the largest gap in minutes gives us the duration the
-        # spawn was there.  Round up to the nearest 15 minute interval for our
-        # current best guess duration.
-        duration = (int((60 - max_gap / 60.0) / 15) + 1) * 15
-
-        # If the second largest gap is larger than 15 minutes, then there are
-        # two gaps greater than 15 minutes.  It must be a double spawn.
-        if len(gap_list) > 4 and sorted(gap_list)[-2] > 900:
-            sp['kind'] = 'hshs'
-            sp['links'] = 'h?h?'
-
-        else:
-            # Convert the duration into a 'hhhs', 'hhss', 'hsss', 'ssss' string
-            # accordingly.  's' is for seen, 'h' is for hidden.
-            sp['kind'] = ''.join(
-                ['s' if i > (3 - duration / 15) else 'h' for i in range(0, 4)])
-
-        # Assume no hidden times.
-        sp['links'] = sp['kind'].replace('s', '?')
-
-        if sp['kind'] != 'ssss':
-            # Cover all bases, make sure we're using values < 3600.
-            # Warning: python uses modulo as the least residue, not as
-            # remainder, so we don't apply it to the result.
-            residue_unseen = sp['earliest_unseen'] % 3600
-            residue_seen = sp['latest_seen'] % 3600
-            if (not sp['earliest_unseen'] or
-                    residue_unseen != residue_seen or
-                    not tth_found):
-
-                # New latest_seen will be just before max_gap.
-                sp['latest_seen'] = seen_secs[gap_list.index(max_gap)]
-
-                # if we don't have a earliest_unseen yet or if the kind of
-                # spawn has changed, reset to latest_seen + 14 minutes.
-                if not sp['earliest_unseen'] or sp['kind'] != old_kind:
-                    SpawnpointDetectionData.set_default_earliest_unseen(sp)
-            return
-
-        # Only ssss spawns from here below.
-
-        sp['links'] = '+++-'
-
-        # Cover all bases, make sure we're using values < 3600.
-        # Warning: python uses modulo as the least residue, not as
-        # remainder, so we don't apply it to the result.
-        residue_unseen = sp['earliest_unseen'] % 3600
-        residue_seen = sp['latest_seen'] % 3600
-
-        if residue_unseen == residue_seen:
-            return
-
-        # Make a sight_list of dicts:
-        # {date: first seen time,
-        # delta: duration of sighting,
-        # same: whether encounter ID was same or different over that time}
-        #
-        # For 60 minute spawns ('ssss'), the largest gap doesn't give the
-        # earliest spawnpoint because a Pokemon is always there.  Use the union
-        # of all intervals where the same encounter ID was seen to find the
-        # latest_seen.  If a different encounter ID was seen, then the
-        # complement of that interval was the same ID, so union that
-        # complement as well.
-
-        sight_list = [{'date': query[i]['scan_time'],
-                       'delta': query[i + 1]['scan_time'] -
-                       query[i]['scan_time'],
-                       'same': query[i + 1]['encounter_id'] ==
-                       query[i]['encounter_id']
-                       }
-                      for i in range(len(query) - 1)
-                      if query[i + 1]['scan_time'] - query[i]['scan_time'] <
-                      timedelta(hours=1)
-                      ]
-
-        start_end_list = []
-        for s in sight_list:
-            if s['same']:
-                # Get the seconds past the hour for start and end times.
-                start = date_secs(s['date'])
-                end = (start + int(s['delta'].total_seconds())) % 3600
-
-            else:
-                # Convert diff range to same range by taking the clock
-                # complement.
-                start = date_secs(s['date'] + s['delta']) % 3600
-                end = date_secs(s['date'])
-
-            start_end_list.append([start, end])
-
-        # Take the union of all the ranges.
-        while True:
-            # union is list of unions of ranges with the same encounter id.
-            union = []
-            for start, end in start_end_list:
-                if not union:
-                    union.append([start, end])
-                    continue
-                # Cycle through all ranges in union, since it might overlap
-                # with any of them.
-                for u in union:
-                    if clock_between(u[0], start, u[1]):
-                        u[1] = end if not(clock_between(
-                            u[0], end, u[1])) else u[1]
-                    elif clock_between(u[0], end, u[1]):
-                        u[0] = start if not(clock_between(
-                            u[0], start, u[1])) else u[0]
-                    elif union.count([start, end]) == 0:
-                        union.append([start, end])
-
-            # Are no more unions possible?
-            if union == start_end_list:
-                break
-
-            start_end_list = union  # Make another pass looking for unions.
-
-        # If more than one disparate union, take the largest as our starting
-        # point.
-        union = reduce(lambda x, y: x if (x[1] - x[0]) % 3600 >
-                       (y[1] - y[0]) % 3600 else y, union, [0, 3600])
-        sp['latest_seen'] = union[1]
-        sp['earliest_unseen'] = union[0]
-        log.info('1x60: appear %d, despawn %d, duration: %d min.',
-                 union[0], union[1], ((union[1] - union[0]) % 3600) / 60)
+        summary = SpawnpointSightings.get_summary(sp['id'])
+        with sighting_summaries_lock:
+            if sighting:
+                summary.add(sighting)
+            summary.classify(sp, scan_loc, now_secs)
 
     # Expand the seen times for 30 minute spawnpoints based on scans when spawn
     # wasn't there.  Return true if spawnpoint dict changed.
@@ -1706,6 +1881,76 @@ class SpawnpointDetectionData(BaseModel):
         return True
 
 
+# Sighting history of a spawnpoint, as a stored SightingSummary. Replaces the
+# rows of SpawnpointDetectionData, which are only read to convert them.
+class SpawnpointSightings(BaseModel):
+    spawnpoint_id = UBigIntegerField(primary_key=True)
+    data = BinaryField()
+
+    # Sighting summary of a spawnpoint, read from the database the first time
+    # it's needed and kept up to date by classify() afterwards.
+    @staticmethod
+    def get_summary(sp_id):
+        with sighting_summaries_lock:
+            summary = sighting_summaries.get(sp_id, None)
+        if summary:
+            return summary
+
+        with SpawnpointSightings.database().execution_context():
+            query = (SpawnpointSightings
+                     .select(SpawnpointSightings.data)
+                     .where(SpawnpointSightings.spawnpoint_id == sp_id)
+                     .tuples())
+            rows = list(query)
+            if rows:
+                summary = SightingSummary.loads(str(rows[0][0]))
+            else:
+                summary = SightingSummary()
+                query = (SpawnpointDetectionData
+                         .select()
+                         .where(SpawnpointDetectionData.spawnpoint_id == sp_id)
+                         .order_by(SpawnpointDetectionData.scan_time.asc())
+                         .dicts())
+                for s in query:
+                    summary.add(s)
+
+        with sighting_summaries_lock:
+            # Another thread might have loaded it in the meantime.
+            return sighting_summaries.setdefault(sp_id, summary)
+
+    # DB format of the current summary of a spawnpoint.
+    @staticmethod
+    def db_format(sp_id):
+        summary = SpawnpointSightings.get_summary(sp_id)
+        with sighting_summaries_lock:
+            return {'spawnpoint_id': sp_id, 'data': summary.dumps()}
+
+    # Merge the summaries stored by other instances sharing the database
+    # into the ones about to be written, so the last writer doesn't drop
+    # their sightings. Merging is idempotent, so sightings lost to a write
+    # in between are merged back on the next write of the spawnpoint.
+    @staticmethod
+    def merge_stored(data):
+        with SpawnpointSightings.database().execution_context():
+            query = (SpawnpointSightings
+                     .select(SpawnpointSightings.spawnpoint_id,
+                             SpawnpointSightings.data)
+                     .where(SpawnpointSightings.spawnpoint_id << data.keys())
+                     .tuples())
+            stored = list(query)
+
+        for sp_id, blob in stored:
+            theirs = SightingSummary.loads(str(blob))
+            with sighting_summaries_lock:
+                # Keep the merged summary for the next classification, unless
+                # it's no longer cached.
+                summary = sighting_summaries.get(sp_id, None)
+                if not summary:
+                    summary = SightingSummary.loads(data[sp_id]['data'])
+                summary.merge(theirs)
+                data[sp_id]['data'] = summary.dumps()
+
+
 class Versions(BaseModel):
     key = Utf8mb4CharField()
     val = SmallIntegerField()
@@ -1714,6 +1959,31 @@ class Versions(BaseModel):
         primary_key = False
 
 
+# Position of the chunked database cleanup per table, so it picks up where
+# it left off after a restart.
+class CleanupCursor(BaseModel):
+    name = Utf8mb4CharField(primary_key=True, max_length=50)
+    position = Utf8mb4CharField(null=True)
+    last_updated = DateTimeField(default=datetime.utcnow)
+
+    @staticmethod
+    def get_position(name, pk_field):
+        try:
+            cursor = CleanupCursor.get(CleanupCursor.name == name)
+            return pk_field.python_value(cursor.position)
+        except CleanupCursor.DoesNotExist:
+            return None
+
+    @staticmethod
+    def set_position(name, position):
+        if position is None:
+            CleanupCursor.delete().where(CleanupCursor.name == name).execute()
+        else:
+            upsert_row(CleanupCursor, {'name': name,
+                                       'position': str(position),
+                                       'last_updated': datetime.utcnow()})
+
+
 class GymMember(BaseModel):
     gym_id = Utf8mb4CharField(index=True)
     pokemon_uid = UBigIntegerField(index=True)
@@ -1754,6 +2024,16 @@ class GymDetails(BaseModel):
     url = Utf8mb4CharField()
     last_scanned = DateTimeField(default=datetime.utcnow)
 
+    # {gym id: last scanned} of the given gyms that have details.
+    @staticmethod
+    def get_last_scanned(ids):
+        with GymDetails.database().execution_context():
+            query = (GymDetails
+                     .select(GymDetails.gym_id, GymDetails.last_scanned)
+                     .where(GymDetails.gym_id << ids)
+                     .tuples())
+            return dict(query)
+
 
 class Token(BaseModel):
     token = TextField()
@@ -1838,7 +2118,7 @@ def hex_bounds(center, steps=None, radius=None):
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e.
 def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
               wh_update_queue, key_scheduler, api, status, now_date, account,
-              account_sets):
+              account_sets, encounter_stage=None):
     pokemon = {}
     pokestops = {}
     gyms = {}
@@ -1856,6 +2136,7 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
     sightings = {}
     new_spawn_points = []
     sp_id_list = []
+    encounters = []
 
     # Consolidate the individual lists in each cell into two lists of Pokemon
     # and a list of forts.
@@ -1912,24 +2193,37 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
     if wild_pokemon and not args.no_pokemon:
         encounter_ids = [p.encounter_id for p in wild_pokemon]
         # For all the wild Pokemon we found check if an active Pokemon is in
-        # the database.
-        with Pokemon.database().execution_context():
-            query = (Pokemon
-                     .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
-                     .where((Pokemon.disappear_time >= now_date) &
-                            (Pokemon.encounter_id << encounter_ids))
-                     .dicts())
-
-            # Store all encounter_ids and spawnpoint_ids for the Pokemon in
-            # query.
-            # All of that is needed to make sure it's unique.
-            encountered_pokemon = [
-                (p['encounter_id'], p['spawnpoint_id']) for p in query]
+        # the database. Only those not in the scan cache are looked up.
+        encountered, missing = scan_cache.get_encounters(encounter_ids)
+        if missing:
+            stored = {}
+            with Pokemon.database().execution_context():
+                query = (Pokemon
+                         .select(Pokemon.encounter_id, Pokemon.spawnpoint_id,
+                                 Pokemon.disappear_time)
+                         .where((Pokemon.disappear_time >= now_date) &
+                                (Pokemon.encounter_id << missing))
+                         .dicts())
+                for p in query:
+                    stored[p['encounter_id']] = (
+                        p['spawnpoint_id'],
+                        calendar.timegm(p['disappear_time'].timetuple()))
+            scan_cache.add_encounters(stored)
+            for encounter_id, (spawnpoint_id, _) in stored.iteritems():
+                encountered[encounter_id] = spawnpoint_id
+
+        # Store all encounter_ids and spawnpoint_ids of stored Pokemon.
+        # All of that is needed to make sure it's unique.
+        encountered_pokemon = set(encountered.iteritems())
+
+        # Load all spawnpoints of the scan at once.
+        known_spawn_points = SpawnPoint.get_by_ids(dict(
+            (int(p.spawn_point_id, 16), (p.latitude, p.longitude))
+            for p in wild_pokemon))
 
         for p in wild_pokemon:
             spawn_id = int(p.spawn_point_id, 16)
-            sp = SpawnPoint.get_by_id(spawn_id, p.latitude,
-                                      p.longitude)
+            sp = known_spawn_points[spawn_id]
             spawn_points[spawn_id] = sp
             sp['missed_count'] = 0
 
@@ -1968,7 +2262,7 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
                     sp['latest_seen'] = d_t_secs
                     sp['earliest_unseen'] = d_t_secs
 
-            scan_spawn_points[len(scan_spawn_points)+1] = {
+            scan_spawn_points[(sp['id'], scan_location['cellid'])] = {
                 'spawnpoint': sp['id'],
                 'scannedlocation': scan_location['cellid']}
             if not sp['last_scanned']:
@@ -1989,7 +2283,7 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
                     not scan_location['done'] or just_completed):
                 SpawnpointDetectionData.classify(sp, scan_location, now_secs,
                                                  sighting)
-                sightings[p.encounter_id] = sighting
+                sightings[spawn_id] = SpawnpointSightings.db_format(spawn_id)
 
             sp['last_scanned'] = datetime.utcfromtimestamp(
                 p.last_modified_timestamp_ms / 1000.0)
@@ -2017,93 +2311,101 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
             printPokemon(pokemon_id, p.latitude, p.longitude,
                          disappear_time)
 
-            # Scan for IVs/CP and moves.
+            # Scan for IVs/CP and moves. Encounters with the L30 pool are
+            # queued if there are encounter threads, the Pokemon is stored and
+            # sent to webhooks without IVs meanwhile.
             pokemon_info = False
+            queue_encounter = False
             if args.encounter and (pokemon_id in args.enc_whitelist):
-                pokemon_info = encounter_pokemon(
-                    args, p, account, api, account_sets, status, key_scheduler)
-
-            pokemon[p.encounter_id] = {
-                'encounter_id': p.encounter_id,
-                'spawnpoint_id': spawn_id,
-                'pokemon_id': pokemon_id,
-                'latitude': p.latitude,
-                'longitude': p.longitude,
-                'disappear_time': disappear_time,
-                'individual_attack': None,
-                'individual_defense': None,
-                'individual_stamina': None,
-                'move_1': None,
-                'move_2': None,
-                'cp': None,
-                'cp_multiplier': None,
-                'height': None,
-                'weight': None,
-                'gender': p.pokemon_data.pokemon_display.gender,
-                'costume': p.pokemon_data.pokemon_display.costume,
-                'form': p.pokemon_data.pokemon_display.form,
-                'weather_boosted_condition': None
-
-            }
+                if encounter_stage and account['level'] < 30:
+                    queue_encounter = True
+                else:
+                    pokemon_info = in_flight_encounters.encounter(
+                        p.encounter_id,
+                        calendar.timegm(disappear_time.timetuple()),
+                        lambda: encounter_pokemon(
+                            args, p, account, api, account_sets, status,
+                            key_scheduler))
 
-            # Store Pokémon boosted condition.
-            # TODO: Move pokemon_display to the top.
             pokemon_display = p.pokemon_data.pokemon_display
-            boosted = pokemon_display.weather_boosted_condition
-            if boosted:
-                pokemon[p.encounter_id]['weather_boosted_condition'] = boosted
+            record = PokemonRecord(
+                encounter_id=p.encounter_id,
+                spawnpoint_id=spawn_id,
+                pokemon_id=pokemon_id,
+                latitude=p.latitude,
+                longitude=p.longitude,
+                disappear_time=disappear_time,
+                individual_attack=None,
+                individual_defense=None,
+                individual_stamina=None,
+                move_1=None,
+                move_2=None,
+                cp=None,
+                cp_multiplier=None,
+                height=None,
+                weight=None,
+                gender=pokemon_display.gender,
+                costume=pokemon_display.costume,
+                form=pokemon_display.form,
+                # Store Pokémon boosted condition.
+                weather_boosted_condition=(
+                    pokemon_display.weather_boosted_condition or None))
+            pokemon[p.encounter_id] = record
 
             # We need to check if exist and is not false due to a
             # request error.
             if pokemon_info:
-                pokemon[p.encounter_id].update({
-                    'individual_attack': pokemon_info.individual_attack,
-                    'individual_defense': pokemon_info.individual_defense,
-                    'individual_stamina': pokemon_info.individual_stamina,
-                    'move_1': pokemon_info.move_1,
-                    'move_2': pokemon_info.move_2,
-                    'height': pokemon_info.height_m,
-                    'weight': pokemon_info.weight_kg,
-                    'cp': pokemon_info.cp,
-                    'cp_multiplier': pokemon_info.cp_multiplier,
-                    'gender': pokemon_info.pokemon_display.gender
-                })
+                record.update(encounter_fields(pokemon_info))
 
+            webhook = False
             if 'pokemon' in args.wh_types:
                 if (pokemon_id in args.webhook_whitelist or
                     (not args.webhook_whitelist and pokemon_id
                      not in args.webhook_blacklist)):
-                    wh_poke = pokemon[p.encounter_id].copy()
-                    wh_poke.update({
-                        'disappear_time': calendar.timegm(
-                            disappear_time.timetuple()),
-                        'last_modified_time': p.last_modified_timestamp_ms,
-                        'time_until_hidden_ms': p.time_till_hidden_ms,
-                        'verified': SpawnPoint.tth_found(sp),
-                        'seconds_until_despawn': seconds_until_despawn,
-                        'spawn_start': start_end[0],
-                        'spawn_end': start_end[1],
-                        'player_level': encounter_level
-                    })
-                    if wh_poke['cp_multiplier'] is not None:
-                        wh_poke.update({
-                            'pokemon_level': calc_pokemon_level(
-                                wh_poke['cp_multiplier'])
-                        })
-                    wh_update_queue.put(('pokemon', wh_poke))
+                    webhook = True
+                    record.last_modified_time = p.last_modified_timestamp_ms
+                    record.time_until_hidden_ms = p.time_till_hidden_ms
+                    record.verified = SpawnPoint.tth_found(sp)
+                    record.seconds_until_despawn = seconds_until_despawn
+                    record.spawn_start = start_end[0]
+                    record.spawn_end = start_end[1]
+                    record.player_level = encounter_level
+                    wh_update_queue.put(('pokemon', record))
+
+            if queue_encounter:
+                encounters.append({
+                    'args': args,
+                    'p': p,
+                    'pokemon': record,
+                    'webhook': webhook,
+                    'account': account,
+                    'account_sets': account_sets,
+                    'status': status,
+                    'key_scheduler': key_scheduler,
+                    'dbq': db_update_queue,
+                    'whq': wh_update_queue,
+                    'queued': default_timer()
+                })
 
     if forts and (not args.no_pokestops or not args.no_gyms):
         if not args.no_pokestops:
             stop_ids = [f.id for f in forts if f.type == 1]
-            if stop_ids:
+            encountered_pokestops, missing = scan_cache.get_pokestops(
+                stop_ids)
+            if missing:
                 with Pokemon.database().execution_context():
                     query = (Pokestop.select(
                         Pokestop.pokestop_id, Pokestop.last_modified).where(
-                            (Pokestop.pokestop_id << stop_ids)).dicts())
-                    encountered_pokestops = [(f['pokestop_id'], int(
+                            (Pokestop.pokestop_id << missing)).dicts())
+                    fetched = dict((f['pokestop_id'], int(
                         (f['last_modified'] - datetime(1970, 1,
                                                        1)).total_seconds()))
-                                             for f in query]
+                                   for f in query)
+                scan_cache.add_pokestops(fetched)
+                encountered_pokestops.update(fetched)
+
+        if not args.no_gyms:
+            parks = Gym.get_gyms_parks([f.id for f in forts if f.type == 0])
 
         for f in forts:
             if not args.no_pokestops and f.type == 1:  # Pokestops.
@@ -2115,47 +2417,48 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
                 else:
                     lure_expiration, active_fort_modifier = None, None
 
-                if ((f.id, int(f.last_modified_timestamp_ms / 1000.0))
-                        in encountered_pokestops):
+                if (encountered_pokestops.get(f.id) ==
+                        int(f.last_modified_timestamp_ms / 1000.0)):
                     # If pokestop has been encountered before and hasn't
                     # changed don't process it.
                     stopsskipped += 1
                     continue
-                pokestops[f.id] = {
-                    'pokestop_id': f.id,
-                    'enabled': f.enabled,
-                    'latitude': f.latitude,
-                    'longitude': f.longitude,
-                    'last_modified': datetime.utcfromtimestamp(
+                pokestops[f.id] = PokestopRecord(
+                    pokestop_id=f.id,
+                    enabled=f.enabled,
+                    latitude=f.latitude,
+                    longitude=f.longitude,
+                    last_modified=datetime.utcfromtimestamp(
                         f.last_modified_timestamp_ms / 1000.0),
-                    'lure_expiration': lure_expiration,
-                    'active_fort_modifier': active_fort_modifier
-                }
+                    last_modified_ms=f.last_modified_timestamp_ms,
+                    lure_expiration=lure_expiration,
+                    active_fort_modifier=active_fort_modifier)
 
                 # Send all pokestops to webhooks.
                 if 'pokestop' in args.wh_types or (
                         'lure' in args.wh_types and
                         lure_expiration is not None):
-                    l_e = None
-                    if lure_expiration is not None:
-                        l_e = calendar.timegm(lure_expiration.timetuple())
-                    wh_pokestop = pokestops[f.id].copy()
-                    wh_pokestop.update({
-                        'pokestop_id': f.id,
-                        'last_modified': f.last_modified_timestamp_ms,
-                        'lure_expiration': l_e,
-                    })
-                    wh_update_queue.put(('pokestop', wh_pokestop))
+                    wh_update_queue.put(('pokestop', pokestops[f.id]))
 
             # Currently, there are only stops and gyms.
             elif not args.no_gyms and f.type == 0:
-                b64_gym_id = str(f.id)
                 gym_display = f.gym_display
                 raid_info = f.raid_info
-                park = Gym.get_gyms_park(f.id)
+                gym = GymRecord(
+                    gym_id=f.id,
+                    team_id=f.owned_by_team,
+                    park=parks[f.id],
+                    guard_pokemon_id=f.guard_pokemon_id,
+                    slots_available=gym_display.slots_available,
+                    total_cp=gym_display.total_gym_cp,
+                    enabled=f.enabled,
+                    latitude=f.latitude,
+                    longitude=f.longitude,
+                    last_modified=datetime.utcfromtimestamp(
+                        f.last_modified_timestamp_ms / 1000.0))
+                gyms[f.id] = gym
 
                 # Send gyms to webhooks.
-
                 if 'gym' in args.wh_types:
                     raid_active_until = 0
                     raid_battle_ms = raid_info.raid_battle_ms
@@ -2164,105 +2467,48 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
                     if raid_battle_ms / 1000 > time.time():
                         raid_active_until = raid_end_ms / 1000
 
-                    # Explicitly set 'webhook_data', in case we want to change
-                    # the information pushed to webhooks.  Similar to above
-                    # and previous commits.
-                    wh_update_queue.put(('gym', {
-                        'gym_id':
-                            b64_gym_id,
-                        'team_id':
-                            f.owned_by_team,
-                        'park':
-                            park,
-                        'guard_pokemon_id':
-                            f.guard_pokemon_id,
-                        'slots_available':
-                            gym_display.slots_available,
-                        'total_cp':
-                            gym_display.total_gym_cp,
-                        'enabled':
-                            f.enabled,
-                        'latitude':
-                            f.latitude,
-                        'longitude':
-                            f.longitude,
-                        'lowest_pokemon_motivation':
-                            gym_display.lowest_pokemon_motivation,
-                        'occupied_since':
-                            calendar.timegm((datetime.utcnow() - timedelta(
-                                milliseconds=gym_display.occupied_millis)
-                                            ).timetuple()),
-                        'last_modified':
-                            f.last_modified_timestamp_ms,
-                        'raid_active_until':
-                            raid_active_until
-                    }))
-                gyms[f.id] = {
-                    'gym_id':
-                        f.id,
-                    'team_id':
-                        f.owned_by_team,
-                    'park':
-                        park,
-                    'guard_pokemon_id':
-                        f.guard_pokemon_id,
-                    'slots_available':
-                        gym_display.slots_available,
-                    'total_cp':
-                        gym_display.total_gym_cp,
-                    'enabled':
-                        f.enabled,
-                    'latitude':
-                        f.latitude,
-                    'longitude':
-                        f.longitude,
-                    'last_modified':
-                        datetime.utcfromtimestamp(
-                            f.last_modified_timestamp_ms / 1000.0),
-
-                }
+                    gym.last_modified_ms = f.last_modified_timestamp_ms
+                    gym.lowest_pokemon_motivation = (
+                        gym_display.lowest_pokemon_motivation)
+                    gym.occupied_since = calendar.timegm(
+                        (datetime.utcnow() - timedelta(
+                            milliseconds=gym_display.occupied_millis)
+                         ).timetuple())
+                    gym.raid_active_until = raid_active_until
+                    wh_update_queue.put(('gym', gym))
 
                 if not args.no_raids and f.type == 0:
                     if f.HasField('raid_info'):
-                        raids[f.id] = {
-                            'gym_id': f.id,
-                            'level': raid_info.raid_level,
-                            'spawn': datetime.utcfromtimestamp(
+                        raid = RaidRecord(
+                            gym_id=f.id,
+                            level=raid_info.raid_level,
+                            spawn=datetime.utcfromtimestamp(
                                 raid_info.raid_spawn_ms / 1000.0),
-                            'start': datetime.utcfromtimestamp(
+                            start=datetime.utcfromtimestamp(
                                 raid_info.raid_battle_ms / 1000.0),
-                            'end': datetime.utcfromtimestamp(
+                            end=datetime.utcfromtimestamp(
                                 raid_info.raid_end_ms / 1000.0),
-                            'pokemon_id': None,
-                            'cp': None,
-                            'move_1': None,
-                            'move_2': None
-                        }
+                            pokemon_id=None,
+                            cp=None,
+                            move_1=None,
+                            move_2=None)
+                        raids[f.id] = raid
 
                         if raid_info.HasField('raid_pokemon'):
                             raid_pokemon = raid_info.raid_pokemon
-                            raids[f.id].update({
-                                'pokemon_id': raid_pokemon.pokemon_id,
-                                'cp': raid_pokemon.cp,
-                                'move_1': raid_pokemon.move_1,
-                                'move_2': raid_pokemon.move_2
-                            })
+                            raid.pokemon_id = raid_pokemon.pokemon_id
+                            raid.cp = raid_pokemon.cp
+                            raid.move_1 = raid_pokemon.move_1
+                            raid.move_2 = raid_pokemon.move_2
 
                         if ('egg' in args.wh_types and
-                                raids[f.id]['pokemon_id'] is None) or (
+                                raid.pokemon_id is None) or (
                                     'raid' in args.wh_types and
-                                    raids[f.id]['pokemon_id'] is not None):
-                            wh_raid = raids[f.id].copy()
-                            wh_raid.update({
-                                'gym_id': b64_gym_id,
-                                'team_id': f.owned_by_team,
-                                'spawn': raid_info.raid_spawn_ms / 1000,
-                                'start': raid_info.raid_battle_ms / 1000,
-                                'end': raid_info.raid_end_ms / 1000,
-                                'latitude': f.latitude,
-                                'longitude': f.longitude
-                            })
-                            wh_update_queue.put(('raid', wh_raid))
+                                    raid.pokemon_id is not None):
+                            raid.team_id = f.owned_by_team
+                            raid.latitude = f.latitude
+                            raid.longitude = f.longitude
+                            wh_update_queue.put(('raid', raid))
 
         # Let db do it's things while we try to spin.
         if args.pokestop_spinning:
@@ -2332,12 +2578,24 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
                 sp['earliest_unseen'] + 14 * 60) % 3600
             spawn_points[sp['id']] = sp
 
-    db_update_queue.put((ScannedLocation, {0: scan_location}))
+    registry.update(scan_location, spawn_points, scan_spawn_points)
+    db_update_queue.put((ScannedLocation,
+                         {scan_location['cellid']: scan_location}))
 
     if pokemon:
         db_update_queue.put((Pokemon, pokemon))
+        scan_cache.add_encounters(dict(
+            (encounter_id, (p.spawnpoint_id, calendar.timegm(
+                p.disappear_time.timetuple())))
+            for encounter_id, p in pokemon.iteritems()))
+        # Only after the Pokemon are queued, so the IVs can't be overwritten.
+        for job in encounters:
+            encounter_stage.put(job)
     if pokestops:
         db_update_queue.put((Pokestop, pokestops))
+        scan_cache.add_pokestops(dict(
+            (pokestop_id, calendar.timegm(p.last_modified.timetuple()))
+            for pokestop_id, p in pokestops.iteritems()))
     if gyms:
         db_update_queue.put((Gym, gyms))
     if raids:
@@ -2346,7 +2604,7 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
         db_update_queue.put((SpawnPoint, spawn_points))
         db_update_queue.put((ScanSpawnPoint, scan_spawn_points))
         if sightings:
-            db_update_queue.put((SpawnpointDetectionData, sightings))
+            db_update_queue.put((SpawnpointSightings, sightings))
 
     if not nearby_pokemon and not wild_pokemon:
         # After parsing the forts, we'll mark this scan as bad due to
@@ -2368,6 +2626,51 @@ def parse_map(args, map_dict, scan_coords, scan_location, db_update_queue,
     }
 
 
+# Encounter a Pokemon queued by parse_map, with an account of the L30 pool,
+# then store it again and update webhooks with the IVs.
+def encounter_queued(job):
+    pokemon = job['pokemon']
+    if pokemon.disappear_time <= datetime.utcnow():
+        metrics.inc('encounter.expired')
+        return
+
+    pokemon_info = in_flight_encounters.encounter(
+        pokemon.encounter_id,
+        calendar.timegm(pokemon.disappear_time.timetuple()),
+        lambda: encounter_pokemon(
+            job['args'], job['p'], job['account'], None,
+            job['account_sets'], job['status'], job['key_scheduler']))
+    # From the sighting to the encounter result.
+    metrics.observe('encounter.latency', default_timer() - job['queued'])
+    if not pokemon_info:
+        metrics.inc('encounter.failed')
+        return
+    metrics.inc('encounter.success')
+
+    # The same record was queued with the scan, so a later write of the scan
+    # has the IVs as well.
+    pokemon.update(encounter_fields(pokemon_info))
+    job['dbq'].put((Pokemon, {pokemon.encounter_id: pokemon}))
+
+    if job['webhook']:
+        job['whq'].put(('pokemon', pokemon))
+
+
+def encounter_fields(pokemon_info):
+    return {
+        'individual_attack': pokemon_info.individual_attack,
+        'individual_defense': pokemon_info.individual_defense,
+        'individual_stamina': pokemon_info.individual_stamina,
+        'move_1': pokemon_info.move_1,
+        'move_2': pokemon_info.move_2,
+        'height': pokemon_info.height_m,
+        'weight': pokemon_info.weight_kg,
+        'cp': pokemon_info.cp,
+        'cp_multiplier': pokemon_info.cp_multiplier,
+        'gender': pokemon_info.pokemon_display.gender
+    }
+
+
 def encounter_pokemon(args, pokemon, account, api, account_sets, status,
                       key_scheduler):
     using_accountset = False
@@ -2510,7 +2813,6 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
     gym_details = {}
     gym_members = {}
     gym_pokemon = {}
-    i = 0
     for g in gym_responses.values():
         gym_state = g.gym_status_and_defenders
         gym_id = gym_state.pokemon_fort_proto.id
@@ -2536,7 +2838,7 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
 
         for member in gym_state.gym_defender:
             pokemon = member.motivated_pokemon.pokemon
-            gym_members[i] = {
+            gym_members[(gym_id, pokemon.id)] = {
                 'gym_id':
                     gym_id,
                 'pokemon_uid':
@@ -2548,7 +2850,7 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
                     timedelta(milliseconds=member.deployment_totals
                               .deployment_duration_ms)
             }
-            gym_pokemon[i] = {
+            gym_pokemon[pokemon.id] = {
                 'pokemon_uid': pokemon.id,
                 'pokemon_id': pokemon.pokemon_id,
                 'cp': member.motivated_pokemon.cp_when_deployed,
@@ -2571,17 +2873,16 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
             }
 
             if 'gym-info' in args.wh_types:
-                wh_pokemon = gym_pokemon[i].copy()
+                wh_pokemon = gym_pokemon[pokemon.id].copy()
                 del wh_pokemon['last_seen']
                 wh_pokemon.update({
                     'cp_decayed':
                         member.motivated_pokemon.cp_now,
                     'deployment_time': calendar.timegm(
-                        gym_members[i]['deployment_time'].timetuple())
+                        gym_members[(gym_id, pokemon.id)][
+                            'deployment_time'].timetuple())
                 })
                 webhook_data['pokemon'].append(wh_pokemon)
-
-            i += 1
         if 'gym-info' in args.wh_types:
             wh_update_queue.put(('gym_details', webhook_data))
 
@@ -2615,6 +2916,14 @@ def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
              len(gym_members))
 
 
+# Models that are re-queued on every scan, with the fields that only track
+# when the row was last seen.
+fingerprints.register(Pokestop, ('last_updated',))
+fingerprints.register(Gym, ('last_scanned',))
+fingerprints.register(SpawnPoint, ('last_scanned',))
+fingerprints.register(ScanSpawnPoint)
+
+
 def db_updater(q, db):
     # The forever loop.
     while True:
@@ -2624,8 +2933,16 @@ def db_updater(q, db):
                 model, data = q.get()
 
                 start_timer = default_timer()
-                bulk_upsert(model, data, db)
+                if fingerprints.is_registered(model):
+                    fingerprinted_upsert(model, data, db)
+                elif model is SpawnpointSightings:
+                    SpawnpointSightings.merge_stored(data)
+                    bulk_upsert(model, data, db)
+                else:
+                    bulk_upsert(model, data, db)
                 q.task_done()
+                metrics.observe('pipeline.persist',
+                                default_timer() - start_timer)
 
                 log.debug('Upserted to %s, %d records (upsert queue '
                           'remaining: %d) in %.6f seconds.',
@@ -2648,12 +2965,13 @@ def db_updater(q, db):
             time.sleep(5)
 
 
-def clean_db_loop(args):
+def clean_db_loop(args, db_updates_queue=None):
     # Run regular database cleanup once every minute.
     regular_cleanup_secs = 60
     # Run full database cleanup once every 10 minutes.
     full_cleanup_timer = default_timer()
     full_cleanup_secs = 600
+    throttle = CleanupThrottle(db_updates_queue, args.db_cleanup_max_queue)
     while True:
         try:
             db_cleanup_regular()
@@ -2667,19 +2985,21 @@ def clean_db_loop(args):
             if now - full_cleanup_timer > full_cleanup_secs:
                 # Remove old pokemon spawns.
                 if args.db_cleanup_pokemon > 0:
-                    db_clean_pokemons(args.db_cleanup_pokemon)
+                    db_clean_pokemons(args.db_cleanup_pokemon,
+                                      throttle=throttle)
 
                 # Remove old gym data.
                 if args.db_cleanup_gym > 0:
-                    db_clean_gyms(args.db_cleanup_gym)
+                    db_clean_gyms(args.db_cleanup_gym, throttle=throttle)
 
                 # Remove old and extinct spawnpoint data.
                 if args.db_cleanup_spawnpoint > 0:
-                    db_clean_spawnpoints(args.db_cleanup_spawnpoint)
+                    db_clean_spawnpoints(args.db_cleanup_spawnpoint,
+                                         throttle=throttle)
 
                 # Remove old pokestop and gym locations.
                 if args.db_cleanup_forts > 0:
-                    db_clean_forts(args.db_cleanup_forts)
+                    db_clean_forts(args.db_cleanup_forts, throttle=throttle)
 
                 log.info('Full database cleanup completed.')
                 full_cleanup_timer = now
@@ -2745,17 +3065,26 @@ def db_cleanup_worker_status(age_minutes):
               time_diff)
 
 
-def db_clean_pokemons(age_hours):
+def db_clean_pokemons(age_hours, throttle=None):
     log.debug('Beginning cleanup of old pokemon spawns.')
     start_timer = default_timer()
 
     pokemon_timeout = datetime.utcnow() - timedelta(hours=age_hours)
 
-    with Pokemon.database().execution_context():
-        query = (Pokemon
-                 .delete()
-                 .where(Pokemon.disappear_time < pokemon_timeout))
-        rows = query.execute()
+    if archive:
+        archive_old_days(Pokemon, Pokemon.disappear_time, pokemon_timeout,
+                         throttle)
+        # Only delete whole days, which are all archived now.
+        pokemon_timeout = start_of_day(pokemon_timeout)
+
+    if args.db_partition:
+        # Whole days at once, without touching a single row.
+        with Pokemon.database().execution_context():
+            drop_expired_partitions(Pokemon.database(), 'pokemon',
+                                    pokemon_timeout)
+    else:
+        rows = chunked_delete(Pokemon, Pokemon.disappear_time,
+                              pokemon_timeout, throttle)
         log.debug('Deleted %d old Pokemon entries.', rows)
 
     time_diff = default_timer() - start_timer
@@ -2763,183 +3092,329 @@ def db_clean_pokemons(age_hours):
               time_diff)
 
 
-def db_clean_gyms(age_hours, gyms_age_days=30):
+def db_clean_gyms(age_hours, gyms_age_days=30, throttle=None):
     log.debug('Beginning cleanup of old gym data.')
     start_timer = default_timer()
 
     gym_info_timeout = datetime.utcnow() - timedelta(hours=age_hours)
 
-    with Gym.database().execution_context():
-        # Remove old GymDetails entries.
-        query = (GymDetails
-                 .delete()
-                 .where(GymDetails.last_scanned < gym_info_timeout))
-        rows = query.execute()
-        log.debug('Deleted %d old GymDetails entries.', rows)
+    # Remove old GymDetails entries.
+    rows = chunked_delete(GymDetails, GymDetails.last_scanned,
+                          gym_info_timeout, throttle)
+    log.debug('Deleted %d old GymDetails entries.', rows)
 
-        # Remove old Raid entries.
-        query = (Raid
-                 .delete()
-                 .where(Raid.end < gym_info_timeout))
-        rows = query.execute()
-        log.debug('Deleted %d old Raid entries.', rows)
+    # Remove old Raid entries.
+    rows = chunked_delete(Raid, Raid.end, gym_info_timeout, throttle)
+    log.debug('Deleted %d old Raid entries.', rows)
 
-        # Remove old GymMember entries.
-        query = (GymMember
-                 .delete()
-                 .where(GymMember.last_scanned < gym_info_timeout))
-        rows = query.execute()
-        log.debug('Deleted %d old GymMember entries.', rows)
+    # Remove old GymMember entries.
+    rows = chunked_delete(GymMember, GymMember.last_scanned,
+                          gym_info_timeout, throttle)
+    log.debug('Deleted %d old GymMember entries.', rows)
 
-        # Remove old GymPokemon entries.
-        query = (GymPokemon
-                 .delete()
-                 .where(GymPokemon.last_seen < gym_info_timeout))
-        rows = query.execute()
-        log.debug('Deleted %d old GymPokemon entries.', rows)
+    # Remove old GymPokemon entries.
+    rows = chunked_delete(GymPokemon, GymPokemon.last_seen,
+                          gym_info_timeout, throttle)
+    log.debug('Deleted %d old GymPokemon entries.', rows)
 
     time_diff = default_timer() - start_timer
     log.debug('Completed cleanup of old gym data in %.6f seconds.',
               time_diff)
 
 
-def db_clean_spawnpoints(age_hours, missed=5):
+def db_clean_spawnpoints(age_hours, missed=5, throttle=None):
     log.debug('Beginning cleanup of old spawnpoint data.')
     start_timer = default_timer()
-    # Maximum number of variables to include in a single query.
-    step = 500
+    chunk_size = args.db_cleanup_chunk_size
 
     spawnpoint_timeout = datetime.utcnow() - timedelta(hours=age_hours)
 
-    with SpawnPoint.database().execution_context():
-        # Select old SpawnPoint entries.
-        query = (SpawnPoint
-                 .select(SpawnPoint.id)
-                 .where((SpawnPoint.last_scanned < spawnpoint_timeout) &
-                        (SpawnPoint.missed_count > missed))
-                 .dicts())
-        old_sp = [(sp['id']) for sp in query]
-
-        num_records = len(old_sp)
-        log.debug('Found %d old SpawnPoint entries.', num_records)
-
-        # Remove SpawnpointDetectionData entries associated to old spawnpoints.
-        num_rows = 0
-        for i in range(0, num_records, step):
-            query = (SpawnpointDetectionData
-                     .delete()
-                     .where((SpawnpointDetectionData.spawnpoint_id <<
-                             old_sp[i:min(i + step, num_records)])))
-            num_rows += query.execute()
-
-        # Remove old SpawnPointDetectionData entries.
-        query = (SpawnpointDetectionData
-                 .delete()
-                 .where((SpawnpointDetectionData.scan_time <
-                         spawnpoint_timeout)))
-        num_rows += query.execute()
-        log.debug('Deleted %d old SpawnpointDetectionData entries.', num_rows)
-
-        # Select ScannedLocation entries associated to old spawnpoints.
-        sl_delete = set()
-        for i in range(0, num_records, step):
-            query = (ScanSpawnPoint
-                     .select()
-                     .where((ScanSpawnPoint.spawnpoint <<
-                             old_sp[i:min(i + step, num_records)]))
-                     .dicts())
-            for sp in query:
-                sl_delete.add(sp['scannedlocation'])
-        log.debug('Found %d ScannedLocation entries from old spawnpoints.',
-                  len(sl_delete))
+    db = SpawnPoint.database()
+    last_id = CleanupCursor.get_position('spawnpoint', SpawnPoint.id)
+    num_sp = num_sdd = num_ssp = num_sl = 0
 
-        # Remove ScanSpawnPoint entries associated to old spawnpoints.
-        num_rows = 0
-        for i in range(0, num_records, step):
-            query = (ScanSpawnPoint
-                     .delete()
-                     .where((ScanSpawnPoint.spawnpoint <<
-                             old_sp[i:min(i + step, num_records)])))
-            num_rows += query.execute()
-        log.debug('Deleted %d ScanSpawnPoint entries from old spawnpoints.',
-                  num_rows)
-
-        # Remove old and invalid SpawnPoint entries.
-        num_rows = 0
-        for i in range(0, num_records, step):
+    # Old spawnpoints are removed in chunks, together with everything that
+    # links to them, one transaction per chunk.
+    while True:
+        chunk_timer = default_timer()
+        with db.execution_context():
+            # Select old SpawnPoint entries.
             query = (SpawnPoint
-                     .delete()
-                     .where((SpawnPoint.id <<
-                             old_sp[i:min(i + step, num_records)])))
-            num_rows += query.execute()
-        log.debug('Deleted %d old SpawnPoint entries.', num_rows)
-
-        sl_delete = list(sl_delete)
-        num_records = len(sl_delete)
-
-        # Remove ScanSpawnPoint entries associated with old scanned locations.
-        num_rows = 0
-        for i in range(0, num_records, step):
-            query = (ScanSpawnPoint
-                     .delete()
-                     .where((ScanSpawnPoint.scannedlocation <<
-                             sl_delete[i:min(i + step, num_records)])))
-            num_rows += query.execute()
-        log.debug('Deleted %d ScanSpawnPoint entries from old scan locations.',
-                  num_rows)
-
-        # Remove ScannedLocation entries associated with old spawnpoints.
-        num_rows = 0
-        for i in range(0, num_records, step):
-            query = (ScannedLocation
-                     .delete()
-                     .where((ScannedLocation.cellid <<
-                             sl_delete[i:min(i + step, num_records)]) &
-                            (ScannedLocation.last_modified <
-                             spawnpoint_timeout)))
-            num_rows += query.execute()
-        log.debug('Deleted %d ScannedLocation entries from old spawnpoints.',
-                  num_rows)
+                     .select(SpawnPoint.id)
+                     .where((SpawnPoint.last_scanned < spawnpoint_timeout) &
+                            (SpawnPoint.missed_count > missed)))
+            if last_id is not None:
+                query = query.where(SpawnPoint.id > last_id)
+            old_sp = [sp[0] for sp in (query
+                                       .order_by(SpawnPoint.id.asc())
+                                       .limit(chunk_size)
+                                       .tuples())]
+
+            if not old_sp:
+                CleanupCursor.set_position('spawnpoint', None)
+                break
+
+            # Remove SpawnpointDetectionData entries associated to old
+            # spawnpoints.
+            num_sdd += (SpawnpointDetectionData
+                        .delete()
+                        .where(SpawnpointDetectionData.spawnpoint_id <<
+                               old_sp)
+                        .execute())
+            num_sdd += (SpawnpointSightings
+                        .delete()
+                        .where(SpawnpointSightings.spawnpoint_id << old_sp)
+                        .execute())
+
+            # Select ScannedLocation entries associated to old spawnpoints.
+            sl_delete = list(set(
+                ssp[0] for ssp in (ScanSpawnPoint
+                                   .select(ScanSpawnPoint.scannedlocation)
+                                   .where(ScanSpawnPoint.spawnpoint << old_sp)
+                                   .tuples())))
+
+            # Remove ScanSpawnPoint entries associated to old spawnpoints.
+            num_ssp += (ScanSpawnPoint
+                        .delete()
+                        .where(ScanSpawnPoint.spawnpoint << old_sp)
+                        .execute())
+
+            # Remove old and invalid SpawnPoint entries.
+            num_sp += (SpawnPoint
+                       .delete()
+                       .where(SpawnPoint.id << old_sp)
+                       .execute())
+
+            if sl_delete:
+                # Remove ScanSpawnPoint entries associated with old scanned
+                # locations.
+                num_ssp += (ScanSpawnPoint
+                            .delete()
+                            .where(ScanSpawnPoint.scannedlocation <<
+                                   sl_delete)
+                            .execute())
+
+                # Remove ScannedLocation entries associated with old
+                # spawnpoints.
+                num_sl += (ScannedLocation
+                           .delete()
+                           .where((ScannedLocation.cellid << sl_delete) &
+                                  (ScannedLocation.last_modified <
+                                   spawnpoint_timeout))
+                           .execute())
+
+            last_id = old_sp[-1]
+            CleanupCursor.set_position('spawnpoint', last_id)
+
+        if throttle:
+            throttle.wait(default_timer() - chunk_timer)
+
+    log.debug('Deleted %d old SpawnPoint entries.', num_sp)
+    log.debug('Deleted %d ScanSpawnPoint entries from old spawnpoints and '
+              'scan locations.', num_ssp)
+    log.debug('Deleted %d ScannedLocation entries from old spawnpoints.',
+              num_sl)
+
+    # Remove old SpawnPointDetectionData entries. Sightings are stored as
+    # SpawnpointSightings now, the old rows are only read to convert
+    # spawnpoints without a summary, until they all expired.
+    num_sdd += chunked_delete(SpawnpointDetectionData,
+                              SpawnpointDetectionData.scan_time,
+                              spawnpoint_timeout, throttle)
+    log.debug('Deleted %d old SpawnpointDetectionData entries.', num_sdd)
 
     time_diff = default_timer() - start_timer
     log.debug('Completed cleanup of old spawnpoint data in %.6f seconds.',
               time_diff)
 
 
-def db_clean_forts(age_hours):
+def db_clean_forts(age_hours, throttle=None):
     log.debug('Beginning cleanup of old forts.')
     start_timer = default_timer()
 
     fort_timeout = datetime.utcnow() - timedelta(hours=age_hours)
 
-    with Gym.database().execution_context():
-        # Remove old Gym entries.
-        query = (Gym
-                 .delete()
-                 .where(Gym.last_scanned < fort_timeout))
-        rows = query.execute()
-        log.debug('Deleted %d old Gym entries.', rows)
+    # Remove old Gym entries.
+    rows = chunked_delete(Gym, Gym.last_scanned, fort_timeout, throttle)
+    log.debug('Deleted %d old Gym entries.', rows)
 
-        # Remove old Pokestop entries.
-        query = (Pokestop
-                 .delete()
-                 .where(Pokestop.last_updated < fort_timeout))
-        rows = query.execute()
-        log.debug('Deleted %d old Pokestop entries.', rows)
+    # Remove old Pokestop entries.
+    rows = chunked_delete(Pokestop, Pokestop.last_updated, fort_timeout,
+                          throttle)
+    log.debug('Deleted %d old Pokestop entries.', rows)
 
     time_diff = default_timer() - start_timer
     log.debug('Completed cleanup of old forts in %.6f seconds.',
               time_diff)
 
 
+# Write all whole days before `timeout` that aren't archived yet to the
+# archive, one day at a time. Rows are read in primary key chunks.
+def archive_old_days(cls, field, timeout, throttle=None):
+    db = cls.database()
+    table = cls._meta.db_table
+    pk = cls._meta.primary_key
+    names = [name for name, _ in archive_columns[table]]
+    fields = [pk] + [getattr(cls, name) for name in names]
+    chunk_size = args.db_cleanup_chunk_size
+
+    with db.execution_context():
+        oldest = list(cls.select(fn.MIN(field)).tuples())[0][0]
+    if oldest is None:
+        return
+
+    day = oldest.date()
+    while day < timeout.date():
+        if archive.has_day(table, day):
+            day += timedelta(days=1)
+            continue
+
+        start = start_of_day(day)
+        end = start + timedelta(days=1)
+        rows = dict((name, []) for name in names)
+        last_pk = None
+        while True:
+            chunk_timer = default_timer()
+            with db.execution_context():
+                query = cls.select(*fields).where((field >= start) &
+                                                  (field < end))
+                if last_pk is not None:
+                    query = query.where(pk > last_pk)
+                chunk = list(query
+                             .order_by(pk.asc())
+                             .limit(chunk_size)
+                             .tuples())
+            if not chunk:
+                break
+
+            for row in chunk:
+                for name, value in zip(names, row[1:]):
+                    rows[name].append(value)
+            last_pk = chunk[-1][0]
+
+            if throttle:
+                throttle.wait(default_timer() - chunk_timer)
+
+        archive.write_day(table, day, rows)
+        log.info('Archived %d %s rows of %s.', len(rows[names[0]]), table,
+                 day)
+        day += timedelta(days=1)
+
+
+# Start of the first day that isn't archived yet, if Pokemon are archived.
+# Older Pokemon are read from the archive instead of the database.
+def pokemon_archived_until():
+    return archive.covered_until('pokemon') if archive else None
+
+
+def start_of_day(dt):
+    return datetime(dt.year, dt.month, dt.day)
+
+
+# Delete all rows where `field` < `timeout` in primary key order, committing
+# every --db-cleanup-chunk-size rows and pausing in between so the db updater
+# threads don't have to wait for locks. The last deleted primary key is
+# stored, so a restart resumes where it left off. Returns the number of rows
+# deleted.
+def chunked_delete(cls, field, timeout, throttle=None):
+    db = cls.database()
+    pk = cls._meta.primary_key
+    chunk_size = args.db_cleanup_chunk_size
+    name = cls._meta.db_table
+    num_rows = 0
+
+    # Tables without a primary key are deleted in the order of the time
+    # column instead, which doesn't need a cursor.
+    if not pk:
+        if is_postgres(db):
+            query_string = ('DELETE FROM "{table}" WHERE ctid IN ('
+                            'SELECT ctid FROM "{table}" WHERE "{field}" < %s '
+                            'ORDER BY "{field}" LIMIT %s);')
+        else:
+            query_string = ('DELETE FROM `{table}` WHERE `{field}` < %s '
+                            'ORDER BY `{field}` LIMIT %s;')
+        query_string = query_string.format(table=name, field=field.db_column)
+        while True:
+            chunk_timer = default_timer()
+            with db.execution_context():
+                rows = db.execute_sql(query_string,
+                                      (field.db_value(timeout),
+                                       chunk_size)).rowcount
+            num_rows += rows
+
+            if rows < chunk_size:
+                return num_rows
+
+            if throttle:
+                throttle.wait(default_timer() - chunk_timer)
+
+    last_pk = CleanupCursor.get_position(name, pk)
+    while True:
+        chunk_timer = default_timer()
+        with db.execution_context():
+            query = cls.select(pk).where(field < timeout)
+            if last_pk is not None:
+                query = query.where(pk > last_pk)
+            keys = [row[0] for row in (query
+                                       .order_by(pk.asc())
+                                       .limit(chunk_size)
+                                       .tuples())]
+
+            if not keys:
+                CleanupCursor.set_position(name, None)
+                return num_rows
+
+            num_rows += (cls
+                         .delete()
+                         .where((pk << keys) & (field < timeout))
+                         .execute())
+            last_pk = keys[-1]
+            CleanupCursor.set_position(name, last_pk)
+
+        if throttle:
+            throttle.wait(default_timer() - chunk_timer)
+
+
+# Paces the chunked database cleanup. After each chunk it sleeps as long as
+# the chunk took, so cleanup never takes more than half of the database's
+# time, and then waits while the db updater queue is backed up.
+class CleanupThrottle(object):
+
+    def __init__(self, db_updates_queue=None, max_queue=50, max_wait_secs=60):
+        self.db_updates_queue = db_updates_queue
+        self.max_queue = max_queue
+        self.max_wait_secs = max_wait_secs
+
+    def wait(self, chunk_secs):
+        waited = min(chunk_secs, self.max_wait_secs)
+        time.sleep(waited)
+
+        while (self.db_updates_queue is not None and
+               self.db_updates_queue.qsize() > self.max_queue and
+               waited < self.max_wait_secs):
+            time.sleep(1)
+            waited += 1
+
+        metrics.inc('cleanup.chunks')
+        metrics.observe('cleanup.throttle', waited)
+
+
 def bulk_upsert(cls, data, db):
     rows = data.values()
     num_rows = len(rows)
     i = 0
+    success = True
 
     # This shouldn't happen, ever, but anyways...
     if num_rows < 1:
-        return
+        return success
+
+    # Rows never carry their S2 cell id, derive it from the coordinates.
+    if 's2_cell_id' in cls._meta.fields:
+        for row in rows:
+            if row.get('s2_cell_id') is None and 'latitude' in row:
+                row['s2_cell_id'] = s2_cell_id(row['latitude'],
+                                               row['longitude'])
 
     # We used to support SQLite and it has a default max 999 parameters,
     # so we limited how many rows we insert for it.
@@ -2951,7 +3426,6 @@ def bulk_upsert(cls, data, db):
 
     # Prepare for our query.
     conn = db.get_conn()
-    cursor = db.get_cursor()
 
     # We build our own INSERT INTO ... ON DUPLICATE KEY UPDATE x=VALUES(x)
     # query, making sure all data is properly escaped. We use
@@ -2981,6 +3455,69 @@ def bulk_upsert(cls, data, db):
         field_default = cls._meta.defaults.get(f, None)
         defaults[field_name] = field_default
 
+    # The raw query bypasses peewee's conversion, so do it ourselves for the
+    # fields that are stored in a different type than their Python value.
+    converters = {}
+    for f in cls._meta.fields.values():
+        if isinstance(f, (E7CoordinateField, EpochDateTimeField)):
+            converters[f.name] = f.db_value
+        elif isinstance(f, BlobField) and is_postgres(db):
+            converters[f.name] = copy_bytea
+
+    if is_postgres(db):
+        formatted_query = copy_upsert_queries(cls, db_columns)
+    else:
+        formatted_query = mysql_upsert_query(conn, cls, db_columns)
+    name = cls.__name__
+
+    while i < num_rows:
+        start = i
+        end = min(i + step, num_rows)
+
+        log.debug('Inserting items %d to %d for %s.', start, end, name)
+
+        # Time to bulk upsert our data. Convert objects to a list of
+        # values for executemany(), and fall back to defaults if
+        # necessary.
+        batch = []
+        batch_rows = rows[start:end]
+
+        for row in batch_rows:
+            row_data = []
+
+            # Parse rows, build arrays of values sorted via row_fields.
+            for field in row_fields:
+                # Take a default if we need it.
+                if field not in row:
+                    default = defaults.get(field, None)
+
+                    # peewee's defaults can be callable, e.g. current
+                    # time. We only call when needed to insert.
+                    if callable(default):
+                        default = default()
+
+                    row[field] = default
+
+                # Append to keep the exact order, and only these
+                # fields.
+                if field in converters:
+                    row_data.append(converters[field](row[field]))
+                else:
+                    row_data.append(row[field])
+            # Done preparing, add it to the batch.
+            batch.append(row_data)
+
+        # Each batch is committed on its own, so one bad row only costs
+        # us that row.
+        if upsert_batch(cls, db, formatted_query, batch, batch_rows) > 0:
+            success = False
+
+        i += step
+
+    return success
+
+
+def mysql_upsert_query(conn, cls, db_columns):
     # Assign fields, placeholders and assignments after defaults
     # so our lists/keys stay in order.
     table = '`'+conn.escape_string(cls._meta.db_table)+'`'
@@ -2997,90 +3534,309 @@ def bulk_upsert(cls, data, db):
                     + ' ({placeholders}) ON DUPLICATE KEY UPDATE'
                     + ' {assignments}')
 
-    # Prepare transaction.
-    with db.atomic():
-        while i < num_rows:
-            start = i
-            end = min(i + step, num_rows)
-            name = cls.__name__
+    # Format query once, it's the same for all batches.
+    return query_string.format(
+        table=table,
+        fields=', '.join(escaped_fields),
+        placeholders=', '.join(placeholders),
+        assignments=', '.join(assignments)
+    )
+
+
+# PostgreSQL has no VALUES() in ON CONFLICT and executemany() sends one
+# statement per row. Instead, each batch is sent with COPY into a temporary
+# table, and upserted from there with a single statement. The temporary
+# table lives as long as the connection and is emptied on commit. Returns
+# the queries to create the table, COPY into it and upsert from it.
+def copy_upsert_queries(cls, db_columns):
+    table = cls._meta.db_table
+    temp_table = 'tmp_' + table
+    columns = ', '.join('"{}"'.format(c) for c in db_columns)
+
+    return (
+        'CREATE TEMPORARY TABLE IF NOT EXISTS "{temp}" (LIKE "{table}" '
+        'INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;'.format(
+            temp=temp_table, table=table),
+        'COPY "{temp}" ({columns}) FROM STDIN;'.format(
+            temp=temp_table, columns=columns),
+        'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM "{temp}" '
+        '{on_conflict};'.format(table=table, temp=temp_table,
+                                columns=columns,
+                                on_conflict=on_conflict_sql(cls,
+                                                            db_columns)))
+
+
+# The ON CONFLICT clause of a PostgreSQL upsert of `db_columns`.
+def on_conflict_sql(cls, db_columns):
+    pk = cls._meta.primary_key
+    if not pk:
+        return ''
+    if hasattr(pk, 'field_names'):
+        pk_columns = [peewee_attr_to_col(cls, f) for f in pk.field_names]
+    else:
+        pk_columns = [pk.db_column]
+    if not set(pk_columns) <= set(db_columns):
+        return ''
 
-            log.debug('Inserting items %d to %d for %s.', start, end, name)
+    assignments = ', '.join('"{0}" = EXCLUDED."{0}"'.format(c)
+                            for c in db_columns if c not in pk_columns)
+    return 'ON CONFLICT ({}) DO {}'.format(
+        ', '.join('"{}"'.format(c) for c in pk_columns),
+        'UPDATE SET ' + assignments if assignments else 'NOTHING')
 
-            try:
-                # Turn off FOREIGN_KEY_CHECKS on MySQL, because apparently it's
-                # unable to recognize strings to update unicode keys for
-                # foreign key fields, thus giving lots of foreign key
-                # constraint errors.
-                db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
-
-                # Time to bulk upsert our data. Convert objects to a list of
-                # values for executemany(), and fall back to defaults if
-                # necessary.
-                batch = []
-                batch_rows = rows[i:min(i + step, num_rows)]
-
-                # We pop them off one by one so we can gradually release
-                # memory as we pass each item. No duplicate memory usage.
-                while len(batch_rows) > 0:
-                    row = batch_rows.pop()
-                    row_data = []
-
-                    # Parse rows, build arrays of values sorted via row_fields.
-                    for field in row_fields:
-                        # Take a default if we need it.
-                        if field not in row:
-                            default = defaults.get(field, None)
-
-                            # peewee's defaults can be callable, e.g. current
-                            # time. We only call when needed to insert.
-                            if callable(default):
-                                default = default()
-
-                            row[field] = default
-
-                        # Append to keep the exact order, and only these
-                        # fields.
-                        row_data.append(row[field])
-                    # Done preparing, add it to the batch.
-                    batch.append(row_data)
-
-                # Format query and go.
-                formatted_query = query_string.format(
-                    table=table,
-                    fields=', '.join(escaped_fields),
-                    placeholders=', '.join(placeholders),
-                    assignments=', '.join(assignments)
-                )
-
-                cursor.executemany(formatted_query, batch)
-
-                db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
-
-            except Exception as e:
-                # If there is a DB table constraint error, dump the data and
-                # don't retry.
-                #
-                # Unrecoverable error strings:
-                unrecoverable = ['constraint', 'has no attribute',
-                                 'peewee.IntegerField object at']
-                has_unrecoverable = filter(
-                    lambda x: x in str(e), unrecoverable)
-                if has_unrecoverable:
-                    log.exception('%s. Data is:', repr(e))
-                    log.warning(data.items())
+
+def copy_upsert(db, queries, batch):
+    create_query, copy_query, upsert_query = queries
+    data = StringIO()
+    for row in batch:
+        data.write('\t'.join(copy_value(v) for v in row))
+        data.write('\n')
+    data.seek(0)
+
+    cursor = db.get_cursor()
+    cursor.execute(create_query)
+    cursor.copy_expert(copy_query, data)
+    cursor.execute(upsert_query)
+
+
+# A value in COPY's text format.
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        # str() rounds to 12 digits.
+        value = repr(value)
+    elif isinstance(value, datetime):
+        value = value.isoformat(' ')
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+# Binary data in bytea's hex format, escaped by copy_value().
+def copy_bytea(value):
+    return None if value is None else '\\x' + str(value).encode('hex')
+
+
+# Single row INSERT, or REPLACE if the primary key exists.
+def upsert_row(cls, row):
+    query = InsertQuery(cls, rows=[row])
+    db = cls.database()
+    if not is_postgres(db):
+        return query.upsert().execute()
+
+    sql, params = query.sql()
+    db_columns = [f.db_column for f in cls._meta.sorted_fields]
+    return db.execute_sql(sql + ' ' + on_conflict_sql(cls, db_columns),
+                          params)
+
+
+# Upsert a batch of rows in its own transaction. Transient errors are retried
+# with a capped exponential backoff, up to db_retry_max_attempts times before
+# the whole batch is dead-lettered. Any other error is caused by the data:
+# the batch is split in half until the offending rows are isolated and
+# written to the dead-letter file, and all other rows are committed.
+# Returns the number of rows that were dead-lettered.
+def upsert_batch(cls, db, query, batch, rows):
+    attempt = 0
+
+    while True:
+        try:
+            with db.atomic():
+                if is_postgres(db):
+                    copy_upsert(db, query, batch)
                 else:
-                    log.warning('%s... Retrying...', repr(e))
-                    time.sleep(1)
-                    continue
+                    # Turn off FOREIGN_KEY_CHECKS on MySQL, because
+                    # apparently it's unable to recognize strings to update
+                    # unicode keys for foreign key fields, thus giving lots
+                    # of foreign key constraint errors.
+                    db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+                    try:
+                        if (args.db_partition and
+                                cls._meta.db_table in partitioned_tables):
+                            move_partitioned_rows(cls, db, rows)
+                        db.get_cursor().executemany(query, batch)
+                    finally:
+                        # The connection goes back to the pool.
+                        db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+            return 0
+        except Exception as e:
+            if is_transient_db_error(e):
+                if attempt >= db_retry_max_attempts:
+                    log.error('%s while upserting %d %s rows, giving up '
+                              'after %d retries.', repr(e), len(batch),
+                              cls.__name__, attempt)
+                    write_dead_letter(cls, rows, e)
+                    return len(rows)
+
+                delay = min(2 ** attempt, db_retry_max_secs)
+                attempt += 1
+                metrics.inc('upsert.retries')
+                log.warning('%s while upserting %d %s rows... Retrying in '
+                            '%d seconds.', repr(e), len(batch), cls.__name__,
+                            delay)
+
+                # Don't hand a broken connection back to the pool.
+                try:
+                    db.manual_close()
+                except Exception:
+                    pass
+
+                time.sleep(delay)
+                continue
 
-            i += step
+            if len(batch) == 1:
+                write_dead_letter(cls, rows, e)
+                return 1
+
+            log.warning('%s while upserting %d %s rows, splitting batch to '
+                        'isolate bad rows.', repr(e), len(batch),
+                        cls.__name__)
+            half = len(batch) // 2
+            return (upsert_batch(cls, db, query, batch[:half], rows[:half]) +
+                    upsert_batch(cls, db, query, batch[half:], rows[half:]))
+
+
+# The primary key of a partitioned table includes its partitioning column, so
+# ON DUPLICATE KEY doesn't match a row whose value of it changed, e.g. a
+# Pokemon whose disappear time was refined once its spawnpoint's TTH was
+# found. Move those rows to their new value first, so the upsert updates them
+# instead of inserting a second row for the same key.
+def move_partitioned_rows(cls, db, rows):
+    table = cls._meta.db_table
+    field, pk = partitioned_tables[table]
+    pk_field = cls._meta.primary_key
+    values = dict((pk_field.db_value(row[pk_field.name]),
+                   field.db_value(row[field.name])) for row in rows)
+
+    cursor = db.execute_sql(
+        'SELECT `{pk}`, `{column}` FROM `{table}` WHERE `{pk}` IN '
+        '({keys});'.format(pk=pk[0], column=field.db_column, table=table,
+                           keys=', '.join(['%s'] * len(values))),
+        values.keys())
+    moved = []
+    for key, stored in cursor.fetchall():
+        value = values[key]
+        # Times are stored without the fraction of a second.
+        if isinstance(value, datetime):
+            changed = abs((value - stored).total_seconds()) >= 1
+        else:
+            changed = value != stored
+        if changed:
+            moved.append((value, key))
+
+    if moved:
+        db.get_cursor().executemany(
+            'UPDATE `{table}` SET `{column}` = %s WHERE `{pk}` = %s;'.format(
+                table=table, column=field.db_column, pk=pk[0]), moved)
+
+
+# Connection loss, too many connections, lock wait timeout and deadlocks go
+# away on their own. Everything else will fail again with the same data.
+def is_transient_db_error(e):
+    if type(e).__name__ == 'InterfaceError':
+        return True
+
+    # psycopg2 raises OperationalError for anything from a lost connection
+    # to a full disk, tell them apart by SQLSTATE. Errors raised by the
+    # client, like a closed connection, have none.
+    if args.db_type == 'postgres':
+        if type(e).__name__ != 'OperationalError':
+            return False
+        code = getattr(e, 'pgcode', None)
+        return (code is None or code.startswith('08') or
+                code in transient_pg_errors)
+
+    code = e.args[0] if e.args and isinstance(e.args[0], int) else None
+    return (type(e).__name__ == 'OperationalError' and
+            code in transient_db_errors)
+
+
+# Append rows that can't be written to the dead-letter file, as one JSON
+# object per line, with the exception that was raised.
+def write_dead_letter(cls, rows, e):
+    filename = os.path.join(args.log_path,
+                            '{}_dead_letter.log'.format(args.status_name))
+    lines = []
+    for row in rows:
+        entry = {
+            'time': datetime.utcnow(),
+            'model': cls.__name__,
+            'error': repr(e),
+            'row': dict(row)
+        }
+        try:
+            lines.append(json.dumps(entry, default=str))
+        except (TypeError, ValueError):
+            entry['row'] = repr(row)
+            lines.append(json.dumps(entry, default=str))
+
+    metrics.inc('upsert.{}.dead_letter'.format(cls.__name__), len(rows))
+    log.error('Dropped %d %s rows after %s, see %s.', len(rows), cls.__name__,
+              repr(e), filename)
+    with dead_letter_lock:
+        with open(filename, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+# Upsert only the rows that changed since they were last written, and only
+# refresh the timestamps of rows where nothing else changed.
+def fingerprinted_upsert(cls, data, db):
+    changed, touched, row_fingerprints = fingerprints.split(cls, data)
+
+    if changed:
+        if bulk_upsert(cls, changed, db):
+            fingerprints.commit(cls, row_fingerprints)
+        else:
+            fingerprints.forget(cls, row_fingerprints.keys())
+
+    if touched:
+        update_timestamps(cls, touched, db)
+
+
+# Batched UPDATE of timestamp fields only, for rows that already exist.
+# `data` is {primary key: {field name: value}}.
+def update_timestamps(cls, data, db):
+    pk_field = cls._meta.primary_key
+    keys = data.keys()
+    field_names = data[keys[0]].keys()
+    step = 500
+
+    try:
+        with db.atomic():
+            for i in range(0, len(keys), step):
+                chunk = keys[i:i + step]
+                values = {}
+                for name in field_names:
+                    field = getattr(cls, name)
+                    distinct = set(data[k][name] for k in chunk)
+                    if len(distinct) == 1:
+                        values[field] = distinct.pop()
+                    else:
+                        # CASE values aren't converted by peewee.
+                        values[field] = case(
+                            pk_field, [(k, field.db_value(data[k][name]))
+                                       for k in chunk])
+
+                cls.update(values).where(pk_field << chunk).execute()
+    except Exception as e:
+        # Rewrite the full rows next time.
+        log.warning('Failed to update %s timestamps: %s.', cls.__name__,
+                    repr(e))
+        fingerprints.forget(cls, keys)
 
 
 def create_tables(db):
     tables = [Pokemon, Pokestop, Gym, Raid, ScannedLocation, GymDetails,
               GymMember, GymPokemon, MainWorker, WorkerStatus,
               SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData,
-              Token, LocationAltitude, PlayerLocale, HashKeys]
+              SpawnpointSightings, Token, LocationAltitude, PlayerLocale,
+              HashKeys, CleanupCursor]
     with db.execution_context():
         for table in tables:
             if not table.table_exists():
@@ -3095,9 +3851,13 @@ def drop_tables(db):
     tables = [Pokemon, Pokestop, Gym, Raid, ScannedLocation, Versions,
               GymDetails, GymMember, GymPokemon, MainWorker,
               WorkerStatus, SpawnPoint, ScanSpawnPoint,
-              SpawnpointDetectionData, LocationAltitude, PlayerLocale,
-              Token, HashKeys]
+              SpawnpointDetectionData, SpawnpointSightings, LocationAltitude,
+              PlayerLocale, Token, HashKeys, CleanupCursor]
     with db.execution_context():
+        if is_postgres(db):
+            db.drop_tables(tables, safe=True, cascade=True)
+            return
+
         db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
         for table in tables:
             if table.table_exists():
@@ -3138,6 +3898,309 @@ def verify_table_encoding(db):
             db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
 
 
+# Fields stored in a narrower type with --db-compact, by table.
+compact_fields = {
+    'pokemon': (Pokemon.latitude, Pokemon.longitude, Pokemon.disappear_time,
+                Pokemon.last_modified),
+    'scannedlocation': (ScannedLocation.latitude, ScannedLocation.longitude,
+                        ScannedLocation.last_modified),
+    'spawnpoint': (SpawnPoint.latitude, SpawnPoint.longitude,
+                   SpawnPoint.last_scanned, SpawnPoint.kind, SpawnPoint.links)
+}
+# SQL converting a column's values, by (current, new) MySQL data type.
+compact_conversions = {
+    ('double', 'int'): 'ROUND(`{}` * 10000000)',
+    ('int', 'double'): '`{}` / 10000000',
+    ('datetime', 'int'): 'UNIX_TIMESTAMP(`{}`)',
+    ('int', 'datetime'): 'FROM_UNIXTIME(`{}`)',
+    ('varchar', 'char'): '`{}`',
+    ('char', 'varchar'): '`{}`'
+}
+
+
+# Convert the columns in `compact_fields` to the types of the current models,
+# i.e. to the compact types with --db-compact and back without it. Values
+# are copied through a new column for each converted column, and the indexes
+# on them are rebuilt.
+def verify_compact_schema(db):
+    compiler = db.compiler()
+
+    with db.execution_context():
+        for table, fields in compact_fields.iteritems():
+            current_types = get_column_types(db, table)
+            convert = []
+            for field in fields:
+                column_type = compiler.get_column_type(field.get_db_field())
+                # E.g. 'INT UNSIGNED' or 'DOUBLE PRECISION', and INTEGER is
+                # reported as int.
+                new_type = column_type.split()[0].lower()
+                new_type = 'int' if new_type == 'integer' else new_type
+                old_type = current_types[field.db_column]
+                if old_type != new_type:
+                    convert.append((field, old_type, new_type, column_type))
+
+            if not convert:
+                continue
+
+            log.info('Converting %d columns of table %s to the %s schema, '
+                     'this might take a while.', len(convert), table,
+                     'compact' if args.db_compact else 'regular')
+            sizes = get_table_size(db, table)
+
+            # A partitioned table can't drop its partitioning column, it's
+            # partitioned again by verify_table_partitioning() if needed.
+            if (table in partitioned_tables and
+                    get_day_partitions(db, table) is not None):
+                remove_table_partitioning(db, table)
+
+            columns = [field.db_column for field, _, _, _ in convert]
+            indexes = get_column_indexes(db, table, columns)
+
+            alter = ['DROP INDEX `{}`'.format(name) for name in indexes]
+            for field, old_type, new_type, column_type in convert:
+                alter.append('ADD COLUMN `{column}_new` {type} NULL '
+                             'AFTER `{column}`'.format(
+                                 column=field.db_column,
+                                 type=column_sql(compiler, field,
+                                                 column_type)))
+            db.execute_sql('ALTER TABLE `{}` {};'.format(
+                table, ', '.join(alter)))
+
+            # Epoch seconds are always UTC.
+            db.execute_sql('SET @old_time_zone = @@session.time_zone;')
+            db.execute_sql("SET time_zone = '+00:00';")
+            db.execute_sql('UPDATE `{}` SET {};'.format(table, ', '.join(
+                '`{}_new` = {}'.format(
+                    field.db_column,
+                    compact_conversions[(old_type, new_type)].format(
+                        field.db_column))
+                for field, old_type, new_type, _ in convert)))
+            db.execute_sql('SET time_zone = @old_time_zone;')
+
+            alter = []
+            for field, old_type, new_type, column_type in convert:
+                alter.append('DROP COLUMN `{column}`, CHANGE `{column}_new` '
+                             '`{column}` {type} {null}'.format(
+                                 column=field.db_column,
+                                 type=column_sql(compiler, field,
+                                                 column_type),
+                                 null='NULL' if field.null else 'NOT NULL'))
+            for name, (unique, index_columns) in indexes.iteritems():
+                alter.append('ADD {}INDEX `{}` ({})'.format(
+                    'UNIQUE ' if unique else '', name,
+                    ', '.join('`{}`'.format(c) for c in index_columns)))
+            db.execute_sql('ALTER TABLE `{}` {};'.format(
+                table, ', '.join(alter)))
+
+            new_sizes = get_table_size(db, table)
+            log.info('Table %s: data %.1f MB -> %.1f MB, indexes %.1f MB -> '
+                     '%.1f MB.', table, sizes[0] / 1048576.0,
+                     new_sizes[0] / 1048576.0, sizes[1] / 1048576.0,
+                     new_sizes[1] / 1048576.0)
+
+
+# Return {column name: MySQL data type} of a table.
+def get_column_types(db, table):
+    cursor = db.execute_sql(
+        'SELECT column_name, data_type FROM information_schema.columns '
+        'WHERE table_schema = %s AND table_name = %s;',
+        (args.db_name, table))
+    return {name: data_type.lower() for name, data_type in cursor.fetchall()}
+
+
+# Return {index name: (unique, [columns])} of the secondary indexes of a
+# table that use any of `columns`.
+def get_column_indexes(db, table, columns):
+    cursor = db.execute_sql(
+        'SELECT index_name, non_unique, column_name '
+        'FROM information_schema.statistics '
+        'WHERE table_schema = %s AND table_name = %s '
+        'ORDER BY index_name, seq_in_index;', (args.db_name, table))
+    indexes = {}
+    for name, non_unique, column in cursor.fetchall():
+        if name != 'PRIMARY':
+            indexes.setdefault(name, (not non_unique, []))[1].append(column)
+
+    return {name: index for name, index in indexes.iteritems()
+            if set(index[1]) & set(columns)}
+
+
+# Return (data bytes, index bytes) of a table, with fresh statistics.
+def get_table_size(db, table):
+    db.execute_sql('ANALYZE TABLE `{}`;'.format(table)).fetchall()
+    cursor = db.execute_sql(
+        'SELECT data_length, index_length FROM information_schema.tables '
+        'WHERE table_schema = %s AND table_name = %s;',
+        (args.db_name, table))
+    return cursor.fetchone()
+
+
+def column_sql(compiler, field, column_type):
+    return compiler.parse_node(field.__ddl_column__(column_type))[0]
+
+
+# Tables that can be range partitioned by day: the time field to partition
+# on and the primary key columns it's added to, since MySQL requires every
+# unique key to include the partitioning column.
+partitioned_tables = {
+    'pokemon': (Pokemon.disappear_time, ('encounter_id',))
+}
+# Tables partitioned by earlier versions, turned back into regular tables.
+unpartitioned_tables = {
+    'spawnpointdetectiondata': (SpawnpointDetectionData.scan_time, ('id',))
+}
+# Number of days to create partitions for in advance.
+partition_days_ahead = 3
+# Catch-all partition, so writes never fail if maintenance falls behind.
+max_partition_sql = 'PARTITION pmax VALUES LESS THAN MAXVALUE'
+
+
+# Partition `pokemon` by day with --db-partition, or turn it back into a
+# regular table without it.
+def verify_table_partitioning(db):
+    with db.execution_context():
+        for table in unpartitioned_tables:
+            if get_day_partitions(db, table) is not None:
+                remove_table_partitioning(db, table)
+
+        for table, (field, pk) in partitioned_tables.iteritems():
+            partitions = get_day_partitions(db, table)
+
+            if args.db_partition and partitions is None:
+                log.info('Partitioning table %s by day, this might take a '
+                         'while.', table)
+                today = datetime.utcnow().date()
+                # The first partition holds all existing data up to today.
+                days = [today + timedelta(days=d)
+                        for d in range(-1, partition_days_ahead + 1)]
+                # Epoch seconds are partitioned on the column itself.
+                if isinstance(field, EpochDateTimeField):
+                    expression = '`{}`'.format(field.db_column)
+                else:
+                    expression = 'TO_DAYS(`{}`)'.format(field.db_column)
+                db.execute_sql(
+                    'ALTER TABLE `{table}` DROP PRIMARY KEY, '
+                    'ADD PRIMARY KEY ({pk}, `{column}`) '
+                    'PARTITION BY RANGE ({expression}) '
+                    '({partitions}, {pmax});'.format(
+                        table=table,
+                        pk=', '.join('`{}`'.format(f) for f in pk),
+                        column=field.db_column,
+                        expression=expression,
+                        partitions=', '.join(
+                            day_partition_sql(day, field) for day in days),
+                        pmax=max_partition_sql))
+
+            elif not args.db_partition and partitions is not None:
+                remove_table_partitioning(db, table)
+
+    if args.db_partition:
+        create_future_partitions(db)
+
+
+def remove_table_partitioning(db, table):
+    log.info('Removing partitioning from table %s, this might take a while.',
+             table)
+    field, pk = (partitioned_tables.get(table) or
+                 unpartitioned_tables[table])
+    db.execute_sql('ALTER TABLE `{}` REMOVE PARTITIONING;'.format(table))
+    # Rows written before their partitioning column was moved on update can
+    # share a key, keep the latest of them.
+    rows = db.execute_sql(
+        'DELETE `old` FROM `{table}` `old` JOIN `{table}` `new` ON {same} '
+        'AND `old`.`{column}` < `new`.`{column}`;'.format(
+            table=table, column=field.db_column,
+            same=' AND '.join('`old`.`{0}` = `new`.`{0}`'.format(f)
+                              for f in pk))).rowcount
+    if rows:
+        log.info('Removed %d duplicate rows from table %s.', rows, table)
+    db.execute_sql(
+        'ALTER TABLE `{table}` DROP PRIMARY KEY, '
+        'ADD PRIMARY KEY ({pk});'.format(
+            table=table,
+            pk=', '.join('`{}`'.format(f) for f in pk)))
+
+
+# Return the days of a partitioned table's day partitions, oldest first, or
+# None if the table isn't partitioned.
+def get_day_partitions(db, table):
+    cursor = db.execute_sql(
+        'SELECT partition_name FROM information_schema.partitions '
+        'WHERE table_schema = %s AND table_name = %s '
+        'ORDER BY partition_ordinal_position;', (args.db_name, table))
+    names = [row[0] for row in cursor.fetchall() if row[0] is not None]
+    if not names:
+        return None
+
+    return [datetime.strptime(name[1:], '%Y%m%d').date()
+            for name in names if name != 'pmax']
+
+
+# Partition p20180102 holds all rows before 2018-01-03.
+def day_partition_sql(day, field):
+    next_day = day + timedelta(days=1)
+    if isinstance(field, EpochDateTimeField):
+        bound = calendar.timegm(next_day.timetuple())
+    else:
+        bound = "TO_DAYS('{}')".format(next_day.isoformat())
+    return 'PARTITION p{:%Y%m%d} VALUES LESS THAN ({})'.format(day, bound)
+
+
+# Split the partitions of the next days off the (empty) catch-all partition.
+def create_future_partitions(db):
+    last_day = datetime.utcnow().date() + timedelta(days=partition_days_ahead)
+
+    with db.execution_context():
+        for table, (field, pk) in partitioned_tables.iteritems():
+            days = get_day_partitions(db, table)
+            if days is None:
+                continue
+
+            new_days = []
+            if days:
+                day = days[-1] + timedelta(days=1)
+            else:
+                day = datetime.utcnow().date()
+            while day <= last_day:
+                new_days.append(day)
+                day += timedelta(days=1)
+
+            if new_days:
+                log.info('Creating %d new partitions for table %s.',
+                         len(new_days), table)
+                db.execute_sql(
+                    'ALTER TABLE `{table}` REORGANIZE PARTITION pmax INTO '
+                    '({partitions}, {pmax});'.format(
+                        table=table,
+                        partitions=', '.join(day_partition_sql(day, field)
+                                             for day in new_days),
+                        pmax=max_partition_sql))
+
+
+# Drop the partitions that only hold rows older than `timeout`.
+def drop_expired_partitions(db, table, timeout):
+    days = get_day_partitions(db, table) or []
+    expired = ['p{:%Y%m%d}'.format(day) for day in days
+               if day + timedelta(days=1) <= timeout.date()]
+
+    if expired:
+        db.execute_sql('ALTER TABLE `{}` DROP PARTITION {};'.format(
+            table, ', '.join(expired)))
+        log.info('Dropped %d old partitions of table %s.', len(expired),
+                 table)
+
+
+def db_partition_loop():
+    # Check for missing partitions once every hour.
+    while True:
+        try:
+            create_future_partitions(Pokemon.database())
+        except Exception as e:
+            log.exception('Database partition maintenance failed: %s.', e)
+
+        time.sleep(3600)
+
+
 def verify_database_schema(db):
     if not Versions.table_exists():
         db.create_tables([Versions])
@@ -3170,6 +4233,148 @@ def verify_database_schema(db):
     db.close()
 
 
+# Compute the S2 cell id of existing rows, in primary key order and one
+# transaction per chunk.
+def backfill_s2_cell_ids(db, cls, step=5000):
+    pk = cls._meta.primary_key
+    num_rows = 0
+    last_pk = None
+
+    log.info('Computing S2 cell ids of table %s, this might take a while.',
+             cls._meta.db_table)
+    while True:
+        with db.atomic():
+            query = (cls
+                     .select(pk, cls.latitude, cls.longitude)
+                     .where(cls.s2_cell_id.is_null()))
+            if last_pk is not None:
+                query = query.where(pk > last_pk)
+            rows = list(query.order_by(pk.asc()).limit(step).tuples())
+            if not rows:
+                break
+
+            cls.update(s2_cell_id=case(pk, [
+                (key, s2_cell_id(lat, lng)) for key, lat, lng in rows])
+            ).where(pk << [row[0] for row in rows]).execute()
+
+        last_pk = rows[-1][0]
+        num_rows += len(rows)
+        log.debug('Computed S2 cell ids of %d %s rows.', num_rows,
+                  cls._meta.db_table)
+
+
+# Apply the migrator operations returned by `operations(table_name)` to a
+# table. With --db-online-migrations, MySQL tables with a single column
+# primary key are migrated online: the operations are applied to an empty
+# copy of the table, triggers keep the copy up to date while the rows are
+# copied over in primary key chunks, and the copy then replaces the table
+# with an atomic RENAME. Other instances keep scanning meanwhile.
+def migrate_table(db, migrator, table, operations):
+    pk = db.get_primary_keys(table)
+    if (not args.db_online_migrations or is_postgres(db) or
+            len(pk) != 1):
+        migrate(*operations(table))
+        return
+
+    pk = pk[0]
+    shadow = '_{}_new'.format(table)
+    old = '_{}_old'.format(table)
+    log.info('Migrating table %s online, this might take a while.', table)
+
+    db.execute_sql('DROP TABLE IF EXISTS `{}`;'.format(shadow))
+    db.execute_sql('CREATE TABLE `{}` LIKE `{}`;'.format(shadow, table))
+    migrate(*operations(shadow))
+    rename_shadow_indexes(db, shadow, table)
+
+    # Columns both tables have, in the order of the new table.
+    old_columns = set(c.name for c in db.get_columns(table))
+    columns = ', '.join('`{}`'.format(c.name)
+                        for c in db.get_columns(shadow)
+                        if c.name in old_columns)
+    new_values = ', '.join('NEW.' + c for c in columns.split(', '))
+
+    drop_online_migration_triggers(db, table)
+    db.execute_sql(
+        'CREATE TRIGGER `{table}_online_ins` AFTER INSERT ON `{table}` '
+        'FOR EACH ROW REPLACE INTO `{shadow}` ({columns}) '
+        'VALUES ({values});'.format(table=table, shadow=shadow,
+                                    columns=columns, values=new_values))
+    db.execute_sql(
+        'CREATE TRIGGER `{table}_online_upd` AFTER UPDATE ON `{table}` '
+        'FOR EACH ROW BEGIN '
+        'DELETE IGNORE FROM `{shadow}` WHERE `{pk}` = OLD.`{pk}`; '
+        'REPLACE INTO `{shadow}` ({columns}) VALUES ({values}); '
+        'END;'.format(table=table, shadow=shadow, pk=pk, columns=columns,
+                      values=new_values))
+    db.execute_sql(
+        'CREATE TRIGGER `{table}_online_del` AFTER DELETE ON `{table}` '
+        'FOR EACH ROW DELETE IGNORE FROM `{shadow}` '
+        'WHERE `{pk}` = OLD.`{pk}`;'.format(table=table, shadow=shadow,
+                                            pk=pk))
+
+    # Rows written by the triggers are newer than the copied ones, hence
+    # INSERT IGNORE.
+    copy_sql = ('INSERT IGNORE INTO `{shadow}` ({columns}) '
+                'SELECT {columns} FROM `{table}` '
+                'WHERE `{pk}` {{}} %s AND `{pk}` <= %s '
+                'LOCK IN SHARE MODE;').format(shadow=shadow, table=table,
+                                              columns=columns, pk=pk)
+    bound_sql = ('SELECT `{pk}` FROM `{table}` WHERE `{pk}` > %s '
+                 'ORDER BY `{pk}` LIMIT 1 OFFSET %s;').format(table=table,
+                                                              pk=pk)
+    chunk_size = args.db_cleanup_chunk_size
+    num_rows = 0
+    last_pk = db.execute_sql('SELECT MIN(`{}`) FROM `{}`;'.format(
+        pk, table)).fetchone()[0]
+    max_pk = db.execute_sql('SELECT MAX(`{}`) FROM `{}`;'.format(
+        pk, table)).fetchone()[0]
+    if last_pk is not None:
+        # The first chunk includes the smallest key.
+        num_rows += db.execute_sql(copy_sql.format('>='),
+                                   (last_pk, last_pk)).rowcount
+
+    while last_pk is not None and last_pk < max_pk:
+        chunk_timer = default_timer()
+        row = db.execute_sql(bound_sql, (last_pk, chunk_size - 1)).fetchone()
+        upper_pk = row[0] if row else max_pk
+        num_rows += db.execute_sql(copy_sql.format('>'),
+                                   (last_pk, upper_pk)).rowcount
+        last_pk = upper_pk
+        log.debug('Copied %d rows of table %s.', num_rows, table)
+
+        # Leave the database half of its time for everything else.
+        time.sleep(default_timer() - chunk_timer)
+
+    db.execute_sql('RENAME TABLE `{table}` TO `{old}`, `{shadow}` TO '
+                   '`{table}`;'.format(table=table, old=old, shadow=shadow))
+    drop_online_migration_triggers(db, table)
+    db.execute_sql('DROP TABLE `{}`;'.format(old))
+    log.info('Migrated %d rows of table %s online.', num_rows, table)
+
+
+def drop_online_migration_triggers(db, table):
+    for action in ('ins', 'upd', 'del'):
+        db.execute_sql('DROP TRIGGER IF EXISTS `{}_online_{}`;'.format(
+            table, action))
+
+
+# Indexes added to the shadow table are named after it. Rename them while
+# it's still empty, so they keep their usual names after the swap.
+def rename_shadow_indexes(db, shadow, table):
+    columns = [c.name for c in db.get_columns(shadow)]
+    alter = []
+    for name, (unique, index_columns) in get_column_indexes(
+            db, shadow, columns).iteritems():
+        if name.startswith(shadow):
+            alter.append('DROP INDEX `{}`'.format(name))
+            alter.append('ADD {}INDEX `{}` ({})'.format(
+                'UNIQUE ' if unique else '', table + name[len(shadow):],
+                ', '.join('`{}`'.format(c) for c in index_columns)))
+    if alter:
+        db.execute_sql('ALTER TABLE `{}` {};'.format(shadow,
+                                                     ', '.join(alter)))
+
+
 def database_migrate(db, old_ver):
     # Update database schema version.
     Versions.update(val=db_schema_version).where(
@@ -3179,7 +4384,10 @@ def database_migrate(db, old_ver):
              old_ver, db_schema_version)
 
     # Perform migrations here.
-    migrator = MySQLMigrator(db)
+    if is_postgres(db):
+        migrator = PostgresqlMigrator(db)
+    else:
+        migrator = MySQLMigrator(db)
 
     if old_ver < 20:
         migrate(
@@ -3340,6 +4548,21 @@ def database_migrate(db, old_ver):
             'MODIFY COLUMN `peak` INTEGER;'
         )
 
+    if old_ver < 31:
+        migrate_table(db, migrator, 'spawnpointdetectiondata', lambda t: [
+            migrator.add_index(t, ('scan_time',), False)])
+
+    if old_ver < 32:
+        for model in (Pokemon, Pokestop, Gym, ScannedLocation, SpawnPoint):
+            table = model._meta.db_table
+            columns = [c.name for c in db.get_columns(table)]
+            if 's2_cell_id' not in columns:
+                migrate_table(db, migrator, table, lambda t: [
+                    migrator.add_column(t, 's2_cell_id',
+                                        UBigIntegerField(null=True)),
+                    migrator.add_index(t, ('s2_cell_id',), False)])
+            backfill_s2_cell_ids(db, model)
+
     # Always log that we're done.
     log.info('Schema upgrade complete.')
     return True
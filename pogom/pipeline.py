@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from threading import Thread
+from queue import Queue
+from timeit import default_timer
+
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+# A stage of the scan pipeline: a bounded queue of jobs and the threads
+# handling them. Putting a job blocks while the queue is full, so a slow stage
+# holds back the stage before it instead of piling up scans in memory. With no
+# threads, jobs are handled right away in the thread putting them.
+#
+# Metrics per stage: `pipeline.<name>` (time spent handling a job),
+# `pipeline.<name>.wait` (time a job spent in the queue),
+# `pipeline.<name>.blocked` (time spent waiting for room in a full queue) and
+# the `pipeline.<name>.queue` size.
+class PipelineStage(object):
+
+    def __init__(self, name, handler, threads=0, maxsize=0):
+        self.name = name
+        self.handler = handler
+        self.queue = Queue(maxsize=maxsize)
+
+        for i in range(threads):
+            t = Thread(target=self.run, name='{}-{}'.format(name, i))
+            t.daemon = True
+            t.start()
+        self.threaded = threads > 0
+
+    def put(self, job):
+        if not self.threaded:
+            self.handle(job)
+            return
+
+        start = default_timer()
+        self.queue.put((default_timer(), job))
+        self.observe('blocked', default_timer() - start)
+        metrics.set('pipeline.{}.queue'.format(self.name), self.queue.qsize())
+
+    def run(self):
+        while True:
+            queued, job = self.queue.get()
+            self.observe('wait', default_timer() - queued)
+            self.handle(job)
+            self.queue.task_done()
+            del job
+
+    def handle(self, job):
+        start = default_timer()
+        try:
+            self.handler(job)
+        except Exception as e:
+            log.exception('Exception in pipeline stage %s: %s', self.name,
+                          repr(e))
+        metrics.observe('pipeline.' + self.name, default_timer() - start)
+
+    def observe(self, timer, seconds):
+        metrics.observe('pipeline.{}.{}'.format(self.name, timer), seconds)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import gzip
+import struct
+import logging
+import calendar
+
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# Lengths of the metadata and the response of a record.
+record_header = struct.Struct('<II')
+# Number of responses per segment file.
+segment_size = 1000
+
+# Recorder of --record-responses, if enabled.
+recorder = None
+
+
+# Saves GET_MAP_OBJECTS responses with the metadata of their scan to gzipped
+# segment files, for tools/replay_responses.py. A record is its header, the
+# metadata as JSON and the serialized response.
+class ResponseRecorder(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segment = None
+        self.records = 0
+        self.lock = Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, response, scan_coords, scan_date, level):
+        metadata = json.dumps({
+            'latitude': scan_coords[0],
+            'longitude': scan_coords[1],
+            'altitude': scan_coords[2] if len(scan_coords) > 2 else 0,
+            'scan_date': calendar.timegm(scan_date.timetuple()) +
+            scan_date.microsecond / 1e6,
+            'recorded': calendar.timegm(datetime.utcnow().timetuple()),
+            'level': level
+        })
+        data = response.SerializeToString()
+
+        with self.lock:
+            if self.segment is None or self.records >= segment_size:
+                self.next_segment()
+            self.segment.write(record_header.pack(len(metadata), len(data)))
+            self.segment.write(metadata)
+            self.segment.write(data)
+            # Keep complete records readable if we're killed.
+            self.segment.flush()
+            self.records += 1
+
+    def next_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        name = 'responses-{}.gz'.format(
+            datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f'))
+        self.segment = gzip.open(os.path.join(self.directory, name), 'wb')
+        self.records = 0
+        log.debug('Started response segment %s.', name)
+
+
+def start_recorder(directory):
+    global recorder
+    recorder = ResponseRecorder(directory)
+
+
+# Record a GET_MAP_OBJECTS response of a scan.
+def record_response(response_dict, scan_coords, scan_date, account):
+    response = response_dict['responses'].get('GET_MAP_OBJECTS', None)
+    if response is not None:
+        recorder.record(response, scan_coords, scan_date, account['level'])
+
+
+# Yields (metadata dict, serialized response) of all records in the segment
+# files, in order. A segment cut short ends at its last complete record.
+def read_segments(paths):
+    for path in paths:
+        segment = gzip.open(path, 'rb')
+        try:
+            while True:
+                try:
+                    header = segment.read(record_header.size)
+                    if len(header) < record_header.size:
+                        break
+                    metadata_len, data_len = record_header.unpack(header)
+                    metadata = segment.read(metadata_len)
+                    data = segment.read(data_len)
+                except IOError:
+                    log.warning('Segment %s is incomplete.', path)
+                    break
+                if len(data) < data_len:
+                    log.warning('Segment %s is incomplete.', path)
+                    break
+                yield json.loads(metadata), data
+        finally:
+            segment.close()
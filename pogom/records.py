@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import calendar
+
+from .utils import calc_pokemon_level
+
+
+def epoch(dt):
+    return calendar.timegm(dt.timetuple()) if dt is not None else None
+
+
+# A row parse_map queues for the database and, as the very same object, for
+# webhooks. The values are kept in slots instead of a dict per row plus a
+# copy per webhook message; the webhook payload is only built by the webhook
+# thread, for messages that actually get sent.
+#
+# For the database it reads like a dict of the `fields` that were set, so
+# peewee and bulk_upsert take it as is and fill in the defaults of fields
+# that weren't. The other slots only hold what webhooks need on top of that.
+class Record(object):
+    __slots__ = ()
+    # Database fields, in order.
+    fields = ()
+
+    def __init__(self, **values):
+        for name, value in values.iteritems():
+            setattr(self, name, value)
+
+    def __iter__(self):
+        for name in self.fields:
+            if hasattr(self, name):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, name):
+        return name in self.fields and hasattr(self, name)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, dict(self.items()))
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self]
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def update(self, values):
+        for name, value in values.iteritems():
+            setattr(self, name, value)
+
+
+class PokemonRecord(Record):
+    fields = (
+        'encounter_id', 'spawnpoint_id', 'pokemon_id', 'latitude',
+        'longitude', 's2_cell_id', 'disappear_time', 'individual_attack',
+        'individual_defense', 'individual_stamina', 'move_1', 'move_2', 'cp',
+        'cp_multiplier', 'weight', 'height', 'gender', 'costume', 'form',
+        'weather_boosted_condition', 'last_modified')
+    __slots__ = fields + (
+        'last_modified_time', 'time_until_hidden_ms', 'verified',
+        'seconds_until_despawn', 'spawn_start', 'spawn_end', 'player_level')
+
+    @property
+    def pokemon_level(self):
+        if self.cp_multiplier is None:
+            return None
+        return calc_pokemon_level(self.cp_multiplier)
+
+    def webhook(self):
+        message = {
+            'encounter_id': self.encounter_id,
+            'spawnpoint_id': self.spawnpoint_id,
+            'pokemon_id': self.pokemon_id,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'disappear_time': epoch(self.disappear_time),
+            'individual_attack': self.individual_attack,
+            'individual_defense': self.individual_defense,
+            'individual_stamina': self.individual_stamina,
+            'move_1': self.move_1,
+            'move_2': self.move_2,
+            'cp': self.cp,
+            'cp_multiplier': self.cp_multiplier,
+            'height': self.height,
+            'weight': self.weight,
+            'gender': self.gender,
+            'costume': self.costume,
+            'form': self.form,
+            'weather_boosted_condition': self.weather_boosted_condition,
+            'last_modified_time': self.last_modified_time,
+            'time_until_hidden_ms': self.time_until_hidden_ms,
+            'verified': self.verified,
+            'seconds_until_despawn': self.seconds_until_despawn,
+            'spawn_start': self.spawn_start,
+            'spawn_end': self.spawn_end,
+            'player_level': self.player_level
+        }
+        if self.cp_multiplier is not None:
+            message['pokemon_level'] = self.pokemon_level
+        return message
+
+
+class PokestopRecord(Record):
+    fields = ('pokestop_id', 'enabled', 'latitude', 'longitude', 's2_cell_id',
+              'last_modified', 'lure_expiration', 'active_fort_modifier',
+              'last_updated')
+    # Last modified time in ms as sent by the API.
+    __slots__ = fields + ('last_modified_ms',)
+
+    def webhook(self):
+        return {
+            'pokestop_id': self.pokestop_id,
+            'enabled': self.enabled,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'last_modified': self.last_modified_ms,
+            'lure_expiration': epoch(self.lure_expiration),
+            'active_fort_modifier': self.active_fort_modifier
+        }
+
+
+class GymRecord(Record):
+    fields = ('gym_id', 'team_id', 'guard_pokemon_id', 'slots_available',
+              'enabled', 'park', 'latitude', 'longitude', 's2_cell_id',
+              'total_cp', 'last_modified', 'last_scanned')
+    __slots__ = fields + ('last_modified_ms', 'lowest_pokemon_motivation',
+                          'occupied_since', 'raid_active_until')
+
+    def webhook(self):
+        return {
+            'gym_id': str(self.gym_id),
+            'team_id': self.team_id,
+            'park': self.park,
+            'guard_pokemon_id': self.guard_pokemon_id,
+            'slots_available': self.slots_available,
+            'total_cp': self.total_cp,
+            'enabled': self.enabled,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'lowest_pokemon_motivation': self.lowest_pokemon_motivation,
+            'occupied_since': self.occupied_since,
+            'last_modified': self.last_modified_ms,
+            'raid_active_until': self.raid_active_until
+        }
+
+
+class RaidRecord(Record):
+    fields = ('gym_id', 'level', 'spawn', 'start', 'end', 'pokemon_id', 'cp',
+              'move_1', 'move_2', 'last_scanned')
+    # Of the gym, for webhooks.
+    __slots__ = fields + ('team_id', 'latitude', 'longitude')
+
+    def webhook(self):
+        return {
+            'gym_id': str(self.gym_id),
+            'team_id': self.team_id,
+            'level': self.level,
+            'spawn': epoch(self.spawn),
+            'start': epoch(self.start),
+            'end': epoch(self.end),
+            'pokemon_id': self.pokemon_id,
+            'cp': self.cp,
+            'move_1': self.move_1,
+            'move_2': self.move_2,
+            'latitude': self.latitude,
+            'longitude': self.longitude
+        }
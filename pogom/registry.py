@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+# In-process copy of the scanned locations, spawnpoints and links between
+# them of the hives scanned by this instance. It's loaded when a hive's
+# location changes and updated with the results of every parse, so the
+# scanner and scheduler don't have to read back what they just queued for
+# the database. The database only gets the writes, through the db updates
+# queue as before.
+#
+# Rows are handed out and taken in as copies: the scanner modifies them while
+# parsing and the db updater adds fields while writing them.
+class SpawnRegistry(object):
+
+    def __init__(self):
+        # Cell id -> scanned location dict.
+        self.scans = {}
+        # Spawnpoint id -> spawnpoint dict.
+        self.spawn_points = {}
+        # Cell id -> set of linked spawnpoint ids.
+        self.links = {}
+        # Owner (a scheduler) -> set of cell ids it loaded.
+        self.owners = {}
+        self.lock = Lock()
+
+    # Replace the cells of `owner` with the given scanned locations
+    # ({cell id: dict}), spawnpoints ({id: dict}) and links ({cell id:
+    # iterable of spawnpoint ids}).
+    def load(self, owner, scans, spawn_points, links):
+        with self.lock:
+            self.owners[owner] = set(scans)
+            owned = set().union(*self.owners.values())
+            for cell in self.scans.keys():
+                if cell not in owned:
+                    del self.scans[cell]
+                    self.links.pop(cell, None)
+
+            for cell, scan in scans.iteritems():
+                self.scans[cell] = dict(scan)
+                self.links[cell] = set(links.get(cell, ()))
+            for sp_id, sp in spawn_points.iteritems():
+                self.spawn_points[sp_id] = dict(sp)
+
+            linked = set().union(*self.links.values()) if self.links else ()
+            for sp_id in self.spawn_points.keys():
+                if sp_id not in linked:
+                    del self.spawn_points[sp_id]
+
+        log.info('Registry holds %d scanned locations and %d spawnpoints.',
+                 len(self.scans), len(self.spawn_points))
+
+    def has_cell(self, cell):
+        return cell in self.scans
+
+    def has_cells(self, cells):
+        with self.lock:
+            return bool(cells) and all(c in self.scans for c in cells)
+
+    def get_scan(self, cell):
+        with self.lock:
+            scan = self.scans.get(cell, None)
+            return dict(scan) if scan else None
+
+    def get_scans(self, cells):
+        with self.lock:
+            return dict((cell, dict(self.scans[cell])) for cell in cells
+                        if cell in self.scans)
+
+    # {id: spawnpoint dict} of the given ids that are known.
+    def get_spawn_points(self, sp_ids):
+        with self.lock:
+            return dict((sp_id, dict(self.spawn_points[sp_id]))
+                        for sp_id in sp_ids if sp_id in self.spawn_points)
+
+    def linked_spawn_points(self, cell):
+        with self.lock:
+            return [dict(self.spawn_points[sp_id])
+                    for sp_id in self.links.get(cell, ())
+                    if sp_id in self.spawn_points]
+
+    # Spawnpoints linked to the given cells, each assigned to only one of
+    # them (the highest cell id, as overlapping locations share spawnpoints).
+    # Returns {cell id: [spawnpoint dicts]}.
+    def cell_to_linked_spawn_points(self, cells):
+        cell_of = {}
+        with self.lock:
+            for cell in cells:
+                for sp_id in self.links.get(cell, ()):
+                    if sp_id in self.spawn_points:
+                        cell_of[sp_id] = max(cell, cell_of.get(sp_id, cell))
+
+            result = {}
+            for sp_id, cell in cell_of.iteritems():
+                result.setdefault(cell, []).append(
+                    dict(self.spawn_points[sp_id]))
+        return result
+
+    # Write back the results of a parse: the scanned location, {id:
+    # spawnpoint dict} and links {key: {'spawnpoint': id, 'scannedlocation':
+    # cell id}}.
+    def update(self, scan=None, spawn_points=None, links=None):
+        with self.lock:
+            if scan and scan['cellid'] in self.scans:
+                self.scans[scan['cellid']] = dict(scan)
+            # New spawnpoints are only kept when linked to one of our cells.
+            linked = set()
+            for link in (links or {}).itervalues():
+                cell = link['scannedlocation']
+                if cell in self.links:
+                    self.links[cell].add(link['spawnpoint'])
+                    linked.add(link['spawnpoint'])
+            for sp_id, sp in (spawn_points or {}).iteritems():
+                if sp_id in self.spawn_points or sp_id in linked:
+                    self.spawn_points[sp_id] = dict(sp)
@@ -581,6 +581,9 @@ class SpeedScan(HexSearch):
         else:
             log.info('Spawn points assigned')
 
+        ScannedLocation.load_registry(self, initial, spawnpoints,
+                                      scan_spawn_point)
+
     # Generates the list of locations to scan
     # Created a new function, because speed scan requires fixed locations,
     # even when increasing -st. With HexSearch locations, the location of
@@ -28,7 +28,6 @@ import requests
 import schedulers
 import terminalsize
 import timeit
-import threading
 
 from datetime import datetime
 from threading import Thread, Lock
@@ -38,23 +37,29 @@ from collections import deque
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from distutils.version import StrictVersion
-from cachetools import TTLCache
 
 from pgoapi.hash_server import HashServer
-from .models import (parse_map, GymDetails, parse_gyms, MainWorker,
+from .models import (parse_map, encounter_queued, GymDetails, parse_gyms,
                      WorkerStatus, HashKeys, ScannedLocation)
 from .utils import now, distance
 from .transform import get_new_coords
-from .account import setup_api, check_login, AccountSet
+from .account import setup_api, login_steps, AccountSet
 from .captcha import captcha_overseer_thread, handle_captcha
 from .proxy import get_new_proxy
 from .apiRequests import gym_get_info, get_map_objects as gmo
+from .recorder import record_response
+from .pipeline import PipelineStage
+from .gymqueue import GymDetailQueue
+from .engine import CoroutineEngine
+from .metrics import metrics
 from .transform import jitter_location
+from .workerstatus import worker_status_table
 
 log = logging.getLogger(__name__)
 
 loginDelayLock = Lock()
-gym_cache_lock = threading.Lock()
+# Time after which the next account may log in.
+next_login_time = 0
 
 
 # Thread to handle user input.
@@ -299,10 +304,11 @@ def account_recycler(args, accounts_queue, account_failures):
                     a['notified'] = True
 
 
-def worker_status_db_thread(threads_status, name, db_updates_queue):
+def worker_status_db_thread(threads_status, name, db_updates_queue,
+                            flush_interval):
+    last_flush = 0
 
     while True:
-        workers = {}
         overseer = None
         for status in threads_status.values():
             if status['type'] == 'Overseer':
@@ -323,11 +329,16 @@ def worker_status_db_thread(threads_status, name, db_updates_queue):
                     'elapsed': status['elapsed']
                 }
             elif status['type'] == 'Worker':
-                workers[status['username']] = WorkerStatus.db_format(
-                    status, name)
+                worker_status_table.update(
+                    WorkerStatus.db_format(status, name))
         if overseer is not None:
-            db_updates_queue.put((MainWorker, {0: overseer}))
-            db_updates_queue.put((WorkerStatus, workers))
+            worker_status_table.update_main(overseer)
+
+            # Only the latest row of each worker reaches the database, in one
+            # batch per table.
+            if time.time() - last_flush >= flush_interval:
+                worker_status_table.flush(db_updates_queue)
+                last_flush = time.time()
         time.sleep(3)
 
 
@@ -346,10 +357,10 @@ def search_overseer_thread(args, new_location_queue, control_flags, heartb,
     api_check_time = 0
     hashkeys_last_upsert = timeit.default_timer()
     hashkeys_upsert_min_delay = 5.0
-    gym_cache = None
+    gym_queue = None
 
     if args.gym_info:
-        gym_cache = TTLCache(maxsize=10000, ttl=60)
+        gym_queue = GymDetailQueue(GymDetails.get_last_scanned)
 
     '''
     Create a queue of accounts for workers to pull from. When a worker has
@@ -429,10 +440,37 @@ def search_overseer_thread(args, new_location_queue, control_flags, heartb,
         log.info('Starting status database thread...')
         t = Thread(target=worker_status_db_thread,
                    name='status_worker_db',
-                   args=(threadStatus, args.status_name, db_updates_queue))
+                   args=(threadStatus, args.status_name, db_updates_queue,
+                         args.worker_status_interval))
         t.daemon = True
         t.start()
 
+    # Encounters with the L30 pool, queued while parsing.
+    encounter_stage = None
+    if args.encounter and args.encounter_threads:
+        log.info('Starting %d encounter threads...', args.encounter_threads)
+        encounter_stage = PipelineStage('encounter', encounter_queued,
+                                        args.encounter_threads)
+
+    # Parsing sleeps for encounters and logs their accounts in, which must
+    # not hold the threads of the worker engine: coroutines always hand their
+    # scans to parse threads.
+    if args.worker_engine == 'coroutines' and not args.parse_threads:
+        args.parse_threads = args.engine_threads
+
+    # Parse stage of the scan pipeline, the search workers being the request
+    # stage and the db updater and webhook threads the persistence stage.
+    if args.parse_threads:
+        log.info('Starting %d parse threads...', args.parse_threads)
+    parse_stage = PipelineStage('parse', parse_scan, args.parse_threads,
+                                args.parse_queue_size)
+
+    engine = None
+    if args.worker_engine == 'coroutines':
+        log.info('Starting worker engine with %d threads...',
+                 args.engine_threads)
+        engine = CoroutineEngine(args.engine_threads)
+
     # Create specified number of search_worker_thread.
     log.info('Starting search worker threads...')
     log.info('Configured scheduler is %s.', args.scheduler)
@@ -469,7 +507,12 @@ def search_overseer_thread(args, new_location_queue, control_flags, heartb,
         argset = (
             args, account_queue, account_sets, account_failures,
             account_captchas, control_flags, threadStatus[workerId],
-            db_updates_queue, wh_queue, scheduler, key_scheduler, gym_cache)
+            db_updates_queue, wh_queue, scheduler, key_scheduler, gym_queue,
+            parse_stage, encounter_stage)
+
+        if engine:
+            engine.spawn(search_worker(*argset), 'search-worker-{}'.format(i))
+            continue
 
         t = Thread(target=search_worker_thread,
                    name='search-worker-{}'.format(i),
@@ -781,9 +824,18 @@ def generate_hive_locations(current_location, step_distance,
     return results
 
 
-def search_worker_thread(args, account_queue, account_sets, account_failures,
-                         account_captchas, control_flags, status, dbq, whq,
-                         scheduler, key_scheduler, gym_cache):
+# Runs a search worker in a thread of its own, sleeping whenever it yields.
+def search_worker_thread(*worker_args):
+    for delay in search_worker(*worker_args):
+        time.sleep(delay)
+
+
+# The search worker. Instead of sleeping it yields the number of seconds to
+# sleep, so that it can also run as a coroutine of the worker engine.
+def search_worker(args, account_queue, account_sets, account_failures,
+                  account_captchas, control_flags, status, dbq, whq,
+                  scheduler, key_scheduler, gym_queue, parse_stage,
+                  encounter_stage):
 
     log.debug('Search worker thread starting...')
 
@@ -795,7 +847,7 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
         try:
             # Force storing of previous worker info to keep consistency.
             if 'starttime' in status:
-                dbq.put((WorkerStatus, {0: WorkerStatus.db_format(status)}))
+                worker_status_table.update(WorkerStatus.db_format(status))
 
             status['starttime'] = now()
             status['active'] = False
@@ -805,17 +857,24 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
 
             # Make sure the scheduler is done for valid locations.
             while not scheduler.ready:
-                time.sleep(1)
+                yield 1
 
             status['message'] = ('Waiting to get new account from the'
                                  + ' queue...')
             log.info(status['message'])
 
             # Get an account.
-            stagger_thread(args)
-            account = account_queue.get()
+            yield stagger_delay(args)
+            while True:
+                try:
+                    account = account_queue.get_nowait()
+                    break
+                except Empty:
+                    yield 1
             # Reset account statistics tracked per loop.
-            prevStatus = WorkerStatus.get_worker(account['username'])
+            prevStatus = (
+                worker_status_table.get_worker(account['username']) or
+                WorkerStatus.get_worker(account['username']))
             if prevStatus:
                 status.update(prevStatus)
             else:
@@ -845,25 +904,25 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
             })
             log.info(status['message'])
 
-            # Sleep when consecutive_fails reaches max_failures, overall fails
-            # for stat purposes.
-            consecutive_fails = 0
-
-            # Sleep when consecutive_noitems reaches max_empty, overall noitems
-            # for stat purposes.
-            consecutive_noitems = 0
+            # Sleep when consecutive fails reach max_failures and consecutive
+            # noitems reach max_empty, overall fails and noitems for stat
+            # purposes. Counted by the parse stage as well.
+            counters = {'fails': 0, 'noitems': 0}
 
             api = setup_api(args, status, account)
+            api_lock = Lock()
+            # Where this account made its last request.
+            last_coords = None
 
             # The forever loop for the searches.
             while True:
                 while is_paused(control_flags):
                     status['message'] = 'Scanning paused.'
-                    time.sleep(2)
+                    yield 2
 
                 # If this account has been messing up too hard, let it rest.
                 if ((args.max_failures > 0) and
-                        (consecutive_fails >= args.max_failures)):
+                        (counters['fails'] >= args.max_failures)):
                     status['message'] = (
                         'Account {} failed more than {} scans; possibly bad ' +
                         'account. Switching accounts...').format(
@@ -880,7 +939,7 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                 # If this account has not found anything for too long, let it
                 # rest.
                 if ((args.max_empty > 0) and
-                        (consecutive_noitems >= args.max_empty)):
+                        (counters['noitems'] >= args.max_empty)):
                     status['message'] = (
                         'Account {} returned empty scan for more than {} ' +
                         'scans; possibly ip is banned. Switching ' +
@@ -930,11 +989,16 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                 # The next_item will return the value telling us how long
                 # to sleep. This way the status can be updated.
                 if wait > 0:
-                    time.sleep(wait)
+                    yield wait
 
                 # Using step as a flag for no valid next location returned.
+                # Use the time for gym details, if there are any near.
                 if step == -1:
-                    time.sleep(scheduler.delay(status['last_scan_date']))
+                    for delay in sleep_getting_gyms(
+                            args, scheduler.delay(status['last_scan_date']),
+                            last_coords, status, api, api_lock, account,
+                            gym_queue, dbq, whq):
+                        yield delay
                     continue
 
                 # get the ScannedLocation before jittering
@@ -959,7 +1023,7 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                         if first_loop:
                             log.info(status['message'])
                             first_loop = False
-                        time.sleep(1)
+                        yield 1
                     if paused:
                         scheduler.task_done(status)
                         continue
@@ -977,205 +1041,111 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                 status['message'] = messages['search']
                 log.debug(status['message'])
 
-                # Let the api know where we intend to be for this loop.
-                # Doing this before check_login so it does not also have
-                # to be done when the auth token is refreshed.
-                api.set_position(*scan_coords)
-
                 if args.hash_key:
                     key = key_scheduler.next()
                     log.debug('Using key {} for this scan.'.format(key))
-                    api.activate_hash_server(key)
+
+                # The parse stage can make requests with this account too,
+                # so they take turns on the API. The lock is only held while
+                # making requests, not while waiting between them, so let
+                # the api know where we intend to be every time we take it.
 
                 # Ok, let's get started -- check our login status.
                 status['message'] = 'Logging in...'
-                check_login(args, account, api, status['proxy_url'])
+                login = login_steps(args, account, api, status['proxy_url'])
+                while True:
+                    with api_lock:
+                        api.set_position(*scan_coords)
+                        if args.hash_key:
+                            api.activate_hash_server(key)
+                        delay = next(login, None)
+                    if delay is None:
+                        break
+                    yield delay
 
                 # Only run this when it's the account's first login, after
                 # check_login().
                 if first_login:
                     first_login = False
 
-                # Putting this message after the check_login so the messages
-                # aren't out of order.
-                status['message'] = messages['search']
-                log.info(status['message'])
-
-                # Make the actual request.
-                scan_date = datetime.utcnow()
-                response_dict = gmo(api, account, scan_coords)
-                status['last_scan_date'] = datetime.utcnow()
+                with api_lock:
+                    api.set_position(*scan_coords)
+                    if args.hash_key:
+                        api.activate_hash_server(key)
 
-                # Record the time and the place that the worker made the
-                # request.
-                status['latitude'] = scan_coords[0]
-                status['longitude'] = scan_coords[1]
-                dbq.put((WorkerStatus, {0: WorkerStatus.db_format(status)}))
-
-                # Nothing back. Mark it up, sleep, carry on.
-                if not response_dict:
-                    status['fail'] += 1
-                    consecutive_fails += 1
-                    status['message'] = messages['invalid']
-                    log.error(status['message'])
-                    time.sleep(scheduler.delay(status['last_scan_date']))
-                    continue
+                    # Putting this message after the check_login so the
+                    # messages aren't out of order.
+                    status['message'] = messages['search']
+                    log.info(status['message'])
 
-                # Got the response, check for captcha, parse it out, then send
-                # todo's to db/wh queues.
-                try:
-                    captcha = handle_captcha(args, status, api, account,
-                                             account_failures,
-                                             account_captchas, whq,
-                                             response_dict, scan_coords)
+                    # Make the actual request.
+                    scan_date = datetime.utcnow()
+                    response_dict = gmo(api, account, scan_coords)
+                    status['last_scan_date'] = datetime.utcnow()
+                    last_coords = scan_coords
+                    metrics.observe('pipeline.request', (
+                        status['last_scan_date'] - scan_date).total_seconds())
+
+                    # Record the time and the place that the worker made the
+                    # request.
+                    status['latitude'] = scan_coords[0]
+                    status['longitude'] = scan_coords[1]
+                    worker_status_table.update(WorkerStatus.db_format(status))
+
+                    # Got the response, check for captcha.
+                    captcha = None
+                    if response_dict:
+                        captcha = handle_captcha(args, status, api, account,
+                                                 account_failures,
+                                                 account_captchas, whq,
+                                                 response_dict, scan_coords)
                     if captcha is not None and captcha:
                         # Make another request for the same location
                         # since the previous one was captcha'd.
                         scan_date = datetime.utcnow()
                         response_dict = gmo(api, account, scan_coords)
-                    elif captcha is not None:
-                        account_queue.task_done()
-                        time.sleep(3)
-                        break
 
-                    parsed = parse_map(args, response_dict, scan_coords,
-                                       scan_location, dbq, whq, key_scheduler,
-                                       api, status, scan_date, account,
-                                       account_sets)
-
-                    scheduler.task_done(status, parsed)
-                    if parsed['count'] > 0:
-                        status['success'] += 1
-                        consecutive_noitems = 0
-                    else:
-                        status['noitems'] += 1
-                        consecutive_noitems += 1
-                    consecutive_fails = 0
-                    status['message'] = ('Search at {:6f},{:6f} completed ' +
-                                         'with {} finds.').format(
-                        scan_coords[0], scan_coords[1],
-                        parsed['count'])
-                    log.debug(status['message'])
-                except Exception as e:
-                    parsed = False
-                    status['fail'] += 1
-                    consecutive_fails += 1
-                    # consecutive_noitems = 0 - I propose to leave noitems
-                    # counter in case of error.
-                    status['message'] = ('Map parse failed at {:6f},{:6f}, ' +
-                                         'abandoning location. {} may be ' +
-                                         'banned.').format(scan_coords[0],
-                                                           scan_coords[1],
-                                                           account['username'])
-                    log.exception('{}. Exception message: {}'.format(
-                        status['message'], repr(e)))
-                finally:
-                    if response_dict is not None:
-                        del response_dict
-
-                # Get detailed information about gyms.
-                if args.gym_info and parsed:
-                    # Build a list of gyms to update.
-                    gyms_to_update = {}
-                    for gym in parsed['gyms'].values():
-                        with gym_cache_lock:
-                            if gym['gym_id'] in gym_cache:
-                                log.debug(
-                                    ('Skipping update of gym @ %f/%f, ' +
-                                     'already in progress.'),
-                                    gym['latitude'], gym['longitude'])
-                                continue
-                            else:
-                                # Set the gym as in progress it will just be
-                                # locked for 60 seconds due to TTL eviction.
-                                gym_cache[gym['gym_id']] = True
-
-                        # Can only get gym details within 1km of our position.
-                        gym_distance = distance(
-                            scan_coords, [gym['latitude'], gym['longitude']])
-                        if gym_distance < 1000:
-                            # Check if we already have details on this gym.
-                            # Get them if not.
-                            try:
-                                record = GymDetails.get(gym_id=gym['gym_id'])
-                            except GymDetails.DoesNotExist:
-                                gyms_to_update[gym['gym_id']] = gym
-                                continue
-                            GymDetails.database().close()
-
-                            # If we have a record of this gym already, check if
-                            # the gym has been updated since our last update.
-                            if record.last_scanned < gym['last_modified']:
-                                gyms_to_update[gym['gym_id']] = gym
-                                continue
-                            else:
-                                log.debug(
-                                    ('Skipping update of gym @ %f/%f, ' +
-                                     'up to date.'),
-                                    gym['latitude'], gym['longitude'])
-                                continue
-                        else:
-                            log.debug(
-                                'Skipping update of gym @ %f/%f, too far ' +
-                                'away from our location at %f/%f (%.0fm).',
-                                gym['latitude'], gym['longitude'],
-                                scan_coords[0], scan_coords[1],
-                                gym_distance)
-
-                    if len(gyms_to_update):
-                        gym_responses = {}
-                        current_gym = 1
-                        status['message'] = (
-                            'Updating {} gyms for location {},{}...').format(
-                                len(gyms_to_update), scan_coords[0],
-                                scan_coords[1])
-                        log.debug(status['message'])
-
-                        for gym in gyms_to_update.values():
-                            time.sleep(random.random() + 2)
-                            status['message'] = (
-                                'Getting details for gym {} of {} for ' +
-                                'location {:6f},{:6f}...').format(
-                                    current_gym,
-                                    len(gyms_to_update), scan_coords[0],
-                                    scan_coords[1])
-                            log.info('Getting details for gym @ %f/%f ' +
-                                     '(%.0fm away)', gym['latitude'],
-                                     gym['longitude'],
-                                     distance(scan_coords, [
-                                         gym['latitude'], gym['longitude']
-                                     ]))
-
-                            response = gym_get_info(api, account,
-                                                    scan_coords, gym)
-
-                            # Make sure the gym was in range. (Sometimes the
-                            # API gets cranky about gyms that are ALMOST 1km
-                            # away.)
-                            if response['responses'][
-                                    'GYM_GET_INFO'].result == 2:
-                                log.warning(
-                                    'Gym @ %f/%f is out of range (%.0fm), ' +
-                                    'skipping.', gym['latitude'],
-                                    gym['longitude'], distance)
-                            else:
-                                gym_responses[gym['gym_id']] = response[
-                                    'responses']['GYM_GET_INFO']
-                            del response
-                            # Increment which gym we're on for status messages.
-                            current_gym += 1
+                if captcha is not None and not captcha:
+                    account_queue.task_done()
+                    yield 3
+                    break
 
-                        status['message'] = (
-                            'Processing details of {} gyms for location ' +
-                            '{:6f},{:6f}...').format(len(gyms_to_update),
-                                                     scan_coords[0],
-                                                     scan_coords[1])
-                        log.debug(status['message'])
+                # Nothing back. Mark it up, sleep, carry on.
+                if not response_dict:
+                    status['fail'] += 1
+                    counters['fails'] += 1
+                    status['message'] = messages['invalid']
+                    log.error(status['message'])
+                    yield scheduler.delay(status['last_scan_date'])
+                    continue
 
-                        if gym_responses:
-                            parse_gyms(args, gym_responses,
-                                       whq, dbq)
-                            del gym_responses
+                if args.record_responses:
+                    record_response(response_dict, scan_coords, scan_date,
+                                    account)
+
+                # Hand the response over to the parse stage.
+                parse_stage.put({
+                    'args': args,
+                    'response_dict': response_dict,
+                    'scan_coords': scan_coords,
+                    'scan_location': scan_location,
+                    'scan_date': scan_date,
+                    # Status as it was for this scan, for task_done().
+                    'scan_status': dict(status),
+                    'status': status,
+                    'counters': counters,
+                    'account': account,
+                    'account_sets': account_sets,
+                    'api': api,
+                    'api_lock': api_lock,
+                    'scheduler': scheduler,
+                    'key_scheduler': key_scheduler,
+                    'gym_queue': gym_queue,
+                    'encounter_stage': encounter_stage,
+                    'dbq': dbq,
+                    'whq': whq
+                })
+                del response_dict
 
                 # Update hashing key stats in the database based on the values
                 # reported back by the hashing server.
@@ -1218,10 +1188,13 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
                         '%H:%M:%S',
                         time.localtime(time.time() + args.scan_delay)))
                 log.debug(status['message'])
-                time.sleep(delay)
+                for delay in sleep_getting_gyms(args, delay, scan_coords,
+                                                status, api, api_lock,
+                                                account, gym_queue, dbq, whq):
+                    yield delay
 
         # Catch any process exceptions, log them, and continue the thread.
-        except Exception as e:
+        except Exception:
             log.exception(
                 'Exception in search_worker under account %s.',
                 account['username'])
@@ -1233,7 +1206,128 @@ def search_worker_thread(args, account_queue, account_sets, account_failures,
             account_failures.append({'account': account,
                                      'last_fail_time': now(),
                                      'reason': 'exception'})
-            time.sleep(args.scan_delay)
+            yield args.scan_delay
+
+
+# Parse stage of the scan pipeline: parse the map response of a scan done by
+# a search worker, then get the details of its gyms.
+def parse_scan(job):
+    args = job['args']
+    status = job['status']
+    counters = job['counters']
+    account = job['account']
+    scan_coords = job['scan_coords']
+    response_dict = job.pop('response_dict')
+
+    try:
+        parse_args = (args, response_dict, scan_coords, job['scan_location'],
+                      job['dbq'], job['whq'], job['key_scheduler'],
+                      job['api'], status, job['scan_date'], account,
+                      job['account_sets'], job['encounter_stage'])
+        # Encounters with our own L30 account and pokestop spins use the
+        # worker's API.
+        if args.pokestop_spinning or (args.encounter and
+                                      account['level'] >= 30):
+            with job['api_lock']:
+                parsed = parse_map(*parse_args)
+        else:
+            parsed = parse_map(*parse_args)
+
+        job['scheduler'].task_done(job['scan_status'], parsed)
+        if parsed['count'] > 0:
+            status['success'] += 1
+            counters['noitems'] = 0
+        else:
+            status['noitems'] += 1
+            counters['noitems'] += 1
+        counters['fails'] = 0
+        status['message'] = ('Search at {:6f},{:6f} completed ' +
+                             'with {} finds.').format(
+            scan_coords[0], scan_coords[1],
+            parsed['count'])
+        log.debug(status['message'])
+    except Exception as e:
+        parsed = False
+        status['fail'] += 1
+        counters['fails'] += 1
+        # counters['noitems'] = 0 - I propose to leave noitems
+        # counter in case of error.
+        status['message'] = ('Map parse failed at {:6f},{:6f}, ' +
+                             'abandoning location. {} may be ' +
+                             'banned.').format(scan_coords[0],
+                                               scan_coords[1],
+                                               account['username'])
+        log.exception('{}. Exception message: {}'.format(
+            status['message'], repr(e)))
+    finally:
+        del response_dict
+
+    metrics.set('pipeline.persist.queue', job['dbq'].qsize())
+    metrics.set('pipeline.webhook.queue', job['whq'].qsize())
+
+    # Queue the gyms that need their details updated.
+    if job['gym_queue'] and parsed:
+        job['gym_queue'].add(parsed['gyms'])
+
+
+# Sleep for `delay` seconds after a scan, getting the details of the most
+# stale queued gyms near `position` meanwhile. Yields the seconds to sleep,
+# like search_worker.
+def sleep_getting_gyms(args, delay, position, status, api, api_lock, account,
+                       gym_queue, dbq, whq):
+    wake = timeit.default_timer() + delay
+    gym_responses = {}
+    while gym_queue and position:
+        # Wait a bit before each request, as long as there's time for it.
+        pause = random.random() + 2
+        if timeit.default_timer() + pause + 1 > wake:
+            break
+        gym = gym_queue.take(position)
+        if gym is None:
+            break
+
+        yield pause
+        scanned = False
+        try:
+            gym_distance = distance(position,
+                                    [gym['latitude'], gym['longitude']])
+            status['message'] = (
+                'Getting details for gym {} for location ' +
+                '{:6f},{:6f}...').format(len(gym_responses) + 1,
+                                         position[0], position[1])
+            log.info('Getting details for gym @ %f/%f (%.0fm away)',
+                     gym['latitude'], gym['longitude'], gym_distance)
+
+            with api_lock:
+                api.set_position(*position)
+                response = gym_get_info(api, account, position, gym)
+
+            # Make sure the gym was in range. (Sometimes the API gets cranky
+            # about gyms that are ALMOST 1km away.)
+            if not response:
+                log.warning('Failed to get details of gym @ %f/%f.',
+                            gym['latitude'], gym['longitude'])
+            elif response['responses']['GYM_GET_INFO'].result == 2:
+                log.warning('Gym @ %f/%f is out of range (%.0fm), skipping.',
+                            gym['latitude'], gym['longitude'], gym_distance)
+            else:
+                gym_responses[gym['gym_id']] = response[
+                    'responses']['GYM_GET_INFO']
+                scanned = True
+            del response
+        finally:
+            gym_queue.done(gym, scanned)
+
+    if gym_responses:
+        status['message'] = (
+            'Processing details of {} gyms for location ' +
+            '{:6f},{:6f}...').format(len(gym_responses), position[0],
+                                     position[1])
+        log.debug(status['message'])
+        parse_gyms(args, gym_responses, whq, dbq)
+        del gym_responses
+
+    yield max(wake - timeit.default_timer(), 0)
 
 
 def upsertKeys(keys, key_scheduler, db_updates_queue):
@@ -1252,13 +1346,17 @@ def upsertKeys(keys, key_scheduler, db_updates_queue):
     db_updates_queue.put((HashKeys, hashkeys))
 
 
-# Delay each thread start time so that logins occur after delay.
-def stagger_thread(args):
-    loginDelayLock.acquire()
-    delay = args.login_delay + ((random.random() - .5) / 2)
-    log.debug('Delaying thread startup for %.2f seconds', delay)
-    time.sleep(delay)
-    loginDelayLock.release()
+# Delay each worker start time so that logins occur after delay. Returns the
+# seconds to wait.
+def stagger_delay(args):
+    global next_login_time
+    with loginDelayLock:
+        delay = args.login_delay + ((random.random() - .5) / 2)
+        current_time = timeit.default_timer()
+        next_login_time = max(next_login_time, current_time) + delay
+        delay = next_login_time - current_time
+    log.debug('Delaying worker startup for %.2f seconds', delay)
+    return delay
 
 
 # The delta from last stat to current stat
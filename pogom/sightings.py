@@ -0,0 +1,341 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import zlib
+import struct
+import logging
+import calendar
+
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+from .utils import clock_between
+
+log = logging.getLogger(__name__)
+
+# Number of most recent ranges kept for 60 minute spawns, over a year of
+# hourly scans.
+range_limit = 10000
+# Version, number of sightings, TTH (-1 if unknown), scan time in epoch
+# seconds and low 32 bits of the encounter id of the last sighting (0 if
+# none) and number of ranges.
+header = struct.Struct('<BHhIIH')
+# Start and end of a range, in seconds after the hour.
+range_entry = struct.Struct('<HH')
+# The first version kept a ring of the most recent sightings instead of
+# their ranges: the header ended with the ring length, followed by the scan
+# time and encounter id of each sighting.
+header_v1 = struct.Struct('<BHhB')
+ring_entry_v1 = struct.Struct('<II')
+
+
+# Summary of the sighting history of a spawnpoint, which is all spawnpoint
+# classification needs: the seconds after the hour the spawnpoint was seen
+# at with the gaps between them, the last TTH, and the ranges in which the
+# same encounter was (or wasn't) there for 60 minute spawns. Sightings have
+# to be added in the order of their scan time.
+#
+# Stored as a zlib compressed blob with a 3600 bit bitmap of the seen
+# seconds, instead of one row per sighting.
+class SightingSummary(object):
+
+    def __init__(self):
+        # Sorted seconds after the hour the spawnpoint was seen at.
+        self.seen = []
+        # Sorted (gap, start) of the gaps between consecutive seconds in
+        # `seen`, including the one wrapping around the hour.
+        self.gaps = []
+        self.count = 0
+        self.tth_secs = None
+        # (epoch seconds, encounter id hash) of the last sighting.
+        self.last = None
+        # (start, end) of the ranges between consecutive sightings, in order
+        # of scan time.
+        self.recent_ranges = deque(maxlen=range_limit)
+
+    def add(self, sighting):
+        scan_time = calendar.timegm(sighting['scan_time'].timetuple())
+        if not self.is_seen(scan_time % 3600):
+            self.insert(scan_time % 3600)
+        self.count += 1
+        if sighting['tth_secs'] is not None:
+            self.tth_secs = (sighting['tth_secs'] - 1) % 3600
+        self.add_last((scan_time, sighting['encounter_id'] & 0xffffffff))
+
+    def add_last(self, last):
+        if self.last:
+            sighting_range = between(self.last, last)
+            if sighting_range:
+                self.recent_ranges.append(sighting_range)
+        self.last = last
+
+    def is_seen(self, secs):
+        i = bisect_left(self.seen, secs)
+        return i < len(self.seen) and self.seen[i] == secs
+
+    # [start, end] ranges between consecutive sightings less than an hour
+    # apart, in order of scan time.
+    def ranges(self):
+        return [list(r) for r in self.recent_ranges]
+
+    # Add the sightings of a summary written by another instance sharing the
+    # database. How the two histories interleave is unknown, so this keeps
+    # the ranges of both, the first TTH, the larger count and the later last
+    # sighting. Merging the same summary again changes nothing.
+    def merge(self, other):
+        for secs in other.seen:
+            if not self.is_seen(secs):
+                self.insert(secs)
+        self.count = max(self.count, other.count)
+        if self.tth_secs is None:
+            self.tth_secs = other.tth_secs
+
+        ours = set(self.recent_ranges)
+        theirs = [r for r in other.recent_ranges if r not in ours]
+        if theirs:
+            self.recent_ranges = deque(theirs + list(self.recent_ranges),
+                                       maxlen=range_limit)
+
+        if other.last and (not self.last or other.last[0] > self.last[0]):
+            self.last = other.last
+
+    def dumps(self):
+        bitmap = bytearray(450)
+        for secs in self.seen:
+            bitmap[secs >> 3] |= 1 << (secs & 7)
+        last_time, last_id = self.last or (0, 0)
+        data = [header.pack(2, min(self.count, 0xffff),
+                            -1 if self.tth_secs is None else self.tth_secs,
+                            last_time, last_id, len(self.recent_ranges)),
+                str(bitmap)]
+        data.extend(range_entry.pack(*r) for r in self.recent_ranges)
+        return zlib.compress(''.join(data))
+
+    @staticmethod
+    def loads(data):
+        data = zlib.decompress(data)
+        summary = SightingSummary()
+        version = ord(data[0])
+        if version == 1:
+            _, summary.count, tth_secs, ring_len = header_v1.unpack_from(data)
+            offset = header_v1.size
+        else:
+            (_, summary.count, tth_secs, last_time, last_id,
+             num_ranges) = header.unpack_from(data)
+            offset = header.size
+            if last_time:
+                summary.last = (last_time, last_id)
+        summary.tth_secs = tth_secs if tth_secs >= 0 else None
+
+        bitmap = bytearray(data[offset:offset + 450])
+        for i, byte in enumerate(bitmap):
+            while byte:
+                bit = byte & -byte
+                summary.insert(i * 8 + bit.bit_length() - 1)
+                byte ^= bit
+        offset += 450
+
+        if version == 1:
+            for i in range(ring_len):
+                summary.add_last(ring_entry_v1.unpack_from(
+                    data, offset + i * ring_entry_v1.size))
+        else:
+            for i in range(num_ranges):
+                summary.recent_ranges.append(range_entry.unpack_from(
+                    data, offset + i * range_entry.size))
+        return summary
+
+    # Previous and next second around position `i` of `seen`, unwrapped so
+    # that previous <= next, and the second the gap between them starts at.
+    def neighbours(self, i, size):
+        start = self.seen[i - 1] if i > 0 else self.seen[-1]
+        previous = start if i > 0 else start - 3600
+        following = self.seen[i] if i < size else self.seen[0] + 3600
+        return previous, following, start
+
+    def insert(self, secs):
+        if not self.seen:
+            self.seen.append(secs)
+            self.gaps.append((3600, secs))
+            return
+
+        i = bisect_right(self.seen, secs)
+        previous, following, start = self.neighbours(i, len(self.seen))
+        self.remove_gap((following - previous, start))
+        insort(self.gaps, (secs - previous, start))
+        insort(self.gaps, (following - secs, secs))
+        self.seen.insert(i, secs)
+
+    def remove(self, secs):
+        i = bisect_left(self.seen, secs)
+        del self.seen[i]
+        if not self.seen:
+            del self.gaps[:]
+            return
+
+        previous, following, start = self.neighbours(i, len(self.seen))
+        self.remove_gap((secs - previous, start))
+        self.remove_gap((following - secs, secs))
+        insort(self.gaps, (following - previous, start))
+
+    def remove_gap(self, gap):
+        del self.gaps[bisect_left(self.gaps, gap)]
+
+    # Same as classifying from the full sighting history: updates kind,
+    # links, latest_seen and earliest_unseen of the spawnpoint dict.
+    def classify(self, sp, scan_loc, now_secs):
+        tth_found = self.tth_secs is not None
+
+        # To reduce CPU usage, give an intial reading of 15 minute spawns if
+        # not done with initial scan of location.
+        if not scan_loc['done']:
+            # We only want to reset a SP if it is new and not due the
+            # location changing (which creates new Scannedlocations)
+            if not tth_found:
+                sp['kind'] = 'hhhs'
+                if not sp['earliest_unseen']:
+                    sp['latest_seen'] = now_secs
+                    set_default_earliest_unseen(sp)
+
+                elif clock_between(sp['latest_seen'], now_secs,
+                                   sp['earliest_unseen']):
+                    sp['latest_seen'] = now_secs
+            return
+
+        # Make a record of links, so we can reset earliest_unseen
+        # if it changes.
+        old_kind = str(sp['kind'])
+        # Include the TTH in the gaps while classifying. Sightings at the
+        # same second add gaps of 0, which only count for the number of gaps.
+        num_gaps = self.count + tth_found
+        add_tth = tth_found and not self.is_seen(self.tth_secs)
+        if add_tth:
+            self.insert(self.tth_secs)
+        try:
+            # The largest gap, and the first second it starts at.
+            max_gap = self.gaps[-1][0]
+            latest_seen = self.gaps[bisect_left(self.gaps, (max_gap,))][1]
+            double_spawn = (num_gaps > 4 and len(self.gaps) > 1 and
+                            self.gaps[-2][0] > 900)
+        finally:
+            if add_tth:
+                self.remove(self.tth_secs)
+
+        # An hour minus the largest gap in minutes gives us the duration the
+        # spawn was there.  Round up to the nearest 15 minute interval for our
+        # current best guess duration.
+        duration = (int((60 - max_gap / 60.0) / 15) + 1) * 15
+
+        # If the second largest gap is larger than 15 minutes, then there are
+        # two gaps greater than 15 minutes.  It must be a double spawn.
+        if double_spawn:
+            sp['kind'] = 'hshs'
+        else:
+            # Convert the duration into a 'hhhs', 'hhss', 'hsss', 'ssss' string
+            # accordingly.  's' is for seen, 'h' is for hidden.
+            sp['kind'] = ''.join(
+                ['s' if i > (3 - duration / 15) else 'h' for i in range(0, 4)])
+
+        # Assume no hidden times.
+        sp['links'] = sp['kind'].replace('s', '?')
+
+        if sp['kind'] != 'ssss':
+            # Cover all bases, make sure we're using values < 3600.
+            # Warning: python uses modulo as the least residue, not as
+            # remainder, so we don't apply it to the result.
+            residue_unseen = sp['earliest_unseen'] % 3600
+            residue_seen = sp['latest_seen'] % 3600
+            if (not sp['earliest_unseen'] or
+                    residue_unseen != residue_seen or
+                    not tth_found):
+
+                # New latest_seen will be just before max_gap.
+                sp['latest_seen'] = latest_seen
+
+                # if we don't have a earliest_unseen yet or if the kind of
+                # spawn has changed, reset to latest_seen + 14 minutes.
+                if not sp['earliest_unseen'] or sp['kind'] != old_kind:
+                    set_default_earliest_unseen(sp)
+            return
+
+        # Only ssss spawns from here below.
+
+        sp['links'] = '+++-'
+
+        # Cover all bases, make sure we're using values < 3600.
+        # Warning: python uses modulo as the least residue, not as
+        # remainder, so we don't apply it to the result.
+        residue_unseen = sp['earliest_unseen'] % 3600
+        residue_seen = sp['latest_seen'] % 3600
+
+        if residue_unseen == residue_seen:
+            return
+
+        # For 60 minute spawns ('ssss'), the largest gap doesn't give the
+        # earliest spawnpoint because a Pokemon is always there.  Use the union
+        # of all intervals where the same encounter ID was seen to find the
+        # latest_seen.  If a different encounter ID was seen, then the
+        # complement of that interval was the same ID, so union that
+        # complement as well.
+        union = union_ranges(self.ranges())
+
+        # If more than one disparate union, take the largest as our starting
+        # point.
+        union = reduce(lambda x, y: x if (x[1] - x[0]) % 3600 >
+                       (y[1] - y[0]) % 3600 else y, union, [0, 3600])
+        sp['latest_seen'] = union[1]
+        sp['earliest_unseen'] = union[0]
+        log.info('1x60: appear %d, despawn %d, duration: %d min.',
+                 union[0], union[1], ((union[1] - union[0]) % 3600) / 60)
+
+
+# (start, end) of the range between two consecutive sightings, given as
+# (epoch seconds, encounter id hash), or None if they're an hour or more
+# apart.
+def between(last, sighting):
+    (last_time, last_id), (scan_time, encounter_id) = last, sighting
+    delta = scan_time - last_time
+    if delta >= 3600:
+        return None
+
+    if encounter_id == last_id:
+        # Get the seconds past the hour for start and end times.
+        start = last_time % 3600
+        end = (start + delta) % 3600
+    else:
+        # Convert diff range to same range by taking the clock complement.
+        start = scan_time % 3600
+        end = last_time % 3600
+    return start, end
+
+
+def set_default_earliest_unseen(sp):
+    sp['earliest_unseen'] = (sp['latest_seen'] + 15 * 60) % 3600
+
+
+# Take the union of a list of [start, end] ranges on the clock.
+def union_ranges(start_end_list):
+    while True:
+        # union is list of unions of ranges with the same encounter id.
+        union = []
+        for start, end in start_end_list:
+            if not union:
+                union.append([start, end])
+                continue
+            # Cycle through all ranges in union, since it might overlap
+            # with any of them.
+            for u in union:
+                if clock_between(u[0], start, u[1]):
+                    u[1] = end if not(clock_between(
+                        u[0], end, u[1])) else u[1]
+                elif clock_between(u[0], end, u[1]):
+                    u[0] = start if not(clock_between(
+                        u[0], start, u[1])) else u[0]
+                elif union.count([start, end]) == 0:
+                    union.append([start, end])
+
+        # Are no more unions possible?
+        if union == start_end_list:
+            return union
+
+        start_end_list = union  # Make another pass looking for unions.
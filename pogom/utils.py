@@ -15,7 +15,8 @@ import subprocess
 import requests
 import configargparse
 
-from s2sphere import CellId, LatLng
+from s2sphere import CellId, LatLng, LatLngRect, RegionCoverer
+from cachetools import LRUCache, cached
 from geopy.geocoders import GoogleV3
 from requests_futures.sessions import FuturesSession
 from requests.packages.urllib3.util.retry import Retry
@@ -24,6 +25,7 @@ from cHaversine import haversine
 from pprint import pformat
 from time import strftime
 from timeit import default_timer
+from threading import Lock
 
 from pgoapi.hash_server import HashServer
 
@@ -77,6 +79,25 @@ def get_args():
     parser.add_argument('-w', '--workers', type=int,
                         help=('Number of search worker threads to start. ' +
                               'Defaults to the number of accounts specified.'))
+    parser.add_argument('-pt', '--parse-threads', type=int, default=0,
+                        help=('Number of threads to parse scans in, so the ' +
+                              'search workers can make their next request ' +
+                              'meanwhile. 0 to parse in the search workers, ' +
+                              'or in --engine-threads threads with ' +
+                              '--worker-engine coroutines.'))
+    parser.add_argument('-pqs', '--parse-queue-size', type=int, default=20,
+                        help=('Maximum number of scans waiting for a parse ' +
+                              'thread. Search workers wait when it is full.'))
+    parser.add_argument('-we', '--worker-engine', default='threads',
+                        choices=['threads', 'coroutines'],
+                        help=('Run each search worker in a thread of its ' +
+                              'own, or as coroutines sharing a pool of ' +
+                              '--engine-threads threads.'))
+    parser.add_argument('-et', '--engine-threads', type=int, default=32,
+                        help=('Number of threads running the search worker ' +
+                              'coroutines. Logins and captchas wait without ' +
+                              'holding one. Only used with --worker-engine ' +
+                              'coroutines.'))
     parser.add_argument('-asi', '--account-search-interval', type=int,
                         default=0,
                         help=('Seconds for accounts to search before ' +
@@ -171,6 +192,12 @@ def get_args():
                         help=('Time delay between encounter pokemon ' +
                               'in scan threads.'),
                         type=float, default=1)
+    parser.add_argument('-encth', '--encounter-threads', type=int, default=0,
+                        help=('Number of threads encountering Pokemon with ' +
+                              'the high level accounts, so scans don\'t ' +
+                              'wait for encounters. Pokemon are stored ' +
+                              'without IVs first, then updated. 0 to ' +
+                              'encounter while parsing the scan.'))
     parser.add_argument('-ignf', '--ignorelist-file',
                         default='', help='File containing a list of ' +
                         'Pokemon IDs to ignore, one line per ID. ' +
@@ -371,6 +398,11 @@ def get_args():
                               'for search threads (none/round/random).'),
                         type=str, default='round')
     group = parser.add_argument_group('Database')
+    group.add_argument(
+        '--db-type',
+        help=('Type of database: mysql or postgres. PostgreSQL needs ' +
+              'psycopg2 installed.'),
+        choices=['mysql', 'postgres'], default='mysql')
     group.add_argument(
         '--db-name', help='Name of the database to be used.', required=True)
     group.add_argument(
@@ -382,13 +414,51 @@ def get_args():
         help='IP or hostname for the database.',
         default='127.0.0.1')
     group.add_argument(
-        '--db-port', help='Port for the database.', type=int, default=3306)
+        '--db-port',
+        help=('Port for the database. Default: 3306 for MySQL, 5432 ' +
+              'for PostgreSQL.'),
+        type=int)
+    group.add_argument(
+        '--db-replica-host', action='append',
+        help=('Host[:port] of a read replica of the database, used for ' +
+              'map and scheduler reads. Can be used multiple times.'))
+    group.add_argument(
+        '--db-replica-max-lag',
+        help=('Stop reading from a replica that is more than this many ' +
+              'seconds behind the primary.'),
+        type=int, default=10)
     group.add_argument(
         '--db-threads',
         help=('Number of db threads; increase if the db ' +
               'queue falls behind.'),
         type=int,
         default=1)
+    group.add_argument(
+        '--db-partition',
+        help=('Partition the pokemon table by day, so database cleanup ' +
+              'drops whole days instead of deleting rows. Converting ' +
+              'an existing table might take a while.'),
+        action='store_true', default=False)
+    group.add_argument(
+        '--db-compact',
+        help=('Store coordinates and times of the pokemon, spawnpoint ' +
+              'and scannedlocation tables as 4 byte integers, to shrink ' +
+              'tables and indexes. Converting existing tables might take ' +
+              'a while.'),
+        action='store_true', default=False)
+    group.add_argument(
+        '--db-online-migrations',
+        help=('Run schema migrations of large tables online: rows are ' +
+              'copied in chunks to a migrated copy of the table while ' +
+              'scanning goes on. Needs the TRIGGER privilege.'),
+        action='store_true', default=False)
+    group.add_argument(
+        '--db-fingerprint-cache',
+        help=('Number of rows per table to remember a fingerprint of, ' +
+              'to skip upserts of rows that did not change. ' +
+              '0 to disable.'),
+        type=int,
+        default=50000)
     group = parser.add_argument_group('Database Cleanup')
     group.add_argument('-DC', '--db-cleanup',
                        help='Enable regular database cleanup thread.',
@@ -418,6 +488,20 @@ def get_args():
                              'after last valid scan. '
                              'Default: 0, 0 to disable.'),
                        type=int, default=0)
+    group.add_argument('-DCcs', '--db-cleanup-chunk-size',
+                       help=('Number of rows deleted and committed at once ' +
+                             'by the database cleanup. Default: 1000.'),
+                       type=int, default=1000)
+    group.add_argument('-DCmq', '--db-cleanup-max-queue',
+                       help=('Pause database cleanup while more than X ' +
+                             'updates are waiting in the db queue. ' +
+                             'Default: 50.'),
+                       type=int, default=50)
+    group.add_argument('-DCa', '--db-cleanup-archive', default=None,
+                       help=('Move old Pokemon to daily files in this ' +
+                             'directory instead of deleting them, and ' +
+                             'include them in the statistics. Needs numpy ' +
+                             'installed.'))
     parser.add_argument(
         '-wh',
         '--webhook',
@@ -485,6 +569,11 @@ def get_args():
     parser.add_argument('-sn', '--status-name', default=str(os.getpid()),
                         help=('Enable status page database update using ' +
                               'STATUS_NAME as main worker name.'))
+    parser.add_argument('-wsi', '--worker-status-interval',
+                        help=('Seconds between batched worker status ' +
+                              'database writes. Status changes in between ' +
+                              'are kept in memory, latest one wins.'),
+                        type=int, default=15)
     parser.add_argument('-hk', '--hash-key', default=None, action='append',
                         help='Key for hash server.')
     parser.add_argument('-hs', '--hash-service', default='bossland', type=str,
@@ -536,6 +625,11 @@ def get_args():
                               'environment and auto-upload to ' +
                               'hastebin.com.'),
                         action='store_true', default=False)
+    parser.add_argument('--record-responses',
+                        help=('Directory to record the map responses of ' +
+                              'all scans to, for replaying them with ' +
+                              'tools/replay_responses.py.'),
+                        default=None)
     parser.add_argument('-exg', '--ex-gyms',
                         help=('Fetch OSM parks within geofence and flag ' +
                               'gyms that are candidates for EX raids. ' +
@@ -577,6 +671,17 @@ def get_args():
     args.log_filename = args.log_filename.replace('<sn>', '<SN>')
     args.log_filename = args.log_filename.replace('<SN>', args.status_name)
 
+    if args.db_port is None:
+        args.db_port = 5432 if args.db_type == 'postgres' else 3306
+
+    if args.db_type == 'postgres' and (args.db_partition or
+                                       args.db_compact or
+                                       args.db_replica_host):
+        parser.print_usage()
+        print(sys.argv[0] + ': error: --db-partition, --db-compact and ' +
+              '--db-replica-host are only supported with MySQL.')
+        sys.exit(1)
+
     if args.only_server:
         if args.location is None:
             parser.print_usage()
@@ -899,6 +1004,36 @@ def cellid(loc):
         16)
 
 
+# Return the S2 leaf cell id of a location. Any S2 cell covers a contiguous
+# range of leaf cell ids, so these can be range scanned for a covering.
+def s2_cell_id(lat, lng):
+    return CellId.from_lat_lng(LatLng.from_degrees(lat, lng)).id()
+
+
+# Cover a bounding box with at most `max_cells` S2 cells, and return the
+# covering as a sorted tuple of (min, max) leaf cell id ranges, merging
+# adjacent cells. Coverings are cached, all map queries of a single request
+# share the same viewport.
+@cached(LRUCache(maxsize=1024), lock=Lock())
+def s2_cell_id_ranges(swLat, swLng, neLat, neLng, max_cells=8):
+    coverer = RegionCoverer()
+    coverer.max_cells = max_cells
+    rect = LatLngRect.from_point_pair(LatLng.from_degrees(swLat, swLng),
+                                      LatLng.from_degrees(neLat, neLng))
+
+    ranges = []
+    for cell in sorted(coverer.get_covering(rect), key=lambda c: c.id()):
+        min_id = cell.range_min().id()
+        max_id = cell.range_max().id()
+        # Leaf cell ids are odd, so adjacent ranges are 2 apart.
+        if ranges and min_id <= ranges[-1][1] + 2:
+            ranges[-1] = (ranges[-1][0], max(max_id, ranges[-1][1]))
+        else:
+            ranges.append((min_id, max_id))
+
+    return tuple(ranges)
+
+
 # Return approximate distance in meters.
 def distance(pos1, pos2):
     return haversine((tuple(pos1))[0:2], (tuple(pos2))[0:2])
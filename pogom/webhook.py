@@ -93,8 +93,6 @@ def wh_updater(args, queue, key_caches):
             except Empty:
                 pass
             else:
-                frame_message = {'type': whtype, 'message': message}
-
                 # Get the proper cache if this type has one.
                 key_cache = None
 
@@ -103,6 +101,7 @@ def wh_updater(args, queue, key_caches):
 
                 # Get the unique identifier to check our cache, if it has one.
                 ident = message.get(ident_fields.get(whtype), None)
+                send = False
 
                 # cachetools in Python2.7 isn't thread safe, so we add a lock.
                 with wh_lock:
@@ -112,25 +111,36 @@ def wh_updater(args, queue, key_caches):
                         # so let's just log and send as-is.
                         log.debug('Queued webhook item of uncached type: %s.',
                                   whtype)
-                        frame_messages.append(frame_message)
+                        send = True
                     elif ident not in key_cache:
-                        key_cache[ident] = message
+                        # The cache only keeps the important fields of what
+                        # was sent. Messages can be records shared with the
+                        # database queue and changed after they were queued,
+                        # e.g. by an encounter.
+                        key_cache[ident] = __wh_key(whtype, message)
                         log.debug('Queued %s to webhook: %s.', whtype, ident)
-                        frame_messages.append(frame_message)
+                        send = True
                     else:
                         # Make sure to call key_cache[ident] in all branches
                         # so it updates the LFU usage count.
                         # If the object has changed in an important way, send
                         # new data to webhooks.
-                        if __wh_object_changed(whtype, key_cache[ident],
-                                               message):
-                            key_cache[ident] = message
-                            frame_messages.append(frame_message)
+                        key = __wh_key(whtype, message)
+                        if key is None or key_cache[ident] != key:
+                            key_cache[ident] = key
+                            send = True
                             log.debug('Queued updated %s to webhook: %s.',
                                       whtype, ident)
                         else:
                             log.debug('Not queuing %s to webhook: %s.', whtype,
                                       ident)
+
+                if send:
+                    # Records are only turned into their payload when sent.
+                    if hasattr(message, 'webhook'):
+                        message = message.webhook()
+                    frame_messages.append({'type': whtype,
+                                           'message': message})
                 queue.task_done()
             # Store the time when we added the first message instead of the
             # time when we last cleared the messages, so we more accurately
@@ -226,23 +236,15 @@ def __get_key_fields(whtype):
     return key_fields.get(whtype, [])
 
 
-# Determine if a webhook object has changed in any important way (and
-# requires a resend).
-def __wh_object_changed(whtype, old, new):
+# The values of the important fields of a webhook object, to determine if it
+# has changed in any important way (and requires a resend). None if the type
+# has no important fields, which is always resent.
+def __wh_key(whtype, message):
     # Only test for important fields: don't trust last_modified fields.
     fields = __get_key_fields(whtype)
 
     if not fields:
         log.debug('Received an object of unknown type %s.', whtype)
-        return True
-
-    return not __dict_fields_equal(fields, old, new)
-
-
-# Determine if two dicts have equal values for all keys in a list.
-def __dict_fields_equal(keys, a, b):
-    for k in keys:
-        if a.get(k) != b.get(k):
-            return False
+        return None
 
-    return True
+    return tuple(message.get(k) for k in fields)
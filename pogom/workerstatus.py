@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from datetime import datetime, timedelta
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+# Latest-wins, in-memory copy of the MainWorker and WorkerStatus tables.
+# Search workers and the status thread only overwrite their own row here, and
+# the rows that changed since the last flush are written to the database as a
+# single batched upsert per table.
+class WorkerStatusTable(object):
+
+    def __init__(self):
+        self.main_workers = {}
+        self.workers = {}
+        self.dirty_main_workers = set()
+        self.dirty_workers = set()
+        # Set once a scanner in this process starts reporting, so the web
+        # server knows it can skip the database.
+        self.active = False
+        self.lock = Lock()
+
+    # Store the latest MainWorker row for an instance.
+    def update_main(self, row):
+        with self.lock:
+            self.active = True
+            self.main_workers[row['worker_name']] = row
+            self.dirty_main_workers.add(row['worker_name'])
+
+    # Store the latest WorkerStatus row for an account.
+    def update(self, row):
+        with self.lock:
+            self.active = True
+            self.workers[row['username']] = row
+            self.dirty_workers.add(row['username'])
+
+    # Return a copy of the last known row of an account, or None.
+    def get_worker(self, username):
+        with self.lock:
+            row = self.workers.get(username, None)
+            return dict(row) if row else None
+
+    # Same as MainWorker.get_recent(), answered from memory.
+    def get_main_recent(self, age_minutes=30):
+        with self.lock:
+            rows = self._filter_recent(self.main_workers, age_minutes)
+        return sorted(rows, key=lambda r: r['worker_name'])
+
+    # Same as WorkerStatus.get_recent(), answered from memory.
+    def get_recent(self, age_minutes=30):
+        with self.lock:
+            rows = self._filter_recent(self.workers, age_minutes)
+        return sorted(rows, key=lambda r: r['username'])
+
+    # Queue all rows that changed since the last flush, one batch per table.
+    # Returns the number of rows queued.
+    def flush(self, db_updates_queue):
+        # Import here to avoid a cyclic import with pogom.models.
+        from .models import MainWorker, WorkerStatus
+
+        with self.lock:
+            main_workers = {name: dict(self.main_workers[name])
+                            for name in self.dirty_main_workers}
+            workers = {name: dict(self.workers[name])
+                       for name in self.dirty_workers}
+            self.dirty_main_workers.clear()
+            self.dirty_workers.clear()
+
+        if main_workers:
+            db_updates_queue.put((MainWorker, main_workers))
+        if workers:
+            db_updates_queue.put((WorkerStatus, workers))
+
+        log.debug('Flushed %d main worker and %d worker status rows.',
+                  len(main_workers), len(workers))
+
+        return len(main_workers) + len(workers)
+
+    @staticmethod
+    def _filter_recent(rows, age_minutes):
+        if age_minutes <= 0:
+            return [dict(r) for r in rows.itervalues()]
+
+        timeout = datetime.utcnow() - timedelta(minutes=age_minutes)
+        return [dict(r) for r in rows.itervalues()
+                if r['last_modified'] >= timeout]
+
+
+# Overlay in-memory rows on rows read from the database, keyed by `key`. Other
+# instances sharing the database only exist in the database rows.
+def merge_status_rows(db_rows, memory_rows, key):
+    rows = {row[key]: row for row in db_rows}
+    rows.update({row[key]: row for row in memory_rows})
+    return [rows[k] for k in sorted(rows)]
+
+
+# Shared by the search threads and the web server when they run in the same
+# process.
+worker_status_table = WorkerStatusTable()
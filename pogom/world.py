@@ -0,0 +1,403 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math
+import time
+import random
+import struct
+
+import xxhash
+
+from collections import namedtuple
+from s2sphere import CellId, LatLng
+
+# Meters per degree of latitude.
+lat_meters = 111319.9
+# Wild Pokemon are visible within 70m of the player, nearby Pokemon within
+# 200m. Spawnpoints are bucketed by 100m squares to find them.
+wild_radius = 70
+nearby_radius = 200
+bucket_size = 100
+# Gym details can only be fetched within 1km of a gym.
+gym_radius = 1000
+# The time till hidden is only known in the last 90 seconds of a spawn.
+tth_window = 90
+# (Seconds a spawn lasts every hour, weight.)
+spawn_kinds = ((900, 60), (1800, 15), (3600, 25))
+# Raids: an egg hatches an hour after it appears, the battle lasts 45 minutes.
+raid_egg = 3600
+raid_battle = 2700
+# Lures last as long as the default --lure-duration.
+lure_duration = 1800
+
+# Salts of the hashes for each kind of event.
+spawn_salt = 1
+fort_salt = 2
+gym_salt = 3
+defender_salt = 4
+raid_salt = 5
+lure_salt = 6
+
+Spawnpoint = namedtuple('Spawnpoint', [
+    'index', 'spawn_point_id', 'latitude', 'longitude', 'x', 'y', 'cell_id',
+    'despawn', 'duration'])
+Fort = namedtuple('Fort', [
+    'index', 'id', 'type', 'latitude', 'longitude', 'cell_id', 'period',
+    'phase'])
+
+
+# Ticks at `speed` times real time from the epoch second `start`, now if not
+# given. The world can be asked about any time, the clock gives the time of
+# requests made to the simulator.
+class WorldClock(object):
+
+    def __init__(self, start=None, speed=1.0):
+        self.real_start = time.time()
+        self.start = self.real_start if start is None else start
+        self.speed = speed
+
+    def now(self):
+        return self.start + (time.time() - self.real_start) * self.speed
+
+
+# A synthetic map answering map, encounter and gym requests, for load testing
+# without accounts. The spawnpoints and forts are generated from the seed;
+# everything that changes over time (which spawnpoints are spawned and what,
+# gym teams, raids and lures) is a hash of the seed, the object and the time
+# slot it's in. So the same seed gives the same answer for the same request
+# and time, on every run and to every worker.
+#
+# Spawnpoints spawn at the same second of every hour for 15, 30 or 60
+# minutes, with a new encounter id each hour, and only show their time till
+# hidden in the last 90 seconds, so spawnpoint scanning and TTH discovery
+# behave as with the real map. Responses are dicts shaped like the protos.
+class SyntheticWorld(object):
+
+    def __init__(self, seed, location, radius=2000, spawnpoints=5000,
+                 pokestops=300, gyms=100):
+        self.seed = seed & 0xFFFFFFFFFFFFFFFF
+        self.location = location
+        self.lng_meters = lat_meters * math.cos(math.radians(location[0]))
+
+        rng = random.Random(seed)
+        # Spawnpoint id -> Spawnpoint.
+        self.spawnpoints = {}
+        # (x bucket, y bucket) -> list of Spawnpoints.
+        self.buckets = {}
+        while len(self.spawnpoints) < spawnpoints:
+            latitude, longitude = self.random_point(rng, radius)
+            cell = CellId.from_lat_lng(LatLng.from_degrees(latitude,
+                                                           longitude))
+            spawn_point_id = cell.parent(20).to_token()
+            if spawn_point_id in self.spawnpoints:
+                continue
+            x, y = self.project(latitude, longitude)
+            sp = Spawnpoint(
+                len(self.spawnpoints), spawn_point_id, latitude, longitude,
+                x, y, cell.parent(15).id(), rng.randrange(3600),
+                self.weighted(rng, spawn_kinds))
+            self.spawnpoints[spawn_point_id] = sp
+            self.buckets.setdefault(self.bucket(x, y), []).append(sp)
+
+        # Fort id -> Fort and S2 level 15 cell id -> list of Forts.
+        self.forts = {}
+        self.cells = {}
+        for fort_type, count in ((0, gyms), (1, pokestops)):
+            for i in range(count):
+                latitude, longitude = self.random_point(rng, radius)
+                index = len(self.forts)
+                fort = Fort(
+                    index, '{:016x}.16'.format(self.hash(fort_salt, index)),
+                    fort_type, latitude, longitude,
+                    CellId.from_lat_lng(LatLng.from_degrees(
+                        latitude, longitude)).parent(15).id(),
+                    # Gym teams change and raids or lures happen once every
+                    # period, at most.
+                    rng.randrange(2, 8) * 3600, rng.randrange(3600 * 8))
+                self.forts[fort.id] = fort
+                self.cells.setdefault(fort.cell_id, []).append(fort)
+
+    def random_point(self, rng, radius):
+        d = math.sqrt(rng.random()) * radius
+        angle = rng.random() * 2 * math.pi
+        return (self.location[0] + d * math.sin(angle) / lat_meters,
+                self.location[1] + d * math.cos(angle) / self.lng_meters)
+
+    @staticmethod
+    def weighted(rng, choices):
+        pick = rng.randrange(sum(weight for _, weight in choices))
+        for value, weight in choices:
+            if pick < weight:
+                return value
+            pick -= weight
+
+    def hash(self, salt, index, slot=0):
+        return xxhash.xxh64(struct.pack('<QQq', salt, index, slot),
+                            seed=self.seed).intdigest()
+
+    # Meters east and north of the center of the world.
+    def project(self, latitude, longitude):
+        return ((longitude - self.location[1]) * self.lng_meters,
+                (latitude - self.location[0]) * lat_meters)
+
+    @staticmethod
+    def bucket(x, y):
+        return (int(math.floor(x / bucket_size)),
+                int(math.floor(y / bucket_size)))
+
+    # The S2 level 15 cell of a location and its neighbors, for map requests
+    # not giving any.
+    @staticmethod
+    def cell_ids(latitude, longitude):
+        cell = CellId.from_lat_lng(
+            LatLng.from_degrees(latitude, longitude)).parent(15)
+        return [cell.id()] + [c.id() for c in cell.get_all_neighbors(15)]
+
+    # (encounter id, epoch second of despawn) of the spawn of a spawnpoint
+    # at `now`, or None if it isn't spawned.
+    def spawn(self, sp, now):
+        start = sp.despawn - sp.duration
+        hour, into = divmod(int(now) - start, 3600)
+        if into >= sp.duration:
+            return None
+        return (self.hash(spawn_salt, sp.index, hour),
+                start + hour * 3600 + sp.duration)
+
+    def pokemon_data(self, encounter_id, details=False):
+        h = encounter_id
+        data = {
+            'pokemon_id': h % 251 + 1,
+            'pokemon_display': {'gender': (h >> 8) % 2 + 1}
+        }
+        if details:
+            level = (h >> 10) % 30 + 1
+            # Inverse of calc_pokemon_level.
+            cp_multiplier = (2.838007664 + math.sqrt(
+                2.838007664 ** 2 - 4 * 58.35178527 * (0.8539209906 - level))
+            ) / (2 * 58.35178527)
+            data.update({
+                'individual_attack': (h >> 16) % 16,
+                'individual_defense': (h >> 20) % 16,
+                'individual_stamina': (h >> 24) % 16,
+                'move_1': (h >> 28) % 50 + 200,
+                'move_2': (h >> 34) % 100 + 13,
+                'height_m': 0.5 + (h >> 40) % 100 / 50.0,
+                'weight_kg': 5 + (h >> 46) % 500 / 10.0,
+                'cp': 10 + (h >> 52) % 100 * level,
+                'cp_multiplier': cp_multiplier
+            })
+        return data
+
+    def wild_pokemon(self, sp, encounter_id, despawn, now_ms, details=False):
+        tth = despawn * 1000 - now_ms
+        return {
+            'encounter_id': encounter_id,
+            'last_modified_timestamp_ms': now_ms,
+            'latitude': sp.latitude,
+            'longitude': sp.longitude,
+            'spawn_point_id': sp.spawn_point_id,
+            'pokemon_data': self.pokemon_data(encounter_id, details),
+            'time_till_hidden_ms': tth if tth <= tth_window * 1000 else -1
+        }
+
+    # Where `fort` is in its period at `now`: (slot, seconds into it).
+    @staticmethod
+    def fort_slot(fort, now):
+        return divmod(int(now) + fort.phase, fort.period)
+
+    # (spawn, battle, end) epoch seconds of the raid of a gym at `now`, level
+    # and boss, or None.
+    def raid(self, fort, now):
+        slot, into = self.fort_slot(fort, now)
+        h = self.hash(raid_salt, fort.index, slot)
+        if h % 2:
+            return None
+        spawn = int(now) - into + (h >> 1) % (
+            fort.period - raid_egg - raid_battle)
+        battle = spawn + raid_egg
+        end = battle + raid_battle
+        if not spawn <= now < end:
+            return None
+        return spawn, battle, end, (h >> 16) % 5 + 1, (h >> 20) % 251 + 1
+
+    def gym(self, fort, now):
+        slot, into = self.fort_slot(fort, now)
+        h = self.hash(gym_salt, fort.index, slot)
+        modified = int(now) - into
+        data = {
+            'id': fort.id,
+            'type': 0,
+            'latitude': fort.latitude,
+            'longitude': fort.longitude,
+            'enabled': True,
+            'owned_by_team': h % 3 + 1,
+            'guard_pokemon_id': (h >> 2) % 251 + 1,
+            'gym_display': {
+                'slots_available': (h >> 10) % 6,
+                'total_gym_cp': (h >> 13) % 10000,
+                'lowest_pokemon_motivation': (h >> 27) % 100 / 100.0,
+                'occupied_millis': into * 1000
+            }
+        }
+        raid = self.raid(fort, now)
+        if raid:
+            spawn, battle, end, level, boss = raid
+            data['raid_info'] = {
+                'raid_seed': self.hash(raid_salt, fort.index, spawn),
+                'raid_spawn_ms': spawn * 1000,
+                'raid_battle_ms': battle * 1000,
+                'raid_end_ms': end * 1000,
+                'raid_level': level
+            }
+            modified = max(modified, spawn)
+            if now >= battle:
+                data['raid_info']['raid_pokemon'] = {
+                    'pokemon_id': boss,
+                    'cp': boss * 100 + level * 1000,
+                    'move_1': (boss % 50) + 200,
+                    'move_2': (boss % 100) + 13
+                }
+                modified = max(modified, battle)
+        data['last_modified_timestamp_ms'] = modified * 1000
+        return data
+
+    def pokestop(self, fort, now):
+        slot, into = self.fort_slot(fort, now)
+        data = {
+            'id': fort.id,
+            'type': 1,
+            'latitude': fort.latitude,
+            'longitude': fort.longitude,
+            'enabled': True,
+            # Modified at the start of every period, and when lured.
+            'last_modified_timestamp_ms': (int(now) - into) * 1000
+        }
+        h = self.hash(lure_salt, fort.index, slot)
+        # Lured in one of five periods.
+        start = int(now) - into + (h >> 3) % (fort.period - lure_duration)
+        if h % 5 == 0 and start <= now < start + lure_duration:
+            data['active_fort_modifier'] = [501]
+            data['last_modified_timestamp_ms'] = start * 1000
+        return data
+
+    def fort(self, fort, now):
+        if fort.type == 0:
+            return self.gym(fort, now)
+        return self.pokestop(fort, now)
+
+    # GET_MAP_OBJECTS of a player at `position` at epoch second `now`.
+    def map_objects(self, position, cell_ids=None, now=None):
+        now = time.time() if now is None else now
+        now_ms = int(now * 1000)
+        if not cell_ids:
+            cell_ids = self.cell_ids(*position[:2])
+
+        map_cells = {}
+        for cell_id in cell_ids:
+            map_cells[cell_id] = {
+                's2_cell_id': cell_id,
+                'current_timestamp_ms': now_ms,
+                'forts': [self.fort(f, now) for f in self.cells.get(cell_id,
+                                                                    [])],
+                'wild_pokemons': [],
+                'nearby_pokemons': []
+            }
+        # Pokemon in cells that weren't asked for go in the first one.
+        first = map_cells[cell_ids[0]]
+
+        x, y = self.project(*position[:2])
+        reach = int(math.ceil(float(nearby_radius) / bucket_size))
+        bx, by = self.bucket(x, y)
+        for i in range(bx - reach, bx + reach + 1):
+            for j in range(by - reach, by + reach + 1):
+                for sp in self.buckets.get((i, j), ()):
+                    d = math.hypot(sp.x - x, sp.y - y)
+                    if d > nearby_radius:
+                        continue
+                    spawn = self.spawn(sp, now)
+                    if spawn is None:
+                        continue
+                    cell = map_cells.get(sp.cell_id, first)
+                    if d <= wild_radius:
+                        cell['wild_pokemons'].append(self.wild_pokemon(
+                            sp, spawn[0], spawn[1], now_ms))
+                    else:
+                        cell['nearby_pokemons'].append({
+                            'encounter_id': spawn[0],
+                            'pokemon_id': self.pokemon_data(
+                                spawn[0])['pokemon_id'],
+                            'distance_in_meters': d
+                        })
+
+        return {'status': 1,
+                'map_cells': [map_cells[c] for c in cell_ids]}
+
+    # ENCOUNTER of a wild Pokemon: status 1 and its details if it's still
+    # there, else status 2 (not found).
+    def encounter(self, encounter_id, spawn_point_id, now=None):
+        now = time.time() if now is None else now
+        sp = self.spawnpoints.get(spawn_point_id, None)
+        spawn = self.spawn(sp, now) if sp else None
+        if spawn is None or spawn[0] != encounter_id:
+            return {'status': 2}
+        return {
+            'status': 1,
+            'wild_pokemon': self.wild_pokemon(
+                sp, encounter_id, spawn[1], int(now * 1000), details=True),
+            'capture_probability': {
+                'pokeball_type': [1, 2, 3],
+                'capture_probability': [0.4, 0.6, 0.8]
+            }
+        }
+
+    # GYM_GET_INFO: result 1 and the gym with its defenders, 2 if the player
+    # is out of range.
+    def gym_info(self, gym_id, position, now=None):
+        now = time.time() if now is None else now
+        fort = self.forts.get(gym_id, None)
+        if fort is None or fort.type != 0:
+            return {'result': 0}
+        x, y = self.project(*position[:2])
+        gx, gy = self.project(fort.latitude, fort.longitude)
+        if math.hypot(gx - x, gy - y) > gym_radius:
+            return {'result': 2}
+
+        gym = self.gym(fort, now)
+        slot, into = self.fort_slot(fort, now)
+        defenders = []
+        for i in range(6 - gym['gym_display']['slots_available']):
+            pokemon_uid = self.hash(defender_salt, fort.index,
+                                    slot * 6 + i)
+            pokemon = self.pokemon_data(pokemon_uid, details=True)
+            pokemon.update({
+                'id': pokemon_uid,
+                'num_upgrades': (pokemon_uid >> 5) % 10,
+                'stamina': 100,
+                'stamina_max': 100,
+                'additional_cp_multiplier': 0
+            })
+            defenders.append({
+                'motivated_pokemon': {
+                    'pokemon': pokemon,
+                    'cp_when_deployed': pokemon['cp'],
+                    'cp_now': pokemon['cp'] * (i + 1) / 6
+                },
+                'deployment_totals': {
+                    'deployment_duration_ms': max(into - i * 60, 0) * 1000
+                },
+                'trainer_public_profile': {
+                    'name': 'Trainer{}'.format(pokemon_uid % 100000),
+                    'level': (pokemon_uid >> 17) % 40 + 1
+                }
+            })
+
+        return {
+            'result': 1,
+            'name': 'Gym {}'.format(fort.index),
+            'description': '',
+            'url': '',
+            'gym_status_and_defenders': {
+                'pokemon_fort_proto': gym,
+                'gym_defender': defenders
+            }
+        }
@@ -21,15 +21,21 @@ from pogom.utils import (get_args, now, gmaps_reverse_geolocate,
                          log_resource_usage_loop, get_debug_dump_link,
                          dynamic_loading_refresher, dynamic_rarity_refresher)
 from pogom.altitude import get_gmaps_altitude
+from pogom.metrics import log_metrics_loop
 
 from pogom.models import (init_database, create_tables, drop_tables,
                           PlayerLocale, db_updater, clean_db_loop,
-                          verify_table_encoding, verify_database_schema)
+                          verify_table_encoding, verify_database_schema,
+                          verify_table_partitioning, db_partition_loop,
+                          verify_compact_schema, db_replica_monitor_loop,
+                          is_postgres)
 from pogom.webhook import wh_updater
+from pogom.archive import archive_available
 
 from pogom.osm import update_ex_gyms
 from pogom.proxy import initialize_proxies
 from pogom.search import search_overseer_thread
+from pogom.recorder import start_recorder
 from time import strftime
 
 
@@ -219,8 +225,15 @@ def startup_db(app, clear_db):
 
     create_tables(db)
 
-    # Fix encoding on present and future tables.
-    verify_table_encoding(db)
+    if not is_postgres(db):
+        # Fix encoding on present and future tables.
+        verify_table_encoding(db)
+
+        # Switch the biggest tables to (or from) the compact column types.
+        verify_compact_schema(db)
+
+        # Partition (or unpartition) the tables that grow the fastest.
+        verify_table_partitioning(db)
 
     if clear_db:
         log.info(
@@ -321,6 +334,11 @@ def main():
     log.info('Pokemon encounters %s.',
              'enabled' if args.encounter else 'disabled')
 
+    if args.db_cleanup_archive and not archive_available():
+        log.critical('The database cleanup archive needs numpy. Try ' +
+                     'running pip install numpy.')
+        sys.exit(1)
+
     app = None
     if not args.no_server and not args.clear_db:
         app = Pogom(__name__,
@@ -361,6 +379,10 @@ def main():
     new_location_queue = Queue()
     new_location_queue.put(position)
 
+    if args.record_responses and not args.only_server:
+        log.info('Recording map responses to %s.', args.record_responses)
+        start_recorder(args.record_responses)
+
     # DB Updates
     db_updates_queue = Queue()
 
@@ -374,7 +396,21 @@ def main():
 
     # Database cleaner; really only need one ever.
     if args.db_cleanup:
-        t = Thread(target=clean_db_loop, name='db-cleaner', args=(args,))
+        t = Thread(target=clean_db_loop, name='db-cleaner',
+                   args=(args, db_updates_queue))
+        t.daemon = True
+        t.start()
+
+    # Only read from replicas that are up to date.
+    if args.db_replica_host:
+        t = Thread(target=db_replica_monitor_loop, name='db-replicas',
+                   args=(db,))
+        t.daemon = True
+        t.start()
+
+    # Keep partitions for the next days around.
+    if args.db_partition:
+        t = Thread(target=db_partition_loop, name='db-partitions')
         t.daemon = True
         t.start()
 
@@ -533,6 +569,11 @@ def set_log_and_verbosity(log):
         t = Thread(target=log_resource_usage_loop, name='res-usage')
         t.daemon = True
         t.start()
+
+        # And our own counters and timers.
+        t = Thread(target=log_metrics_loop, name='metrics')
+        t.daemon = True
+        t.start()
     else:
         log.setLevel(logging.INFO)
 
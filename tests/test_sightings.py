@@ -0,0 +1,205 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from pogom import sightings as summaries
+from pogom.sightings import SightingSummary
+from pogom.utils import date_secs, clock_between
+
+
+# Spawnpoint classification from the full sighting history, as it was done
+# before sighting summaries. The summaries must give the same results, as
+# long as the ranges of the history fit in their range_limit.
+def classify_history(sp, scan_loc, now_secs, query):
+    tth_found = False
+    for s in query:
+        if s['tth_secs'] is not None:
+            tth_found = True
+            tth_secs = (s['tth_secs'] - 1) % 3600
+
+    if not scan_loc['done']:
+        if not tth_found:
+            sp['kind'] = 'hhhs'
+            if not sp['earliest_unseen']:
+                sp['latest_seen'] = now_secs
+                sp['earliest_unseen'] = (sp['latest_seen'] + 900) % 3600
+            elif clock_between(sp['latest_seen'], now_secs,
+                               sp['earliest_unseen']):
+                sp['latest_seen'] = now_secs
+        return
+
+    old_kind = str(sp['kind'])
+    seen_secs = sorted(map(lambda x: date_secs(x['scan_time']), query))
+    if tth_found:
+        seen_secs.append(tth_secs)
+        seen_secs.sort()
+    if seen_secs:
+        seen_secs.append(seen_secs[0] + 3600)
+
+    gap_list = [seen_secs[i + 1] - seen_secs[i]
+                for i in range(len(seen_secs) - 1)]
+    max_gap = max(gap_list)
+    duration = (int((60 - max_gap / 60.0) / 15) + 1) * 15
+
+    if len(gap_list) > 4 and sorted(gap_list)[-2] > 900:
+        sp['kind'] = 'hshs'
+    else:
+        sp['kind'] = ''.join(
+            ['s' if i > (3 - duration / 15) else 'h' for i in range(0, 4)])
+    sp['links'] = sp['kind'].replace('s', '?')
+
+    if sp['kind'] != 'ssss':
+        if (not sp['earliest_unseen'] or
+                sp['earliest_unseen'] % 3600 != sp['latest_seen'] % 3600 or
+                not tth_found):
+            sp['latest_seen'] = seen_secs[gap_list.index(max_gap)]
+            if not sp['earliest_unseen'] or sp['kind'] != old_kind:
+                sp['earliest_unseen'] = (sp['latest_seen'] + 900) % 3600
+        return
+
+    sp['links'] = '+++-'
+    if sp['earliest_unseen'] % 3600 == sp['latest_seen'] % 3600:
+        return
+
+    sight_list = [{'date': query[i]['scan_time'],
+                   'delta': query[i + 1]['scan_time'] -
+                   query[i]['scan_time'],
+                   'same': query[i + 1]['encounter_id'] ==
+                   query[i]['encounter_id']}
+                  for i in range(len(query) - 1)
+                  if query[i + 1]['scan_time'] - query[i]['scan_time'] <
+                  timedelta(hours=1)]
+
+    start_end_list = []
+    for s in sight_list:
+        if s['same']:
+            start = date_secs(s['date'])
+            end = (start + int(s['delta'].total_seconds())) % 3600
+        else:
+            start = date_secs(s['date'] + s['delta']) % 3600
+            end = date_secs(s['date'])
+        start_end_list.append([start, end])
+
+    while True:
+        union = []
+        for start, end in start_end_list:
+            if not union:
+                union.append([start, end])
+                continue
+            for u in union:
+                if clock_between(u[0], start, u[1]):
+                    u[1] = end if not(clock_between(
+                        u[0], end, u[1])) else u[1]
+                elif clock_between(u[0], end, u[1]):
+                    u[0] = start if not(clock_between(
+                        u[0], start, u[1])) else u[0]
+                elif union.count([start, end]) == 0:
+                    union.append([start, end])
+        if union == start_end_list:
+            break
+        start_end_list = union
+
+    union = reduce(lambda x, y: x if (x[1] - x[0]) % 3600 >
+                   (y[1] - y[0]) % 3600 else y, union, [0, 3600])
+    sp['latest_seen'] = union[1]
+    sp['earliest_unseen'] = union[0]
+
+
+def random_sightings(rng, count):
+    scan_time = datetime(2018, 1, 1) + timedelta(seconds=rng.randint(0, 3599))
+    # Scans of spawns of a few kinds, with some duplicate seconds.
+    spawn_secs = rng.choice((900, 1800, 2700, 3600))
+    appear = rng.randint(0, 3599)
+    sightings = []
+    while len(sightings) < count:
+        scan_time += timedelta(seconds=rng.choice(
+            (rng.randint(1, 600), rng.randint(600, 5400), 3600, 1800)))
+        secs = (date_secs(scan_time) - appear) % 3600
+        if secs >= spawn_secs and rng.random() < 0.8:
+            continue
+        tth_secs = None
+        if rng.random() < 0.1:
+            tth_secs = (appear + spawn_secs) % 3600
+        sightings.append({
+            'encounter_id': (scan_time - datetime(2018, 1, 1)).days * 24 +
+            (scan_time.hour if rng.random() < 0.9 else rng.randint(0, 2)),
+            'scan_time': scan_time,
+            'tth_secs': tth_secs})
+    return sightings
+
+
+class SightingSummaryTest(unittest.TestCase):
+
+    def test_same_as_full_history(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            # Up to twice the 48 sightings the first version kept.
+            sightings = random_sightings(rng, rng.randint(1, 96))
+            summary = SightingSummary()
+            history = []
+            expected = {'kind': 'hhhs', 'links': '????', 'latest_seen': 0,
+                        'earliest_unseen': 0}
+            actual = dict(expected)
+            for sighting in sightings:
+                scan_loc = {'done': rng.random() < 0.8}
+                now_secs = date_secs(sighting['scan_time'])
+                history.append(sighting)
+                summary.add(sighting)
+                classify_history(expected, scan_loc, now_secs, history)
+                summary.classify(actual, scan_loc, now_secs)
+                self.assertEqual(expected, actual)
+
+                # Classifying again without a new sighting.
+                classify_history(expected, scan_loc, now_secs, history)
+                summary.classify(actual, scan_loc, now_secs)
+                self.assertEqual(expected, actual)
+
+                # Same result after storing and loading the summary.
+                stored = SightingSummary.loads(summary.dumps())
+                self.assertEqual(summary.seen, stored.seen)
+                self.assertEqual(summary.gaps, stored.gaps)
+                loaded = dict(actual)
+                stored.classify(loaded, scan_loc, now_secs)
+                classify_history(expected, scan_loc, now_secs, history)
+                self.assertEqual(expected, loaded)
+
+    def test_range_limit(self):
+        rng = random.Random(2)
+        range_limit = summaries.range_limit
+        summaries.range_limit = 10
+        try:
+            summary = SightingSummary()
+            for sighting in random_sightings(rng, 100):
+                summary.add(sighting)
+        finally:
+            summaries.range_limit = range_limit
+
+        unlimited = SightingSummary()
+        for sighting in random_sightings(random.Random(2), 100):
+            unlimited.add(sighting)
+
+        # Only the most recent ranges are kept, also when stored.
+        self.assertEqual(unlimited.ranges()[-10:], summary.ranges())
+        stored = SightingSummary.loads(summary.dumps())
+        self.assertEqual(summary.ranges(), stored.ranges())
+        self.assertEqual(summary.last, stored.last)
+        self.assertEqual(unlimited.seen, stored.seen)
+
+    def test_merge(self):
+        rng = random.Random(3)
+        sightings = random_sightings(rng, 60)
+        ours, theirs = SightingSummary(), SightingSummary()
+        for i, sighting in enumerate(sightings):
+            (ours if i % 2 else theirs).add(sighting)
+
+        ours.merge(theirs)
+        self.assertEqual(sorted(set(ours.seen + theirs.seen)), ours.seen)
+        self.assertEqual(max(s['scan_time'] for s in sightings),
+                         datetime.utcfromtimestamp(ours.last[0]))
+        for sighting_range in theirs.ranges():
+            self.assertIn(sighting_range, ours.ranges())
+
+        # Merging the same summary again changes nothing.
+        merged = ours.dumps()
+        ours.merge(theirs)
+        self.assertEqual(merged, ours.dumps())
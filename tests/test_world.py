@@ -0,0 +1,47 @@
+import unittest
+
+from pogom.world import SyntheticWorld
+
+location = (40.7580, -73.9855)
+now = 1500000000
+
+
+class SyntheticWorldTest(unittest.TestCase):
+
+    def setUp(self):
+        self.world = SyntheticWorld(42, location, radius=500,
+                                    spawnpoints=500, pokestops=20, gyms=10)
+
+    def test_same_seed_same_answers(self):
+        other = SyntheticWorld(42, location, radius=500, spawnpoints=500,
+                               pokestops=20, gyms=10)
+        for t in (now, now + 600, now + 3600 * 5):
+            self.assertEqual(self.world.map_objects(location, now=t),
+                             other.map_objects(location, now=t))
+
+    def test_spawns_every_hour(self):
+        for sp in self.world.spawnpoints.values():
+            spawn = self.world.spawn(sp, now)
+            if spawn is None:
+                continue
+            encounter_id, despawn = spawn
+            # Spawned until it despawns, at the same second next hour with a
+            # new encounter id.
+            self.assertEqual(self.world.spawn(sp, despawn - 1), spawn)
+            self.assertNotEqual(self.world.spawn(sp, despawn), spawn)
+            later = self.world.spawn(sp, despawn + 3599)
+            self.assertEqual(later[1], despawn + 3600)
+            self.assertNotEqual(later[0], encounter_id)
+
+    def test_encounter_matches_map(self):
+        found = 0
+        for cell in self.world.map_objects(location, now=now)['map_cells']:
+            for p in cell['wild_pokemons']:
+                response = self.world.encounter(
+                    p['encounter_id'], p['spawn_point_id'], now)
+                self.assertEqual(response['status'], 1)
+                self.assertEqual(
+                    response['wild_pokemon']['pokemon_data']['pokemon_id'],
+                    p['pokemon_data']['pokemon_id'])
+                found += 1
+        self.assertGreater(found, 0)
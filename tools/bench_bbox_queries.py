@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmark of viewport queries on a synthetic table, comparing the
+# (latitude, longitude) index with S2 cell id ranges.
+#
+# Uses the database settings from the config file or command line, and
+# creates (once) and keeps a `benchlocation` table in that database:
+#
+#   python tools/bench_bbox_queries.py -os -l "40.73,-73.99" \
+#       --bench-rows 10000000 --bench-queries 200
+
+import sys
+import time
+import random
+import logging
+import argparse
+
+from peewee import DoubleField, PrimaryKeyField
+
+sys.path.append('.')
+bench_parser = argparse.ArgumentParser(add_help=False)
+bench_parser.add_argument('--bench-rows', type=int, default=10000000)
+bench_parser.add_argument('--bench-queries', type=int, default=200)
+bench_parser.add_argument('--bench-seed', type=int, default=1)
+bench_args, sys.argv[1:] = bench_parser.parse_known_args()
+
+from pogom.utils import get_args, s2_cell_id  # noqa: E402
+from pogom.models import (init_database, LatLongModel,  # noqa: E402
+                          UBigIntegerField)
+
+logging.basicConfig(
+    format='%(asctime)s [%(module)14s][%(levelname)8s] %(message)s',
+    level=logging.INFO)
+log = logging.getLogger()
+
+args = get_args()
+
+
+class BenchLocation(LatLongModel):
+    id = PrimaryKeyField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+    s2_cell_id = UBigIntegerField(index=True)
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
+
+
+# Spread points over a ~60x60 km area around the location, denser in the
+# middle like a real city.
+def random_location(center):
+    return (center[0] + random.gauss(0, 0.12),
+            center[1] + random.gauss(0, 0.16))
+
+
+def populate(db, center, num_rows, step=10000):
+    count = BenchLocation.select().count()
+    if count >= num_rows:
+        log.info('Table already has %d rows.', count)
+        return
+
+    log.info('Inserting %d rows, this takes a while.', num_rows - count)
+    while count < num_rows:
+        rows = []
+        for _ in range(min(step, num_rows - count)):
+            lat, lng = random_location(center)
+            rows.append({'latitude': lat, 'longitude': lng,
+                         's2_cell_id': s2_cell_id(lat, lng)})
+        with db.atomic():
+            BenchLocation.insert_many(rows).execute()
+        count += len(rows)
+        if count % 1000000 < step:
+            log.info('%d rows inserted.', count)
+
+
+def bench(name, viewports, where):
+    found = 0
+    start = time.time()
+    for (swLat, swLng, neLat, neLng) in viewports:
+        found += (BenchLocation
+                  .select(BenchLocation.id)
+                  .where(where(swLat, swLng, neLat, neLng))
+                  .count())
+    elapsed = time.time() - start
+    log.info('%-12s %8.2f ms/query, %d rows.', name,
+             elapsed * 1000 / len(viewports), found)
+    return found
+
+
+def by_coordinates(swLat, swLng, neLat, neLng):
+    return ((BenchLocation.latitude >= swLat) &
+            (BenchLocation.longitude >= swLng) &
+            (BenchLocation.latitude <= neLat) &
+            (BenchLocation.longitude <= neLng))
+
+
+def main():
+    random.seed(bench_args.bench_seed)
+    center = [float(c) for c in args.location.split(',')[:2]]
+
+    db = init_database(None)
+    db.create_tables([BenchLocation], safe=True)
+    populate(db, center, bench_args.bench_rows)
+
+    # Normal map viewports, and tall thin strips which the latitude index
+    # can't narrow down.
+    shapes = {'viewport': (0.03, 0.05), 'strip': (0.3, 0.005)}
+    for shape, (height, width) in shapes.iteritems():
+        viewports = []
+        for _ in range(bench_args.bench_queries):
+            lat, lng = random_location(center)
+            viewports.append((lat, lng, lat + height, lng + width))
+
+        log.info('%d %s queries of %.3f x %.3f degrees:',
+                 len(viewports), shape, height, width)
+        a = bench('lat/lng', viewports, by_coordinates)
+        b = bench('s2 ranges', viewports, BenchLocation.in_bounds)
+        if a != b:
+            log.error('Queries returned different results!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmark of bulk_upsert() write throughput on a copy of the pokemon table,
+# to compare the MySQL and PostgreSQL backends on the same machine:
+#
+#   python tools/bench_bulk_upsert.py --db-type mysql ...
+#   python tools/bench_bulk_upsert.py --db-type postgres ...
+#
+# Uses the database settings from the config file or command line. The
+# `benchpokemon` table is created and dropped again by the benchmark.
+
+import sys
+import time
+import random
+import logging
+import argparse
+
+from datetime import datetime, timedelta
+
+sys.path.append('.')
+bench_parser = argparse.ArgumentParser(add_help=False)
+bench_parser.add_argument('--bench-rows', type=int, default=200000)
+bench_parser.add_argument('--bench-batch', type=int, default=1000)
+bench_parser.add_argument('--bench-seed', type=int, default=1)
+bench_args, sys.argv[1:] = bench_parser.parse_known_args()
+
+from pogom.utils import get_args  # noqa: E402
+from pogom.models import init_database, bulk_upsert, Pokemon  # noqa: E402
+
+logging.basicConfig(
+    format='%(asctime)s [%(module)14s][%(levelname)8s] %(message)s',
+    level=logging.INFO)
+log = logging.getLogger()
+
+args = get_args()
+
+
+class BenchPokemon(Pokemon):
+    pass
+
+
+def random_rows(center, encounter_ids):
+    now = datetime.utcnow()
+    rows = {}
+    for encounter_id in encounter_ids:
+        rows[encounter_id] = {
+            'encounter_id': encounter_id,
+            'spawnpoint_id': random.getrandbits(40),
+            'pokemon_id': random.randint(1, 386),
+            'latitude': center[0] + random.gauss(0, 0.1),
+            'longitude': center[1] + random.gauss(0, 0.1),
+            'disappear_time': now + timedelta(
+                seconds=random.randint(60, 3600)),
+            'individual_attack': random.randint(0, 15),
+            'individual_defense': random.randint(0, 15),
+            'individual_stamina': random.randint(0, 15),
+            'move_1': random.randint(1, 300),
+            'move_2': random.randint(1, 300),
+            'cp': random.randint(10, 3000),
+            'gender': random.randint(1, 3)
+        }
+    return rows
+
+
+def bench(name, db, batches):
+    num_rows = 0
+    start = time.time()
+    for rows in batches:
+        bulk_upsert(BenchPokemon, rows, db)
+        num_rows += len(rows)
+    elapsed = time.time() - start
+    log.info('%-8s %8d rows in %6.2f s, %8.0f rows/s.', name, num_rows,
+             elapsed, num_rows / elapsed)
+
+
+def main():
+    random.seed(bench_args.bench_seed)
+    center = [float(c) for c in args.location.split(',')[:2]]
+    step = bench_args.bench_batch
+
+    db = init_database(None)
+    db.drop_tables([BenchPokemon], safe=True)
+    db.create_tables([BenchPokemon])
+
+    # Encounter ids are 64 bit, make sure the unsigned range is covered.
+    encounter_ids = [random.getrandbits(64)
+                     for _ in range(bench_args.bench_rows)]
+    batches = [random_rows(center, encounter_ids[i:i + step])
+               for i in range(0, len(encounter_ids), step)]
+
+    try:
+        log.info('Bulk upserts on %s, %d rows per batch:', args.db_type,
+                 step)
+        bench('insert', db, batches)
+        # Same keys again, so every row hits the conflict/duplicate key path.
+        for rows in batches:
+            for row in rows.itervalues():
+                row['cp'] += 1
+        bench('update', db, batches)
+    finally:
+        db.drop_tables([BenchPokemon], safe=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Replays map responses recorded with --record-responses through parse_map,
+# as fast as it goes, to benchmark and profile the parse path without
+# accounts:
+#
+#   python tools/replay_responses.py --replay-path recordings/ ...
+#   python tools/replay_responses.py --replay-path recordings/ \
+#       --replay-profile parse.prof ...
+#
+# Uses the database settings from the config file or command line for the
+# reads of parse_map. Its database writes and webhooks are discarded, unless
+# --replay-persist is given: then db updater threads write them as while
+# scanning, and the time to finish the writes is reported as well.
+#
+# With --replay-memory, the size of what parse_map queues for the database and
+# webhooks is reported per scan, counting objects shared by both queues once.
+
+import os
+import sys
+import glob
+import logging
+import argparse
+import cProfile
+
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+from timeit import default_timer
+from pogoprotos.networking.responses.get_map_objects_response_pb2 import (
+    GetMapObjectsResponse)
+
+sys.path.append('.')
+replay_parser = argparse.ArgumentParser(add_help=False)
+replay_parser.add_argument('--replay-path', required=True,
+                           help='Recorded segment file or directory.')
+replay_parser.add_argument('--replay-limit', type=int, default=0,
+                           help='Maximum number of responses to replay.')
+replay_parser.add_argument('--replay-persist', action='store_true',
+                           help='Write the parsed data to the database.')
+replay_parser.add_argument('--replay-profile', default=None,
+                           help='File to save cProfile stats of parsing to.')
+replay_parser.add_argument('--replay-memory', action='store_true',
+                           help='Report the size of the queued data.')
+replay_args, sys.argv[1:] = replay_parser.parse_known_args()
+
+from pogom.utils import get_args  # noqa: E402
+from pogom.models import (  # noqa: E402
+    init_database, db_updater, parse_map, ScannedLocation)
+from pogom.recorder import read_segments  # noqa: E402
+from pogom.metrics import log_metrics  # noqa: E402
+
+logging.basicConfig(
+    format='%(asctime)s [%(module)14s][%(levelname)8s] %(message)s',
+    level=logging.INFO)
+log = logging.getLogger()
+
+args = get_args()
+# There are no accounts to make requests with.
+args.encounter = False
+args.pokestop_spinning = False
+
+
+# Stands in for the db and webhook queues, dropping everything put on it.
+class DiscardQueue(object):
+
+    def put(self, item, *args, **kwargs):
+        pass
+
+    def qsize(self):
+        return 0
+
+
+# Adds up the deep size of the data put on the queues, for --replay-memory.
+# Objects already counted for the scan, on either queue, aren't counted again.
+class MeasuringQueue(object):
+
+    def __init__(self, queue, totals):
+        self.queue = queue
+        self.totals = totals
+
+    def put(self, item, *args, **kwargs):
+        # Data only: (model class or webhook type, data).
+        self.add(item[1])
+        self.queue.put(item, *args, **kwargs)
+
+    def add(self, obj):
+        seen = self.totals['seen']
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        self.totals['bytes'] += sys.getsizeof(obj)
+        self.totals['objects'] += 1
+
+        if isinstance(obj, dict):
+            children = obj.keys() + obj.values()
+        elif isinstance(obj, (list, tuple, set)):
+            children = obj
+        else:
+            slots = getattr(type(obj), '__slots__', ())
+            children = [getattr(obj, name) for name in slots
+                        if hasattr(obj, name)]
+        for child in children:
+            self.add(child)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+def segment_paths(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, 'responses-*.gz')))
+    return [path]
+
+
+def main():
+    db = init_database(None)
+    whq = DiscardQueue()
+    dbq = DiscardQueue()
+    if replay_args.replay_persist:
+        dbq = persist_queue = Queue()
+        for i in range(args.db_threads):
+            t = Thread(target=db_updater, name='db-updater-{}'.format(i),
+                       args=(dbq, db))
+            t.daemon = True
+            t.start()
+
+    totals = {'bytes': 0, 'objects': 0, 'seen': set()}
+    if replay_args.replay_memory:
+        dbq = MeasuringQueue(dbq, totals)
+        whq = MeasuringQueue(whq, totals)
+
+    profile = cProfile.Profile() if replay_args.replay_profile else None
+    timings = {'decode': 0.0, 'location': 0.0, 'parse': 0.0, 'persist': 0.0}
+    scans = 0
+    # Pokemon and forts are reported by the log of parse_map.
+    logging.getLogger('pogom.models').setLevel(logging.WARNING)
+
+    start = default_timer()
+    for metadata, data in read_segments(
+            segment_paths(replay_args.replay_path)):
+        phase = default_timer()
+        response = GetMapObjectsResponse()
+        response.ParseFromString(data)
+        timings['decode'] += default_timer() - phase
+
+        scan_coords = (metadata['latitude'], metadata['longitude'],
+                       metadata['altitude'])
+        phase = default_timer()
+        scan_location = ScannedLocation.get_by_loc(scan_coords)
+        timings['location'] += default_timer() - phase
+
+        parse_args = (
+            args, {'responses': {'GET_MAP_OBJECTS': response}}, scan_coords,
+            scan_location, dbq, whq, None, None, {'proxy_url': None},
+            datetime.utcfromtimestamp(metadata['scan_date']),
+            {'username': 'replay', 'level': metadata['level']}, None)
+        phase = default_timer()
+        if profile:
+            profile.runcall(parse_map, *parse_args)
+        else:
+            parse_map(*parse_args)
+        timings['parse'] += default_timer() - phase
+
+        totals['seen'].clear()
+        scans += 1
+        if scans == replay_args.replay_limit:
+            break
+
+    if replay_args.replay_persist:
+        phase = default_timer()
+        persist_queue.join()
+        timings['persist'] += default_timer() - phase
+    elapsed = default_timer() - start
+
+    if not scans:
+        log.error('No responses found in %s.', replay_args.replay_path)
+        return
+
+    log.info('Replayed %d scans in %.2f s, %.1f scans/s.', scans, elapsed,
+             scans / elapsed)
+    for name in ('decode', 'location', 'parse', 'persist'):
+        log.info('%-8s %8.2f s, %8.3f ms/scan, %5.1f%%.', name,
+                 timings[name], timings[name] * 1000 / scans,
+                 timings[name] * 100 / elapsed)
+    if replay_args.replay_memory:
+        log.info('Queued %.1f KB in %.0f objects per scan.',
+                 totals['bytes'] / 1024.0 / scans,
+                 float(totals['objects']) / scans)
+    log_metrics(log.info)
+
+    if profile:
+        profile.dump_stats(replay_args.replay_profile)
+        log.info('Saved parse profile to %s.', replay_args.replay_profile)
+
+
+if __name__ == '__main__':
+    main()